@@ -1,20 +1,55 @@
 from django.contrib import admin
 from apps.fbschema.models import *
+from apps.fbschema.admin_utils import FastModelAdmin
 
-class FacebookUserAdmin(admin.ModelAdmin):
-    list_display = ('username', 'about_me')
+# Change lists of the big tables are built by FastModelAdmin, see apps.fbschema.admin_utils. Foreign keys shown in
+# list_display are joined ( FacebookUser's __unicode__ reads its profile ), search_fields are exact matches on indexed
+# columns and list_filter is kept to the system user, filtering by owner would list every FacebookUser as a choice
 
-class FacebookAlbumAdmin(admin.ModelAdmin):
+class FacebookUserProfileAdmin(FastModelAdmin):
+    list_display = ('username', 'about_me', 'refreshed')
+    search_fields = ('uid',)
+
+class FacebookUserAdmin(FastModelAdmin):
+    list_display = ('profile', 'uid', 'user', 'mutual_friend_count')
+    select_related_fields = ('profile', 'user')
+    search_fields = ('uid',)
+    list_filter = ('user',)
+
+class FacebookAlbumAdmin(FastModelAdmin):
     list_display = ('owner', 'name', 'description', 'user')
+    select_related_fields = ('owner__profile', 'user')
+    search_fields = ('aid', 'object_id')
+    list_filter = ('user',)
 
-class FacebookPhotoAdmin(admin.ModelAdmin):
+class FacebookPhotoAdmin(FastModelAdmin):
     list_display = ('owner', 'caption', 'src_big', 'aid', 'user')
+    select_related_fields = ('owner__profile', 'aid', 'user')
+    search_fields = ('pid', 'object_id', 'album_object_id')
+    list_filter = ('user',)
 
-class FacebookLinkAdmin(admin.ModelAdmin):
+class FacebookLinkAdmin(FastModelAdmin):
     list_display = ('owner', 'title', 'summary', 'url')
-    list_filter = ('owner',)
+    select_related_fields = ('owner__profile',)
+    search_fields = ('link_id',)
+    list_filter = ('user',)
+
+class FacebookStreamAdmin(FastModelAdmin):
+    list_display = ('post_id', 'actor_id', 'message', 'type', 'created_time', 'user')
+    select_related_fields = ('user',)
+    search_fields = ('source_id', 'target_id')
+    list_filter = ('user',)
+
+class FacebookNotificationAdmin(FastModelAdmin):
+    list_display = ('notification_id', 'recipient_id', 'sender_id', 'title_text', 'created_time', 'user')
+    select_related_fields = ('recipient_id__profile', 'user')
+    search_fields = ('notification_id',)
+    list_filter = ('user',)
 
+admin.site.register(FacebookUserProfile, FacebookUserProfileAdmin)
 admin.site.register(FacebookUser, FacebookUserAdmin)
 admin.site.register(FacebookAlbum, FacebookAlbumAdmin)
 admin.site.register(FacebookPhoto, FacebookPhotoAdmin)
 admin.site.register(FacebookLink, FacebookLinkAdmin)
+admin.site.register(FacebookStream, FacebookStreamAdmin)
+admin.site.register(FacebookNotification, FacebookNotificationAdmin)
@@ -0,0 +1,216 @@
+'''
+Admin change lists of tables with millions of tuples. The stock ChangeList counts the table twice per page, joins
+every foreign key recursively, reads deep pages with LIMIT/OFFSET and searches with LIKE '%term%', each of which
+scans the whole table. FastModelAdmin instead -
+    joins the foreign keys of select_related_fields only ( e.g. owner__profile, which owner's __unicode__ reads )
+    counts exactly up to settings.FBSCHEMA_ADMIN_EXACT_COUNT_LIMIT tuples, from the statistics of the database
+    above that ( MySQL, PostgreSQL ), and caps filtered counts there
+    reads the pages of the default order ( -id ) by seeking to the key they start at. The starting key of the
+    next page is remembered until a tuple is added to the table, so paging through a list never scans the pages before
+    searches search_fields, indexed columns, for exact matches of the terms
+'''
+import hashlib
+import operator
+from functools import reduce
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.util import get_fields_from_path
+from django.contrib.admin.views.main import ChangeList
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage, Page, Paginator
+from django.db import connections
+from django.db.models import Max, Q
+
+ADMIN_EXACT_COUNT_LIMIT = getattr(settings, 'FBSCHEMA_ADMIN_EXACT_COUNT_LIMIT', 10000)
+# Seconds the starting key of a next page is remembered
+ADMIN_KEYSET_TIMEOUT = getattr(settings, 'FBSCHEMA_ADMIN_KEYSET_TIMEOUT', 600)
+
+
+def capped_count(queryset, limit):
+    '''
+    Number of tuples of queryset, counting stops at limit + 1
+    '''
+    sql, params = queryset.order_by().values_list('pk')[:limit + 1].query.sql_with_params()
+    cursor = connections[queryset.db].cursor()
+    cursor.execute("SELECT COUNT(*) FROM (%s) capped" % sql, params)
+    return cursor.fetchone()[0]
+
+
+def table_rows_estimate(model, using):
+    '''
+    Number of rows of the table of model according to the statistics of the database, None if it keeps none
+    '''
+    connection = connections[using]
+    cursor = connection.cursor()
+    if connection.vendor == 'mysql':
+        cursor.execute("SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                       [model._meta.db_table])
+    elif connection.vendor == 'postgresql':
+        cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [model._meta.db_table])
+    else:
+        return None
+    row = cursor.fetchone()
+    return row and row[0] or None
+
+
+def estimated_count(queryset, limit=ADMIN_EXACT_COUNT_LIMIT):
+    '''
+    Exact number of tuples of queryset up to limit. Above it, the estimate of the database for a whole table and
+    limit for a filtered one
+    '''
+    count = capped_count(queryset, limit)
+    if count <= limit:
+        return count
+    if not queryset.query.where:
+        return max(table_rows_estimate(queryset.model, queryset.db) or limit, limit)
+    return limit
+
+
+def keyset_direction(queryset):
+    '''
+    '-' or '' when queryset is ordered by primary key alone, descending or ascending, None otherwise
+    '''
+    # ChangeList repeats the ordering ModelAdmin.queryset has already applied
+    ordering = []
+    for field_name in queryset.query.order_by:
+        if field_name not in ordering:
+            ordering.append(field_name)
+    if ordering in (['-pk'], ['-id']):
+        return '-'
+    if ordering in (['pk'], ['id']):
+        return ''
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    '''
+    Paginator counting with estimated_count
+    '''
+    def _get_count(self):
+        if self._count is None:
+            self._count = estimated_count(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+
+class KeysetPaginator(EstimatedCountPaginator):
+    '''
+    Pages of a queryset ordered by primary key are read from the key they start at, WHERE id <= start LIMIT n, rather
+    than with an OFFSET. The start of a page is the key remembered when the page before it was read, else it is
+    looked up among the keys alone. Other orders are paged with OFFSET
+    '''
+    _latest_key = None
+
+    def latest_key(self):
+        '''
+        Highest key of the whole table, read once per paginator. Tuples stored since shift the pages, remembered
+        starts are keyed by it so that they aren't used after a sync
+        '''
+        if self._latest_key is None:
+            model = self.object_list.model
+            self._latest_key = model._default_manager.using(self.object_list.db).aggregate(latest=Max('pk'))['latest'] or 0
+        return self._latest_key
+
+    def boundary_key(self, number):
+        # compiling adds the joins of select_related to a query, a clone is compiled
+        sql, params = self.object_list.query.clone().sql_with_params()
+        text = u"%s|%r|%s|%s|%s" % (sql, params, self.per_page, number, self.latest_key())
+        return 'fbschema:admin:keyset:%s' % hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def page(self, number):
+        number = self.validate_number(number)
+        direction = keyset_direction(self.object_list)
+        if direction is None:
+            return super(KeysetPaginator, self).page(number)
+        queryset = self.object_list
+        if number > 1:
+            start = cache.get(self.boundary_key(number))
+            if start is None:
+                bottom = (number - 1) * self.per_page
+                start = list(queryset.values_list('pk', flat=True)[bottom:bottom + 1])
+                start = start and start[0] or None
+            if start is None:
+                return Page([], number, self)
+            queryset = queryset.filter(**{direction and 'pk__lte' or 'pk__gte': start})
+        # one tuple more tells where the next page starts
+        object_list = list(queryset[:self.per_page + 1])
+        if len(object_list) > self.per_page:
+            cache.set(self.boundary_key(number + 1), object_list[-1].pk, ADMIN_KEYSET_TIMEOUT)
+        return Page(object_list[:self.per_page], number, self)
+
+
+def indexed_search(queryset, search_fields, query):
+    '''
+    Tuples of queryset where, for every term of query, one of search_fields equals the term. Fields which can't hold
+    a term ( letters for a number column ) are skipped
+    '''
+    for term in query.split():
+        or_queries = []
+        for path in search_fields:
+            try:
+                or_queries.append(Q(**{path: get_fields_from_path(queryset.model, path)[-1].to_python(term)}))
+            except ValidationError:
+                pass
+        if not or_queries:
+            # no tuple matches, none() would be counted as the whole table by capped_count
+            return queryset.filter(pk__isnull=True)
+        queryset = queryset.filter(reduce(operator.or_, or_queries))
+    return queryset
+
+
+class FastChangeList(ChangeList):
+    def get_query_set(self, request):
+        # the stock search would run LIKE '%term%' on every search field
+        query, self.query = self.query, ''
+        try:
+            queryset = super(FastChangeList, self).get_query_set(request)
+        finally:
+            self.query = query
+        if self.search_fields and query:
+            queryset = indexed_search(queryset, self.search_fields, query)
+        return queryset
+
+    def get_results(self, request):
+        # ChangeList.get_results with the full_result_count of a filtered list estimated too, rather than counted
+        paginator = self.model_admin.get_paginator(request, self.query_set, self.list_per_page)
+        result_count = paginator.count
+        if not self.query_set.query.where:
+            full_result_count = result_count
+        else:
+            full_result_count = estimated_count(self.root_query_set)
+        can_show_all = result_count <= self.list_max_show_all
+        multi_page = result_count > self.list_per_page
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.query_set._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+
+class FastModelAdmin(admin.ModelAdmin):
+    '''
+    ModelAdmin of the big fql tables. search_fields are exact matches on indexed columns
+    '''
+    select_related_fields = ()
+    ordering = ('-id',)
+    paginator = KeysetPaginator
+
+    def queryset(self, request):
+        queryset = super(FastModelAdmin, self).queryset(request)
+        if self.select_related_fields:
+            queryset = queryset.select_related(*self.select_related_fields)
+        return queryset
+
+    def get_changelist(self, request, **kwargs):
+        return FastChangeList
@@ -0,0 +1,42 @@
+from django.db import models
+from django.contrib.auth.models import User
+
+'''
+Materialized aggregates of the fql tables, see apps.fbschema.aggregates
+'''
+
+class RankedTuple(models.Model):
+    '''
+    Score of a tuple on a leaderboard ( e.g. the likes of an album ). Reading a top N walks the
+    (user, table, metric, score) index backwards, nothing is sorted at query time
+    '''
+    user                = models.ForeignKey(User, help_text="System user the tuple belongs to")
+    table               = models.CharField( max_length=100, help_text="fqlname of the model" )
+    metric              = models.CharField( max_length=50, help_text="Name of the leaderboard, one of ranked_by of the model" )
+    key                 = models.CharField( max_length=255, help_text="primary_identifier value of the tuple" )
+    score               = models.IntegerField()
+
+    def __unicode__(self):
+        return "%s %s %s: %d" % (self.table, self.metric, self.key, self.score)
+
+    class Meta:
+        unique_together = (("user", "table", "metric", "key"),)
+        index_together = (("user", "table", "metric", "score"),)
+
+
+class GroupCount(models.Model):
+    '''
+    Number of tuples of a table sharing the value of a column, e.g. the albums of an owner or the posts of a type.
+    Foreign keys are grouped by id
+    '''
+    user                = models.ForeignKey(User, help_text="System user the tuples belong to")
+    table               = models.CharField( max_length=100, help_text="fqlname of the model" )
+    dimension           = models.CharField( max_length=50, help_text="Name of the grouped column, one of counted_by of the model" )
+    group               = models.CharField( max_length=255, blank=True, null=True, help_text="Value of the column, NULL for tuples without one" )
+    count               = models.IntegerField( default=0 )
+
+    def __unicode__(self):
+        return "%s %s=%s: %d" % (self.table, self.dimension, self.group, self.count)
+
+    class Meta:
+        unique_together = (("user", "table", "dimension", "group"),)
@@ -0,0 +1,169 @@
+'''
+Aggregates of the fql tables kept up to date as syncs write, instead of being computed by sorted joins at query time.
+Models declare them -
+    ranked_by   = {"likes": ("like_info", "like_count")} # leaderboards, RankedTuple scores read from a struct column
+    counted_by  = ("owner", "type")                      # GroupCount per value of a column
+and the rows_changed receiver below applies every added, updated and deleted tuple of save_update_delete to them, so
+a leaderboard or a count costs one index read.
+
+Counts are increments, a system user's syncs run one at a time ( see apps.fbschema.jobs.claim_job ) so they don't
+race. fbschema_aggregates rebuilds everything from the stored tuples, e.g. after turning settings.FBSCHEMA_AGGREGATES on.
+
+Usage -
+    for album, likes in top(request.user, FacebookAlbum, 'likes', 10):
+        print album.name, album.owner, likes
+    group_counts(request.user, FacebookPhoto, 'owner')
+'''
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import F, ForeignKey
+
+from apps.fbschema.aggregate_models import RankedTuple, GroupCount
+from apps.fbschema.signals import rows_changed
+from apps.fbschema.bulk_utils import BULK_CHUNK_SIZE, chunked, iterate_in_pages
+
+logger = logging.getLogger(__name__)
+
+AGGREGATES_ENABLED = getattr(settings, 'FBSCHEMA_AGGREGATES', True)
+
+
+def has_aggregates(model):
+    return bool(getattr(model, 'ranked_by', None) or getattr(model, 'counted_by', None))
+
+
+def ref(value):
+    # foreign keys are given as instances in data_dicts and as ids in stored values
+    return getattr(value, 'pk', value)
+
+
+def group_of(value):
+    value = ref(value)
+    return value is not None and unicode(value) or None
+
+
+def struct_scores(model, metric, values):
+    '''
+    Scores of a metric for the struct column values ( instances or ids ) of some tuples, in order. Ids are
+    looked up in one query
+    '''
+    field_name, struct_field = model.ranked_by[metric]
+    struct_model = model._meta.get_field(field_name).rel.to
+    ids = set([value for value in values if value is not None and not hasattr(value, 'pk')])
+    looked_up = ids and dict(struct_model.objects.filter(id__in=ids).values_list('id', struct_field)) or {}
+    scores = []
+    for value in values:
+        if value is None:
+            scores.append(None)
+        elif hasattr(value, 'pk'):
+            scores.append(getattr(value, struct_field))
+        else:
+            scores.append(looked_up.get(value))
+    return scores
+
+
+def write_ranks(model, user, metric, stale_keys, data_dicts):
+    '''
+    Drops the scores of stale_keys and adds those of data_dicts
+    '''
+    table = model.fqlname
+    for chunk in chunked([unicode(key) for key in stale_keys], BULK_CHUNK_SIZE):
+        RankedTuple.objects.filter(user=user, table=table, metric=metric, key__in=chunk).delete()
+    field_name = model.ranked_by[metric][0]
+    for chunk in chunked(data_dicts, BULK_CHUNK_SIZE):
+        scores = struct_scores(model, metric, [data_dict[field_name] for data_dict in chunk])
+        RankedTuple.objects.bulk_create([RankedTuple(user=user, table=table, metric=metric, key=unicode(data_dict[model.primary_identifier]), score=score)
+                                         for data_dict, score in zip(chunk, scores) if score is not None])
+
+
+def apply_counts(model, user, deltas):
+    '''
+    Adds deltas, (dimension, group) => change of the count, to the GroupCounts. Emptied groups are dropped
+    '''
+    emptied = False
+    for (dimension, group), delta in deltas.items():
+        if not delta:
+            continue
+        counts = GroupCount.objects.filter(user=user, table=model.fqlname, dimension=dimension, group=group)
+        if not counts.update(count=F('count') + delta):
+            GroupCount.objects.create(user=user, table=model.fqlname, dimension=dimension, group=group, count=delta)
+        emptied = emptied or delta < 0
+    if emptied:
+        GroupCount.objects.filter(user=user, table=model.fqlname, count__lte=0).delete()
+
+
+def update_aggregates(sender, request, added, updated, deleted, **kwargs):
+    '''
+    rows_changed receiver, applies a save_update_delete call's tuples to the aggregates of the model
+    '''
+    if not has_aggregates(sender):
+        return
+    primary_identifier = sender.primary_identifier
+    for metric, (field_name, struct_field) in getattr(sender, 'ranked_by', {}).items():
+        # structs are interned, an unchanged score keeps its struct tuple
+        changed = [data_dict for old_values, data_dict in updated if ref(old_values[field_name]) != ref(data_dict[field_name])]
+        # added tuples may have had a score already when they were recovered by handle_integrity_exception
+        stale_keys = [data_dict[primary_identifier] for data_dict in list(added) + changed] + \
+                     [old_values[primary_identifier] for old_values in deleted]
+        write_ranks(sender, request.user, metric, stale_keys, list(added) + changed)
+
+    deltas = defaultdict(int)
+    for dimension in getattr(sender, 'counted_by', ()):
+        for data_dict in added:
+            deltas[(dimension, group_of(data_dict[dimension]))] += 1
+        for old_values, data_dict in updated:
+            old_group, group = group_of(old_values[dimension]), group_of(data_dict[dimension])
+            if old_group != group:
+                deltas[(dimension, old_group)] -= 1
+                deltas[(dimension, group)] += 1
+        for old_values in deleted:
+            deltas[(dimension, group_of(old_values[dimension]))] -= 1
+    apply_counts(sender, request.user, deltas)
+
+
+def rebuild_aggregates(model, user):
+    '''
+    Computes the aggregates of model of a system user from its stored tuples again
+    '''
+    RankedTuple.objects.filter(user=user, table=model.fqlname).delete()
+    GroupCount.objects.filter(user=user, table=model.fqlname).delete()
+    ranked_by = getattr(model, 'ranked_by', {})
+    counted_by = getattr(model, 'counted_by', ())
+    field_names = set([field_name for field_name, struct_field in ranked_by.values()]).union(counted_by)
+    # values() gives foreign keys as ids, like the stored values of rows_changed
+    queryset = model.objects.filter(user=user).values('id', model.primary_identifier, *field_names)
+    deltas = defaultdict(int)
+    for page in chunked(iterate_in_pages(queryset), BULK_CHUNK_SIZE):
+        for data_dict in page:
+            for dimension in counted_by:
+                deltas[(dimension, group_of(data_dict[dimension]))] += 1
+        for metric in ranked_by:
+            write_ranks(model, user, metric, [], page)
+    apply_counts(model, user, deltas)
+
+
+def top(user, model, metric, n=10):
+    '''
+    The n tuples of model of a system user scoring highest on a leaderboard, [(tuple, score)]
+    '''
+    ranks = list(RankedTuple.objects.filter(user=user, table=model.fqlname, metric=metric).order_by('-score').values_list('key', 'score')[:n])
+    kwargs = { "%s__in" % model.primary_identifier : [key for key, score in ranks] }
+    tuples = dict([(unicode(getattr(data_tuple, model.primary_identifier)), data_tuple) for data_tuple in model.objects.filter(user=user, **kwargs)])
+    return [(tuples[key], score) for key, score in ranks if key in tuples]
+
+
+def group_counts(user, model, dimension):
+    '''
+    Tuples of model of a system user per value of a column, { value : count }. Foreign keys are given as ids
+    '''
+    field = model._meta.get_field(dimension)
+    convert = isinstance(field, ForeignKey) and int or field.to_python
+    counts = {}
+    for group, count in GroupCount.objects.filter(user=user, table=model.fqlname, dimension=dimension).values_list('group', 'count'):
+        counts[group if group is None else convert(group)] = count
+    return counts
+
+
+if AGGREGATES_ENABLED:
+    rows_changed.connect(update_aggregates, dispatch_uid='fbschema_aggregates')
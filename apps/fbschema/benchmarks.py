@@ -0,0 +1,316 @@
+'''
+Benchmarks of the sync pipeline, run with `python manage.py fbschema_benchmark`.
+
+Micro benchmarks time the functions every response tuple goes through ( prepare_dict, parse_clean_field_value,
+parse_fbdate and compare_keys_with_fields ). End to end benchmarks run save_update_delete per model on synthetic
+responses ( apps.fbschema.synthetic ) of 1k, 10k and 100k tuples, in three phases - the first sync inserting
+everything, a resync of the unchanged response and a resync where a tenth of the tuples changed. Responses are
+written to json lines files beforehand and decoded tuple by tuple while the sync runs, like streamed responses, so
+generating them isn't timed and doesn't take memory. Each run reports rows per second, queries and peak resident
+memory.
+
+Results are json, saved as baselines and compared against on every release, for each database backend -
+
+    {"meta": {"vendor": "sqlite", "django": "1.5", ...},
+     "results": [{"name": "sync.photo.10000.insert", "rows_per_second": 2500.0, "queries": 61, ...}, ...]}
+'''
+import datetime
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+import django
+from django.contrib.auth.models import User
+from django.db import connection, reset_queries
+
+from apps.fbschema.models import *
+from apps.fbschema.fql_engine import get_table_model
+from apps.fbschema.history_models import ChangeLog, ChangeSnapshot
+from apps.fbschema.history import HISTORY_ENABLED
+from apps.fbschema.jobs import JobRequest
+from apps.fbschema.metrics import registry
+from apps.fbschema.parse_utils import parse_clean_field_value, parse_fbdate
+from apps.fbschema.streaming import resident_memory
+from apps.fbschema.synthetic import SyntheticFacebook
+from apps.fbschema.utils import compare_keys_with_fields
+
+SIZES = (1000, 10000, 100000)
+SYNC_MODELS = ('album', 'photo', 'link', 'notification', 'stream')
+# Fraction of the tuples changed for the third phase
+CHURN = 0.1
+# Micro benchmarks repeat a function for at least this many seconds per measurement
+MICRO_MIN_TIME = 0.2
+MICRO_REPEAT = 3
+
+BENCHMARK_USERNAME = 'fbschema-benchmark'
+BENCHMARK_UID = 100000000000001
+
+
+def synthetic_counts(table, size):
+    '''
+    SyntheticFacebook arguments giving about size tuples of a table for the viewer
+    '''
+    if table == 'photo':
+        photos = min(size, 100)
+        return {'albums': max(1, size // photos), 'photos': photos}
+    return {{'album': 'albums', 'link': 'links', 'notification': 'notifications', 'stream': 'posts'}[table]: size}
+
+
+class MemorySampler(object):
+    '''
+    Samples the resident memory of the process in a thread, as ru_maxrss only tells the peak of the whole process
+    '''
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start = self.peak = resident_memory()
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, resident_memory())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, resident_memory())
+        return self.peak
+
+
+class SyncBenchmark(object):
+    '''
+    End to end benchmarks of save_update_delete, in the database of the default connection
+    '''
+    def __init__(self, sizes=SIZES, tables=SYNC_MODELS, bulk=True, directory=None, log=None, staging=False):
+        self.sizes = sizes
+        self.tables = tables
+        self.bulk = bulk
+        self.staging = staging
+        self.directory = directory
+        self.log = log or (lambda message: None)
+        self.user, created = User.objects.get_or_create(username=BENCHMARK_USERNAME)
+
+    def run(self):
+        directory = self.directory or tempfile.mkdtemp(prefix='fbschema-benchmark-')
+        try:
+            results = []
+            for table in self.tables:
+                for size in self.sizes:
+                    results.extend(self.run_model(table, size, directory))
+            return results
+        finally:
+            if not self.directory:
+                shutil.rmtree(directory, True)
+
+    def write_response(self, directory, table, size, revision=0):
+        facebook = SyntheticFacebook(me=BENCHMARK_UID, friends=20, revision=revision, churn=CHURN, **synthetic_counts(table, size))
+        path = os.path.join(directory, '%s-%d-%d.json' % (table, size, revision))
+        if not os.path.exists(path):
+            with open(path, 'w') as response:
+                for row in facebook.rows(table, BENCHMARK_UID):
+                    response.write(json.dumps(row) + '\n')
+        return path
+
+    def read_response(self, path):
+        with open(path) as response:
+            for line in response:
+                yield json.loads(line)
+
+    def reset(self):
+        for model in (FacebookPhoto, FacebookAlbum, FacebookLink, FacebookNotification, FacebookStream, FacebookUser):
+            model.objects.filter(user=self.user).delete()
+        ChangeLog.objects.filter(user=self.user).delete()
+        ChangeSnapshot.objects.filter(user=self.user).delete()
+        facebook = SyntheticFacebook(me=BENCHMARK_UID, friends=0)
+        FacebookUser.save_profiles(JobRequest(self.user), facebook.rows('user', BENCHMARK_UID))
+
+    def run_model(self, table, size, directory):
+        model = get_table_model(table)
+        self.reset()
+        if table == 'photo':
+            # the albums photos belong to, not timed
+            albums = self.write_response(directory, 'album', synthetic_counts('photo', size)['albums'])
+            FacebookAlbum.save_update_delete(JobRequest(self.user), self.read_response(albums), bulk=True)
+        results = []
+        for phase, revision in (('insert', 0), ('unchanged', 0), ('changed', 1)):
+            path = self.write_response(directory, table, size, revision)
+            result = self.measure(model, path, stream_nature=(model.owner_identifier == 'ONLY_SESSION_USER'))
+            result.update({'name': 'sync.%s.%d.%s' % (table, size, phase), 'kind': 'sync', 'table': table,
+                           'size': size, 'phase': phase})
+            self.log("%(name)s: %(rows_per_second).0f rows/s, %(queries)d queries, peak %(peak_memory_mb).1f MB (%(stats)s)" % result)
+            results.append(result)
+        return results
+
+    def measure(self, model, path, stream_nature):
+        request = JobRequest(self.user)
+        # a periodic flush of the metrics would land in the measurement otherwise
+        registry.flush()
+        debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        reset_queries()
+        sampler = MemorySampler()
+        started = time.time()
+        try:
+            stats = model.save_update_delete(request, self.read_response(path), stream_nature=stream_nature, bulk=self.bulk,
+                                             staging=self.staging)
+        finally:
+            seconds = time.time() - started
+            peak = sampler.stop()
+            queries = len(connection.queries)
+            connection.use_debug_cursor = debug_cursor
+            reset_queries()
+        rows = stats.added + stats.updated + stats.unchanged
+        return {
+            'rows': rows,
+            'seconds': seconds,
+            'rows_per_second': rows / seconds if seconds else 0,
+            'queries': queries,
+            'peak_memory_mb': peak / 1024.0 / 1024,
+            'memory_growth_mb': (peak - sampler.start) / 1024.0 / 1024,
+            'stats': str(stats),
+        }
+
+
+def time_calls(function, min_time=MICRO_MIN_TIME, repeat=MICRO_REPEAT):
+    '''
+    Seconds one call of function takes, the best of repeat measurements each calling it for at least min_time
+    '''
+    def measure(number):
+        started = time.time()
+        for i in xrange(number):
+            function()
+        return time.time() - started
+
+    number = 1
+    elapsed = measure(number)
+    while elapsed < min_time:
+        number *= 10 if elapsed < min_time / 10 else 2
+        elapsed = measure(number)
+    return min([elapsed] + [measure(number) for i in range(repeat - 1)]) / number
+
+
+def micro_benchmarks(log=None):
+    '''
+    Times the per tuple functions on a synthetic photo, the widest table
+    '''
+    log = log or (lambda message: None)
+    user, created = User.objects.get_or_create(username=BENCHMARK_USERNAME)
+    request = JobRequest(user)
+    facebook = SyntheticFacebook(me=BENCHMARK_UID, friends=0, albums=1, photos=1, missing=0)
+    if not FacebookUser.objects.filter(user=user, uid=BENCHMARK_UID).exists():
+        FacebookUser.save_profiles(request, facebook.rows('user', BENCHMARK_UID))
+    row = facebook.rows('photo', BENCHMARK_UID).next()
+    fields = [(field, row[field.name]) for field in FacebookPhoto._meta.fields if field.name in row]
+    keys = row.keys()
+
+    def parse_fields():
+        for field, value in fields:
+            parse_clean_field_value(field, value, request)
+
+    cases = [
+        ('micro.prepare_dict.photo', 1, lambda: FacebookPhoto.prepare_dict(row, request)),
+        ('micro.parse_clean_field_value.photo', len(fields), parse_fields),
+        ('micro.parse_fbdate.timestamp', 1, lambda: parse_fbdate(1383264000)),
+        ('micro.parse_fbdate.date', 1, lambda: parse_fbdate('August 12, 1985')),
+        ('micro.parse_fbdate.date_without_year', 1, lambda: parse_fbdate('August 12')),
+        ('micro.compare_keys_with_fields.photo', 1, lambda: compare_keys_with_fields(FacebookPhoto, keys)),
+    ]
+    results = []
+    for name, calls, function in cases:
+        seconds = time_calls(function) / calls
+        result = {'name': name, 'kind': 'micro', 'microseconds_per_call': seconds * 1e6,
+                  'calls_per_second': 1 / seconds if seconds else 0}
+        log("%(name)s: %(microseconds_per_call).2f us/call" % result)
+        results.append(result)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                cwd=os.path.dirname(__file__)).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(sizes=SIZES, tables=SYNC_MODELS, micro=True, sync=True, bulk=True, log=None, staging=False):
+    '''
+    Runs the benchmarks and returns the baseline document
+    '''
+    results = []
+    if micro:
+        results.extend(micro_benchmarks(log))
+    if sync:
+        results.extend(SyncBenchmark(sizes, tables, bulk, log=log, staging=staging).run())
+    meta = {
+        'vendor': connection.vendor,
+        'django': django.get_version(),
+        'python': platform.python_version(),
+        'host': socket.gethostname(),
+        'revision': git_revision(),
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'bulk': bulk,
+        'staging': staging,
+        'chunk_size': BULK_CHUNK_SIZE,
+        'history': HISTORY_ENABLED,
+    }
+    return {'meta': meta, 'results': results}
+
+
+def save_baseline(document, path):
+    with open(path, 'w') as baseline:
+        json.dump(document, baseline, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path) as baseline:
+        return json.load(baseline)
+
+
+'''
+Metrics compared with a baseline, and whether larger values are better
+'''
+COMPARED_METRICS = (
+    ('rows_per_second', True),
+    ('calls_per_second', True),
+    ('queries', False),
+    ('memory_growth_mb', False),
+)
+# Memory growth below this many MB is noise
+MEMORY_SLACK_MB = 5
+
+
+def compare(document, baseline, tolerance=0.2):
+    '''
+    Compares results with a baseline of the same database backend, returns (name, metric, baseline value, value,
+    regressed) for every metric of every benchmark found in both
+    '''
+    if document['meta'].get('vendor') != baseline['meta'].get('vendor'):
+        raise ValueError("Baseline is of %s, results of %s" % (baseline['meta'].get('vendor'), document['meta'].get('vendor')))
+    baseline_results = dict([(result['name'], result) for result in baseline['results']])
+    comparison = []
+    for result in document['results']:
+        previous = baseline_results.get(result['name'])
+        if previous is None:
+            continue
+        for metric, larger_is_better in COMPARED_METRICS:
+            if metric not in result or metric not in previous:
+                continue
+            value, previous_value = result[metric], previous[metric]
+            if larger_is_better:
+                regressed = value < previous_value * (1 - tolerance)
+            elif metric == 'memory_growth_mb':
+                regressed = value > previous_value * (1 + tolerance) + MEMORY_SLACK_MB
+            else:
+                regressed = value > previous_value * (1 + tolerance)
+            comparison.append((result['name'], metric, previous_value, value, regressed))
+    return comparison
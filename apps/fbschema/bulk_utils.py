@@ -0,0 +1,85 @@
+'''
+Bulk write helpers, they let save_update_delete write a whole response in a handful of statements
+instead of one or two round trips per data tuple
+'''
+from django.conf import settings
+from django.db import connections, router
+
+BULK_CHUNK_SIZE = getattr(settings, 'FBSCHEMA_BULK_CHUNK_SIZE', 500)
+
+# SQLITE_LIMIT_VARIABLE_NUMBER, sqlite refuses statements having more parameters than this
+SQLITE_MAX_PARAMS = 999
+
+
+def chunked(items, chunk_size):
+    '''
+    Yields lists of at most chunk_size items from given iterable
+    '''
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iterate_in_pages(queryset, chunk_size=BULK_CHUNK_SIZE):
+    '''
+    Yields the rows of a values() queryset, which must include 'id', fetching chunk_size rows at a time in id order.
+    queryset.iterator() doesn't bound memory, sqlite and MySQLdb's default cursor fetch the whole result set at once
+    '''
+    last_id = 0
+    while True:
+        page = list(queryset.filter(id__gt=last_id).order_by('id')[:chunk_size])
+        if not page:
+            return
+        for row in page:
+            yield row
+        last_id = page[-1]['id']
+
+
+def update_batch_size(connection, fields, chunk_size):
+    '''
+    Returns how many rows a single bulk_update statement can carry. Every row costs two parameters per
+    updated column plus one for the WHERE ... IN list
+    '''
+    if connection.vendor == 'sqlite':
+        return max(min(chunk_size, SQLITE_MAX_PARAMS // (2 * len(fields) + 1)), 1)
+    return chunk_size
+
+
+def bulk_update(model, objs, fields, chunk_size=BULK_CHUNK_SIZE, using=None):
+    '''
+    Writes given fields of already saved model instances using multi-row statements of the form
+        UPDATE table SET col = CASE pk WHEN %s THEN %s ... END, ... WHERE pk IN (...)
+    Transaction handling is left to the caller so that a chunk can be written as a single unit
+    '''
+    if not objs:
+        return
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    pk_column = qn(model._meta.pk.column)
+
+    for batch in chunked(objs, update_batch_size(connection, fields, chunk_size)):
+        assignments = []
+        params = []
+        for field in fields:
+            if connection.vendor == 'postgresql':
+                # Untyped parameters inside CASE are resolved as text by postgres
+                value_sql = 'CAST(%%s AS %s)' % field.db_type(connection)
+            else:
+                value_sql = '%s'
+            cases = []
+            for obj in batch:
+                cases.append('WHEN %%s THEN %s' % value_sql)
+                params.append(obj.pk)
+                params.append(field.get_db_prep_save(field.pre_save(obj, False), connection=connection))
+            assignments.append('%s = CASE %s %s END' % (qn(field.column), pk_column, ' '.join(cases)))
+
+        params.extend([obj.pk for obj in batch])
+        sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (qn(model._meta.db_table), ', '.join(assignments),
+                pk_column, ', '.join(['%s'] * len(batch)))
+        connection.cursor().execute(sql, params)
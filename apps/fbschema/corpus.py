@@ -0,0 +1,186 @@
+'''
+Term frequencies of the text columns ( search_fields ) of the fql tables. Texts are streamed out of a table a page
+at a time, texts seen before get their term counts from the TermCounts cache, keyed by the sha1 of the text, and the
+others are tokenized and counted in a pool of settings.FBSCHEMA_CORPUS_PROCESSES processes while the next page is
+read. Counters of the pages are merged as they come back, so a run holds one page and the vocabulary in memory,
+and a re-run only tokenizes texts which changed.
+
+Usage -
+    pipeline = CorpusPipeline()
+    pipeline.top_terms(request.user, 'stream', 50, since=datetime.datetime(2013, 1, 1))
+    pipeline.top_terms(request.user, 'photo', 20, owner=uid)
+    pipeline.stats
+'''
+import hashlib
+import json
+import logging
+import multiprocessing
+from collections import Counter
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from apps.fbschema.bulk_utils import BULK_CHUNK_SIZE, chunked, iterate_in_pages
+from apps.fbschema.corpus_models import TermCounts
+from apps.fbschema.fql_engine import get_table_model
+from apps.fbschema.models import FacebookUser, FacebookUserProfile
+from apps.fbschema.search import document_body, tokenize
+
+logger = logging.getLogger(__name__)
+
+# None for one process per cpu, 0 or 1 counts in the calling process
+CORPUS_PROCESSES = getattr(settings, 'FBSCHEMA_CORPUS_PROCESSES', None)
+
+'''
+Columns of the time window and of the owner ( a facebook id ) of the tables, fql table => field lookup
+'''
+TIME_FIELDS = {
+    'stream': 'created_time',
+    'photo': 'created',
+    'link': 'created_time',
+    'notification': 'created_time',
+}
+OWNER_FIELDS = {
+    'stream': 'actor_id',
+    'photo': 'owner__uid',
+    'link': 'owner__uid',
+    'notification': 'sender_id',
+    'user': 'uid',
+}
+
+STOP_WORDS = frozenset("""a about after all also am an and any are as at be because been but by can could did do does
+for from had has have he her him his how i if in into is it its just like me more my no not now of on one or our out
+she so some than that the their them then there they this to too up us was we were what when which who will with would
+you your""".split())
+
+
+def count_terms(texts):
+    '''
+    Term counts of each text, run by the pool processes
+    '''
+    return [dict(Counter(tokenize(text))) for text in texts]
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def corpus_queryset(user, table, owner=None, since=None, until=None):
+    '''
+    values() queryset of the texts of a table of a system user. The user table reads the shared profiles of the
+    users in the social graph
+    '''
+    if table == FacebookUser.fqlname:
+        model = FacebookUserProfile
+        queryset = model.objects.filter(viewers__user=user)
+    else:
+        model = get_table_model(table)
+        queryset = model.objects.filter(user=user)
+    if not getattr(model, 'search_fields', None):
+        raise ValueError("%s has no text columns" % table)
+    if owner is not None:
+        queryset = queryset.filter(**{OWNER_FIELDS[table]: owner})
+    if since is not None or until is not None:
+        if table not in TIME_FIELDS:
+            raise ValueError("%s has no time column" % table)
+        if since is not None:
+            queryset = queryset.filter(**{"%s__gte" % TIME_FIELDS[table]: since})
+        if until is not None:
+            queryset = queryset.filter(**{"%s__lt" % TIME_FIELDS[table]: until})
+    return model, queryset.values('id', *model.search_fields)
+
+
+class CorpusPipeline(object):
+    '''
+    Counts terms of tables with a process pool and the TermCounts cache. stats of the last run tell how many texts
+    were read, found in the cache and counted
+    '''
+    def __init__(self, processes=CORPUS_PROCESSES, chunk_size=BULK_CHUNK_SIZE, stop_words=STOP_WORDS):
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.stop_words = stop_words
+        self.stats = {}
+
+    def texts(self, user, table, owner=None, since=None, until=None):
+        model, queryset = corpus_queryset(user, table, owner, since, until)
+        for values in iterate_in_pages(queryset, self.chunk_size):
+            text = document_body(model, values)
+            if text:
+                yield text
+
+    def cached_counts(self, hashes):
+        return dict([(cached_hash, json.loads(counts)) for cached_hash, counts in
+                     TermCounts.objects.filter(text_hash__in=list(hashes)).values_list('text_hash', 'counts')])
+
+    def cache(self, counted):
+        '''
+        Stores the counts of newly counted texts, text hash => counts. Another run may have stored some meanwhile
+        '''
+        entries = [TermCounts(text_hash=counted_hash, counts=json.dumps(counts)) for counted_hash, counts in counted.items()]
+        try:
+            with transaction.commit_on_success():
+                TermCounts.objects.bulk_create(entries)
+        except IntegrityError:
+            stored = set(TermCounts.objects.filter(text_hash__in=counted.keys()).values_list('text_hash', flat=True))
+            with transaction.commit_on_success():
+                TermCounts.objects.bulk_create([entry for entry in entries if entry.text_hash not in stored])
+
+    def merge(self, total, counts):
+        for term, count in counts.items():
+            if term not in self.stop_words:
+                total[term] += count
+
+    def count(self, texts):
+        '''
+        Merged term counts of texts, a Counter
+        '''
+        self.stats = {'texts': 0, 'cached': 0, 'counted': 0}
+        total = Counter()
+        pool = self.processes not in (0, 1) and multiprocessing.Pool(self.processes) or None
+        pending = []
+        try:
+            for chunk in chunked(texts, self.chunk_size):
+                hashes = [text_hash(text) for text in chunk]
+                cached = self.cached_counts(set(hashes))
+                missing = {}
+                for hashed, text in zip(hashes, chunk):
+                    if hashed in cached:
+                        self.merge(total, cached[hashed])
+                    else:
+                        missing[hashed] = text
+                self.stats['texts'] += len(chunk)
+                self.stats['cached'] += len(chunk) - len(missing)
+                if missing:
+                    # identical texts of the chunk are counted once
+                    missing_hashes = [hashed for hashed in hashes if hashed in missing]
+                    texts_hashes = missing.keys()
+                    if pool:
+                        pending.append((missing_hashes, texts_hashes, pool.apply_async(count_terms, ([missing[hashed] for hashed in texts_hashes],))))
+                    else:
+                        pending.append((missing_hashes, texts_hashes, count_terms([missing[hashed] for hashed in texts_hashes])))
+                # the pool counts a couple of chunks ahead of the merging
+                while len(pending) > max(self.processes or multiprocessing.cpu_count(), 1) * 2:
+                    self.collect(total, pending.pop(0))
+            while pending:
+                self.collect(total, pending.pop(0))
+        finally:
+            if pool:
+                pool.terminate()
+        return total
+
+    def collect(self, total, pending):
+        missing_hashes, texts_hashes, result = pending
+        counts = dict(zip(texts_hashes, hasattr(result, 'get') and result.get() or result))
+        for hashed in missing_hashes:
+            self.merge(total, counts[hashed])
+        self.stats['counted'] += len(texts_hashes)
+        self.cache(counts)
+
+    def top_terms(self, user, table, n=20, owner=None, since=None, until=None):
+        '''
+        The n most frequent terms of the texts of a table of a system user, of one owner ( facebook id ) and time
+        window [since, until) if given, [(term, count)]
+        '''
+        total = self.count(self.texts(user, table, owner, since, until))
+        logger.info("%s terms of %s: %s" % (table, user, self.stats))
+        return total.most_common(n)
@@ -0,0 +1,21 @@
+import json
+
+from django.db import models
+
+'''
+Cache of the corpus pipeline, see apps.fbschema.corpus
+'''
+
+class TermCounts(models.Model):
+    '''
+    Term counts of a text, keyed by the sha1 of the text so that a text is tokenized once however many tuples,
+    tables or runs it turns up in
+    '''
+    text_hash           = models.CharField( max_length=40, unique=True, help_text="sha1 of the utf-8 text" )
+    counts              = models.TextField( help_text="json, term => occurrences" )
+
+    def get_counts(self):
+        return json.loads(self.counts)
+
+    def __unicode__(self):
+        return self.text_hash
@@ -0,0 +1,24 @@
+from django.db import models
+from django.contrib.auth.models import User
+
+'''
+Id lists of the fql tables as edges, see apps.fbschema.edges
+'''
+
+class IdEdge(models.Model):
+    '''
+    One id listed in an id list column of a tuple, e.g. a uid in tagged_ids of a post. The tuple is referred to by its
+    primary_identifier value like ChangeLog does, edges of the tuples a sync adds or changes are written in the same sync
+    '''
+    user                = models.ForeignKey(User, help_text="System user the tuple belongs to")
+    table               = models.CharField( max_length=100, help_text="fqlname of the model" )
+    field               = models.CharField( max_length=100, help_text="Name of the id list column, one of edge_fields of the model" )
+    key                 = models.CharField( max_length=255, help_text="primary_identifier value of the tuple" )
+    target              = models.BigIntegerField( help_text="The listed id" )
+
+    def __unicode__(self):
+        return "%s %s.%s -> %s" % (self.table, self.key, self.field, self.target)
+
+    class Meta:
+        ordering = ('id',)
+        index_together = (("user", "table", "target"), ("user", "table", "key"))
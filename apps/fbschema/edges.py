@@ -0,0 +1,104 @@
+'''
+Id list columns of the fql tables ( edge_fields of a model, e.g. tagged_ids and with_tags of stream ) are stored as
+json and, one IdEdge tuple per listed id, in an indexed edge table. Edges follow the syncs through the rows_changed
+signal, edges of added and changed tuples are rewritten and those of deleted tuples dropped, so "all posts tagging
+uid X" is an index lookup rather than a scan of every post's json.
+
+Usage -
+    listing(request.user, FacebookStream, uid)
+    listing(request.user, FacebookStream, uid, fields=['with_tags']).filter(created_time__gte=since)
+'''
+import logging
+
+from apps.fbschema.edge_models import IdEdge
+from apps.fbschema.signals import rows_changed
+from apps.fbschema.bulk_utils import BULK_CHUNK_SIZE, chunked, iterate_in_pages
+
+logger = logging.getLogger(__name__)
+
+
+def edge_targets(value):
+    '''
+    Ids listed in the value of an id list column. Fql gives plain id arrays, objects with an id ( and arrays keyed
+    by offset ) are taken too, anything else lists nothing
+    '''
+    if isinstance(value, dict):
+        value = value.values()
+    if not isinstance(value, (list, tuple)):
+        return set()
+    targets = set()
+    for item in value:
+        if isinstance(item, dict):
+            item = item.get('id')
+        try:
+            targets.add(int(item))
+        except (TypeError, ValueError):
+            pass
+    return targets
+
+
+def make_edges(model, user, data_dicts):
+    edges = []
+    for data_dict in data_dicts:
+        key = unicode(data_dict[model.primary_identifier])
+        for field in model.edge_fields:
+            for target in edge_targets(data_dict.get(field)):
+                edges.append(IdEdge(user=user, table=model.fqlname, field=field, key=key, target=target))
+    return edges
+
+
+def write_edges(model, user, stale_keys, data_dicts):
+    '''
+    Drops the edges of stale_keys and adds the edges of data_dicts
+    '''
+    for chunk in chunked([unicode(key) for key in stale_keys], BULK_CHUNK_SIZE):
+        IdEdge.objects.filter(user=user, table=model.fqlname, key__in=chunk).delete()
+    for chunk in chunked(make_edges(model, user, data_dicts), BULK_CHUNK_SIZE):
+        IdEdge.objects.bulk_create(chunk)
+
+
+def update_edges(sender, request, added, updated, deleted, **kwargs):
+    '''
+    rows_changed receiver, keeps the edges of a save_update_delete call's tuples
+    '''
+    if not getattr(sender, 'edge_fields', None):
+        return
+    primary_identifier = sender.primary_identifier
+    # added tuples may have had edges already when they were recovered by handle_integrity_exception
+    fresh = list(added)
+    for old_values, data_dict in updated:
+        if [field for field in sender.edge_fields if edge_targets(old_values[field]) != edge_targets(data_dict[field])]:
+            fresh.append(data_dict)
+    stale_keys = [data_dict[primary_identifier] for data_dict in fresh] + [old_values[primary_identifier] for old_values in deleted]
+    write_edges(sender, request.user, stale_keys, fresh)
+
+
+def rebuild_edges(model, user):
+    '''
+    Writes the edges of all stored tuples of model of a system user again, returns their number
+    '''
+    IdEdge.objects.filter(user=user, table=model.fqlname).delete()
+    queryset = model.objects.filter(user=user).values('id', model.primary_identifier, *model.edge_fields)
+    count = 0
+    for page in chunked(iterate_in_pages(queryset), BULK_CHUNK_SIZE):
+        for data_dict in page:
+            for field in model.edge_fields:
+                data_dict[field] = model._meta.get_field(field).to_python(data_dict[field])
+        edges = make_edges(model, user, page)
+        IdEdge.objects.bulk_create(edges)
+        count += len(edges)
+    return count
+
+
+def listing(user, model, target, fields=None):
+    '''
+    Tuples of model of a system user whose id list columns ( all edge_fields, or given ones ) list target
+    '''
+    edges = IdEdge.objects.filter(user=user, table=model.fqlname, target=target)
+    if fields:
+        edges = edges.filter(field__in=fields)
+    kwargs = { "%s__in" % model.primary_identifier : edges.values('key') }
+    return model.objects.filter(user=user, **kwargs)
+
+
+rows_changed.connect(update_edges, dispatch_uid='fbschema_edges')
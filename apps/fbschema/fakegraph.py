@@ -0,0 +1,253 @@
+'''
+Offline stand-ins for the open_facebook graph, so syncs can run, be load tested and benchmarked without a facebook
+session -
+
+    RecordingGraph  wraps a real graph and writes every fql response it receives into a fixture directory
+    ReplayGraph     answers fql and batch_fql from such a directory
+    SyntheticGraph  answers them from apps.fbschema.synthetic data at any scale
+
+Fake graphs inject latency and failures the way facebook does - a delay per request and per returned tuple,
+timeouts ( FacebookUnreachable ) at a given rate and "reduce the amount of data" errors for responses above
+max_rows, which is what apps.fbschema.fetch adapts batch sizes to.
+
+With settings.FBSCHEMA_FAKE_GRAPH jobs get a fake graph instead of the user's, see apps.fbschema.jobs.get_graph.
+`python manage.py fbschema_fakegraph` serves one over http, shaped like https://graph.facebook.com/fql, for runs
+that should go through open_facebook's http client as well ( settings.FBSCHEMA_GRAPH_API_URL ).
+'''
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import urlparse
+
+from django.core.exceptions import ObjectDoesNotExist
+from open_facebook import exceptions as open_facebook_exceptions
+
+from apps.fbschema.fql_engine import FqlError, normalize
+from apps.fbschema.synthetic import SyntheticFacebook
+
+logger = logging.getLogger(__name__)
+
+REDUCE_DATA_MESSAGE = "Please reduce the amount of data you're asking for, then retry your request"
+
+
+class FixtureMissing(open_facebook_exceptions.OpenFacebookException):
+    '''
+    Raised by ReplayGraph for queries which were never recorded
+    '''
+    pass
+
+
+def fixture_path(directory, query):
+    '''
+    File the response of a query is recorded in, queries differing only in whitespace or keyword case share it
+    '''
+    try:
+        text = normalize(query)
+    except FqlError:
+        text = u' '.join(query.split())
+    return os.path.join(directory, '%s.json' % hashlib.sha1(text.encode('utf-8')).hexdigest())
+
+
+def batch_result(results, name):
+    # names come back as strings from facebook, whatever they were sent as
+    if name in results:
+        return results[name]
+    return results[unicode(name)]
+
+
+class RecordingGraph(object):
+    '''
+    Passes fql and batch_fql through to graph and records each response, the queries of a batch are recorded one by
+    one so that they replay whatever batches they are sent in. Tasks streaming responses fall back to graph.fql for
+    graphs without an access_token ( see apps.fbschema.streaming ), so everything they read gets recorded
+    '''
+    def __init__(self, graph, directory):
+        self.graph = graph
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def record(self, query, data):
+        path = fixture_path(self.directory, query)
+        # Written aside and renamed, batches are recorded from several fetch threads at once
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as fixture:
+            json.dump({'query': query, 'recorded': int(time.time()), 'data': data}, fixture)
+        os.rename(temporary, path)
+
+    def fql(self, query, **kwargs):
+        data = self.graph.fql(query, **kwargs)
+        self.record(query, data)
+        return data
+
+    def batch_fql(self, queries_dict):
+        results = self.graph.batch_fql(queries_dict)
+        for name, query in queries_dict.items():
+            self.record(query, batch_result(results, name))
+        return results
+
+
+class FakeGraph(object):
+    '''
+    Base of the fake graphs, subclasses implement answer(query). latency is the mean delay of a request in seconds
+    and row_latency the delay per returned tuple, timeout_rate the fraction of requests failing with
+    FacebookUnreachable and max_rows the size above which a response fails like an oversized one on facebook
+    '''
+    def __init__(self, latency=0, row_latency=0, timeout_rate=0, max_rows=None, seed=None):
+        self.latency = latency
+        self.row_latency = row_latency
+        self.timeout_rate = timeout_rate
+        self.max_rows = max_rows
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def answer(self, query):
+        raise NotImplementedError
+
+    def delay(self, rows):
+        seconds = self.latency * self.random.uniform(0.5, 1.5) + self.row_latency * rows
+        if seconds:
+            time.sleep(seconds)
+
+    def request(self, queries):
+        '''
+        Answers a list of queries as one request, injecting latency and failures
+        '''
+        with self.lock:
+            self.requests += 1
+        if self.timeout_rate and self.random.random() < self.timeout_rate:
+            self.delay(0)
+            raise open_facebook_exceptions.FacebookUnreachable("Fake graph timed out")
+        try:
+            results = [self.answer(query) for query in queries]
+        except FqlError, e:
+            raise open_facebook_exceptions.OpenFacebookException("(#601) %s" % e)
+        rows = sum([len(result) for result in results])
+        if self.max_rows is not None and rows > self.max_rows:
+            self.delay(self.max_rows)
+            raise open_facebook_exceptions.UnknownException(REDUCE_DATA_MESSAGE)
+        self.delay(rows)
+        return results
+
+    def fql(self, query, **kwargs):
+        return self.request([query])[0]
+
+    def batch_fql(self, queries_dict):
+        names = queries_dict.keys()
+        results = self.request([queries_dict[name] for name in names])
+        return dict([(unicode(name), result) for name, result in zip(names, results)])
+
+
+class ReplayGraph(FakeGraph):
+    '''
+    Answers queries from the fixtures of a RecordingGraph
+    '''
+    def __init__(self, directory, **kwargs):
+        super(ReplayGraph, self).__init__(**kwargs)
+        self.directory = directory
+
+    def answer(self, query):
+        path = fixture_path(self.directory, query)
+        if not os.path.exists(path):
+            raise FixtureMissing("No fixture recorded in %s for %s" % (self.directory, query))
+        with open(path) as fixture:
+            return json.load(fixture)['data']
+
+
+class SyntheticGraph(FakeGraph):
+    '''
+    Answers queries from synthetic data, keyword arguments not known to FakeGraph go to SyntheticFacebook
+    '''
+    def __init__(self, latency=0, row_latency=0, timeout_rate=0, max_rows=None, seed=None, **kwargs):
+        super(SyntheticGraph, self).__init__(latency, row_latency, timeout_rate, max_rows, seed)
+        if seed is not None:
+            kwargs['seed'] = seed
+        self.facebook = SyntheticFacebook(**kwargs)
+
+    def answer(self, query):
+        return self.facebook.fql(query)
+
+
+def make_fake_graph(options, user=None):
+    '''
+    Fake graph described by a dict like settings.FBSCHEMA_FAKE_GRAPH, {'fixtures': directory, ...} replays recorded
+    responses, anything else is synthetic. Synthetic viewers are the facebook id of given user when known
+    '''
+    options = dict(options)
+    fixtures = options.pop('fixtures', None)
+    if fixtures:
+        return ReplayGraph(fixtures, **options)
+    if user is not None and 'me' not in options:
+        try:
+            facebook_id = user.get_profile().facebook_id
+        except ObjectDoesNotExist:
+            facebook_id = None
+        if facebook_id:
+            options['me'] = facebook_id
+    return SyntheticGraph(**options)
+
+
+class FakeGraphRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Answers GET and POST <anything>/fql?q=... like facebook, q being a query or a json object of named queries
+    '''
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        self.respond(url.path, urlparse.parse_qs(url.query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        parameters = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        parameters.update(urlparse.parse_qs(self.rfile.read(length)))
+        self.respond(urlparse.urlparse(self.path).path, parameters)
+
+    def respond(self, path, parameters):
+        if not path.rstrip('/').endswith('fql'):
+            return self.send_json(404, {'error': {'message': "Unknown path %s" % path, 'type': 'GraphMethodException', 'code': 100}})
+        q = parameters.get('q', [''])[0]
+        if not q:
+            return self.send_json(400, {'error': {'message': "(#601) A query is required", 'type': 'OAuthException', 'code': 601}})
+        graph = self.server.graph
+        try:
+            if q.lstrip().startswith('{'):
+                results = graph.batch_fql(json.loads(q))
+                data = [{'name': name, 'fql_result_set': result} for name, result in sorted(results.items())]
+            else:
+                data = graph.fql(q)
+        except open_facebook_exceptions.FacebookUnreachable, e:
+            return self.send_json(500, {'error': {'message': unicode(e), 'type': 'OAuthException', 'code': 2}})
+        except open_facebook_exceptions.UnknownException, e:
+            return self.send_json(500, {'error': {'message': unicode(e), 'type': 'OAuthException', 'code': 1}})
+        except (open_facebook_exceptions.OpenFacebookException, ValueError), e:
+            return self.send_json(400, {'error': {'message': unicode(e), 'type': 'OAuthException', 'code': 601}})
+        self.send_json(200, {'data': data})
+
+    def send_json(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.info("%s %s" % (self.address_string(), format % args))
+
+
+class FakeGraphServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    Serves a fake graph over http, requests are answered in threads so latency of one doesn't hold up the others
+    '''
+    daemon_threads = True
+
+    def __init__(self, graph, address=('127.0.0.1', 8001)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeGraphRequestHandler)
+        self.graph = graph
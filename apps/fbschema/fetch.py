@@ -0,0 +1,141 @@
+'''
+Concurrent batch_fql dispatch. Waiting on facebook is most of the time a friend batch task takes, so several
+batch_fql requests are kept in flight by a bounded thread pool while results are stored as they arrive. The batch
+size follows observed latency, it grows while requests come back quickly and shrinks on slow responses and
+timeouts ( facebook times out on batches which are too large ).
+
+Only network calls run in pool threads, responses are handed back to the calling thread, so all database writes
+stay in the thread of the task.
+'''
+import logging
+import Queue
+import socket
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from open_facebook import exceptions as open_facebook_exceptions
+
+logger = logging.getLogger(__name__)
+
+FETCH_CONCURRENCY = getattr(settings, 'FBSCHEMA_FETCH_CONCURRENCY', 4)
+# Seconds a batch_fql request may take before batches start to shrink
+FETCH_TARGET_LATENCY = getattr(settings, 'FBSCHEMA_FETCH_TARGET_LATENCY', 10)
+# Timeouts a single query may hit at the minimum batch size before the fetch gives up
+FETCH_RETRIES = getattr(settings, 'FBSCHEMA_FETCH_RETRIES', 3)
+
+
+def is_timeout(exception):
+    '''
+    Whether a batch_fql failure means that the batch was too slow or too large, rather than a bad query
+    '''
+    if isinstance(exception, (open_facebook_exceptions.FacebookUnreachable, socket.timeout)):
+        return True
+    if isinstance(exception, open_facebook_exceptions.UnknownException):
+        return 'reduce the amount of data' in unicode(exception)
+    return False
+
+
+class AdaptiveBatchSize(object):
+    '''
+    Additive increase, multiplicative decrease of the batch size
+    '''
+    def __init__(self, initial, minimum=1, maximum=None, target_latency=FETCH_TARGET_LATENCY):
+        self.minimum = minimum
+        self.maximum = maximum or initial * 4
+        self.target_latency = target_latency
+        self.current = max(min(initial, self.maximum), minimum)
+
+    def success(self, size, latency):
+        if latency > self.target_latency:
+            self.current = max(self.minimum, min(self.current, int(size * 0.75)))
+        elif size >= self.current:
+            # Only a full sized batch tells that the current size is fine
+            self.current = min(self.maximum, self.current + max(1, self.current // 4))
+
+    def timeout(self, size):
+        self.current = max(self.minimum, min(self.current, size // 2))
+
+    def __int__(self):
+        return self.current
+
+
+class BatchFetcher(object):
+    '''
+    Usage -
+        fetcher = BatchFetcher(graph, initial_batch_size=100)
+        fetcher.fetch(friends, query_for_friend, handle_batch, progress)
+
+    query_for_friend(item) returns the fql query of an item, handle_batch(items, response_dataset) stores the
+    batch_fql response of a batch and progress(items), if given, is called with the items completing the longest
+    handled prefix of the item list, so that a checkpoint can be moved past them.
+
+    An item whose query alone still times out after retries attempts is passed to skip(item, error), if given,
+    and counts as handled, so one friend whose data facebook can't return doesn't hold up the rest. Without skip
+    the error is raised.
+    '''
+    def __init__(self, graph, initial_batch_size, maximum_batch_size=None, concurrency=FETCH_CONCURRENCY, retries=FETCH_RETRIES):
+        self.graph = graph
+        self.batch_size = AdaptiveBatchSize(initial_batch_size, maximum=maximum_batch_size)
+        self.concurrency = concurrency
+        self.retries = retries
+
+    def _request(self, batch_id, query_dict):
+        started = time.time()
+        try:
+            return batch_id, self.graph.batch_fql(query_dict), None, time.time() - started
+        except Exception, e:
+            return batch_id, None, e, time.time() - started
+
+    def fetch(self, items, query_for_item, handle_batch, progress=None, skip=None):
+        items = list(items)
+        pending = range(len(items))     # indexes waiting to be dispatched, in order
+        in_flight = {}                  # batch id -> indexes
+        timeouts = {}                   # index -> timeouts hit at minimum batch size
+        handled = [False] * len(items)
+        prefix = 0
+        results = Queue.Queue()
+        pool = ThreadPool(self.concurrency)
+        batch_id = 0
+        try:
+            while pending or in_flight:
+                while pending and len(in_flight) < self.concurrency:
+                    indexes, pending = pending[:int(self.batch_size)], pending[int(self.batch_size):]
+                    query_dict = dict([(items[index].id, query_for_item(items[index])) for index in indexes])
+                    batch_id += 1
+                    in_flight[batch_id] = indexes
+                    pool.apply_async(self._request, (batch_id, query_dict), callback=results.put)
+
+                done_id, response_dataset, error, latency = results.get()
+                indexes = in_flight.pop(done_id)
+                if error is not None:
+                    if not is_timeout(error):
+                        raise error
+                    logger.info("batch_fql of %d queries failed after %.1fs (%s), retrying smaller batches" % (len(indexes), latency, error))
+                    self.batch_size.timeout(len(indexes))
+                    retry = []
+                    for index in indexes:
+                        if len(indexes) <= self.batch_size.minimum:
+                            timeouts[index] = timeouts.get(index, 0) + 1
+                            if timeouts[index] > self.retries:
+                                if skip is None:
+                                    raise error
+                                logger.warning("Skipping %s, its query failed %d times (%s)" % (items[index], timeouts[index], error))
+                                skip(items[index], error)
+                                handled[index] = True
+                                continue
+                        retry.append(index)
+                    pending = retry + pending
+                else:
+                    self.batch_size.success(len(indexes), latency)
+                    handle_batch([items[index] for index in indexes], response_dataset)
+                    for index in indexes:
+                        handled[index] = True
+                start = prefix
+                while prefix < len(items) and handled[prefix]:
+                    prefix += 1
+                if progress and prefix > start:
+                    progress(items[start:prefix])
+        finally:
+            pool.terminate()
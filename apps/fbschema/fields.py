@@ -0,0 +1,36 @@
+'''
+Model fields for fql data types which have no column type of their own
+'''
+import json
+
+from django.db import models
+
+
+class JSONField(models.TextField):
+    '''
+    Arrays and objects of fql ( images, tagged_ids, education... ) stored as json text and given back as lists and
+    dicts. Text which isn't json, i.e. values stored before the column held json, is given back as it is, see the
+    fbschema_json_fields command
+    '''
+    __metaclass__ = models.SubfieldBase
+
+    def to_python(self, value):
+        if isinstance(value, basestring):
+            try:
+                return json.loads(value)
+            except ValueError:
+                return value
+        return value
+
+    def get_prep_value(self, value):
+        if value is None:
+            return None
+        # sorted keys, equal values are equal text
+        return json.dumps(value, sort_keys=True)
+
+    def value_from_object(self, obj):
+        # forms ( the admin ) edit the json text
+        return self.get_prep_value(getattr(obj, self.attname))
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
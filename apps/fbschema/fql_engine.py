@@ -0,0 +1,546 @@
+'''
+Local fql engine, answers fql queries from the locally stored fbschema tables instead of the facebook api.
+
+    SELECT name, like_info FROM album WHERE owner IN (SELECT uid2 FROM friend WHERE uid1=me()) ORDER BY modified DESC LIMIT 10
+
+A query is parsed into a small syntax tree and compiled against the model whose fqlname matches the table, into
+a Django queryset returning rows shaped like facebook's ( foreign keys as uid/aid, structs as dicts, times as unix
+timestamps ). Subqueries become SQL subqueries, so the whole query runs as one statement. Compiled plans don't
+depend on the viewer, me() is bound when a plan is executed, and are cached keyed by the normalized query text.
+
+Supported - SELECT <columns> FROM <table> [WHERE <condition>] [ORDER BY <column> [ASC|DESC], ...] [LIMIT [<offset>,] <n>]
+where conditions combine =, !=, <>, <, <=, >, >=, IN (<values>), IN (<subquery>), NOT IN, strpos(<column>, <string>)
+and strpos(lower(<column>), <string>) comparisons with AND, OR, NOT and parentheses, values being numbers, strings,
+true/false/null, me() and now(). Every table is implicitly restricted to the tuples of the viewer.
+'''
+import calendar
+import datetime
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import models
+from django.db.models import Q
+from django.utils import timezone
+
+from apps.fbschema.fields import JSONField
+from apps.fbschema.resolvers import LOOKUP_FIELDS
+from apps.fbschema.utils import get_shared_model
+
+FQL_PLAN_CACHE_SIZE = getattr(settings, 'FBSCHEMA_FQL_PLAN_CACHE_SIZE', 500)
+
+KEYWORDS = frozenset(['SELECT', 'FROM', 'WHERE', 'AND', 'OR', 'NOT', 'IN', 'ORDER', 'BY', 'ASC', 'DESC', 'LIMIT', 'OFFSET'])
+
+TOKEN_RE = re.compile(r'''\s*(?:
+    (?P<number>\d+(?:\.\d+)?) |
+    (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*") |
+    (?P<op><>|!=|<=|>=|=|<|>) |
+    (?P<punct>[(),-]) |
+    (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    )''', re.VERBOSE)
+
+LOOKUPS = {'=': 'exact', '<': 'lt', '<=': 'lte', '>': 'gt', '>=': 'gte'}
+FLIPPED = {'=': '=', '!=': '!=', '<>': '<>', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+
+class FqlError(ValueError):
+    '''
+    Raised for queries the local engine can't parse or answer
+    '''
+    pass
+
+
+def tokenize(query):
+    '''
+    Returns a list of (kind, value) tokens, keywords are upper cased and strings unquoted
+    '''
+    tokens = []
+    position = 0
+    query = query.rstrip()
+    while position < len(query):
+        match = TOKEN_RE.match(query, position)
+        if match is None or match.end() == position:
+            raise FqlError("Unexpected character at %d in fql query: %s" % (position, query[position:position + 20]))
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'number':
+            value = float(value) if '.' in value else int(value)
+        elif kind == 'string':
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        elif kind == 'name' and value.upper() in KEYWORDS:
+            kind, value = 'keyword', value.upper()
+        tokens.append((kind, value))
+    return tokens
+
+
+def normalize(query):
+    '''
+    Normalized query text, queries differing only in whitespace or keyword case share a compiled plan
+    '''
+    return u' '.join([kind == 'string' and repr(value) or unicode(value) for kind, value in tokenize(query)])
+
+
+class Parser(object):
+    '''
+    Recursive descent parser turning tokens into nested tuples -
+        query       ('query', columns, table, condition, [(column, descending)], offset, limit)
+        condition   ('and', [conditions]), ('or', [conditions]), ('not', condition),
+                    ('compare', operator, operand, operand), ('in', operand, values or query)
+        operand     ('column', name), ('value', value), ('call', name, [operands])
+    '''
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self, kind=None, value=None):
+        if self.position >= len(self.tokens):
+            return None
+        token = self.tokens[self.position]
+        if (kind and token[0] != kind) or (value is not None and token[1] != value):
+            return None
+        return token
+
+    def take(self, kind=None, value=None):
+        token = self.peek(kind, value)
+        if token is None:
+            found = self.position < len(self.tokens) and self.tokens[self.position][1] or 'end of query'
+            raise FqlError("Expected %s but found %s" % (value or kind or 'an operand', found))
+        self.position += 1
+        return token
+
+    def parse(self):
+        query = self.query()
+        if self.position != len(self.tokens):
+            raise FqlError("Unexpected %s after end of query" % (self.tokens[self.position][1],))
+        return query
+
+    def query(self):
+        self.take('keyword', 'SELECT')
+        columns = [self.take('name')[1]]
+        while self.peek('punct', ','):
+            self.take()
+            columns.append(self.take('name')[1])
+        self.take('keyword', 'FROM')
+        table = self.take('name')[1]
+        condition = None
+        if self.peek('keyword', 'WHERE'):
+            self.take()
+            condition = self.condition()
+        order = []
+        if self.peek('keyword', 'ORDER'):
+            self.take()
+            self.take('keyword', 'BY')
+            while True:
+                column = self.take('name')[1]
+                descending = False
+                if self.peek('keyword', 'ASC') or self.peek('keyword', 'DESC'):
+                    descending = self.take()[1] == 'DESC'
+                order.append((column, descending))
+                if not self.peek('punct', ','):
+                    break
+                self.take()
+        offset = limit = None
+        if self.peek('keyword', 'LIMIT'):
+            self.take()
+            limit = self.take('number')[1]
+            if self.peek('punct', ','):
+                self.take()
+                offset, limit = limit, self.take('number')[1]
+            elif self.peek('keyword', 'OFFSET'):
+                self.take()
+                offset = self.take('number')[1]
+        return ('query', columns, table, condition, order, offset, limit)
+
+    def condition(self):
+        conditions = [self.conjunction()]
+        while self.peek('keyword', 'OR'):
+            self.take()
+            conditions.append(self.conjunction())
+        return conditions[0] if len(conditions) == 1 else ('or', conditions)
+
+    def conjunction(self):
+        conditions = [self.negation()]
+        while self.peek('keyword', 'AND'):
+            self.take()
+            conditions.append(self.negation())
+        return conditions[0] if len(conditions) == 1 else ('and', conditions)
+
+    def negation(self):
+        if self.peek('keyword', 'NOT'):
+            self.take()
+            return ('not', self.negation())
+        if self.peek('punct', '('):
+            # a parenthesized condition, operands never start with a parenthesis
+            self.take()
+            condition = self.condition()
+            self.take('punct', ')')
+            return condition
+        left = self.operand()
+        if self.peek('keyword', 'NOT'):
+            self.take()
+            return ('not', self.membership(left))
+        if self.peek('keyword', 'IN'):
+            return self.membership(left)
+        operator = self.take('op')[1]
+        return ('compare', operator, left, self.operand())
+
+    def membership(self, left):
+        self.take('keyword', 'IN')
+        self.take('punct', '(')
+        if self.peek('keyword', 'SELECT'):
+            values = self.query()
+        else:
+            values = [self.operand()]
+            while self.peek('punct', ','):
+                self.take()
+                values.append(self.operand())
+        self.take('punct', ')')
+        return ('in', left, values)
+
+    def operand(self):
+        if self.peek('punct', '-'):
+            self.take()
+            return ('value', -self.take('number')[1])
+        kind, value = self.take()
+        if kind in ('number', 'string'):
+            return ('value', value)
+        if kind != 'name':
+            raise FqlError("Unexpected %s" % value)
+        if self.peek('punct', '('):
+            self.take()
+            arguments = []
+            while not self.peek('punct', ')'):
+                arguments.append(self.operand())
+                if not self.peek('punct', ','):
+                    break
+                self.take()
+            self.take('punct', ')')
+            return ('call', value.lower(), arguments)
+        if value.lower() in ('true', 'false', 'null'):
+            return ('value', {'true': True, 'false': False, 'null': None}[value.lower()])
+        return ('column', value)
+
+
+def parse(query):
+    return Parser(tokenize(query)).parse()
+
+
+_tables = {}
+
+def get_table_model(fqlname):
+    '''
+    Returns the fbschema model of an fql table name
+    '''
+    if not _tables:
+        for model in models.get_models():
+            if getattr(model, 'fqlname', None):
+                _tables[model.fqlname] = model
+    if fqlname not in _tables:
+        raise FqlError("Table %s is not stored locally" % fqlname)
+    return _tables[fqlname]
+
+
+class FqlContext(object):
+    '''
+    Viewer a plan is executed for, me() is the facebook uid of the viewer
+    '''
+    def __init__(self, user, me=None):
+        self.user = user
+        self._me = me
+
+    @property
+    def me(self):
+        if self._me is None:
+            try:
+                self._me = self.user.get_profile().facebook_id
+            except Exception:
+                self._me = None
+            if self._me is None:
+                raise FqlError("me() is unknown, %s has no facebook profile" % self.user)
+        return self._me
+
+
+def to_timestamp(value):
+    if value is None:
+        return None
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    return calendar.timegm(value.utctimetuple())
+
+
+class Column(object):
+    '''
+    A column of an fql table, i.e. a model field, and how it maps onto the ORM
+    '''
+    def __init__(self, model, name):
+        if name in model.ignore_fields:
+            raise FqlError("%s is not a column of %s" % (name, model.fqlname))
+        self.field = None
+        self.path = name
+        try:
+            self.field = model._meta.get_field(name)
+        except models.FieldDoesNotExist:
+            # viewer independent columns of the user table are read through its shared profile
+            shared_model = get_shared_model(model)
+            if shared_model and name not in shared_model.ignore_fields:
+                try:
+                    self.field = shared_model._meta.get_field(name)
+                    self.path = "%s__%s" % (model.shared_field, name)
+                except models.FieldDoesNotExist:
+                    pass
+        if self.field is None:
+            raise FqlError("%s is not a column of %s" % (name, model.fqlname))
+        self.name = name
+        self.struct_fields = []
+        if isinstance(self.field, models.ForeignKey):
+            to = self.field.rel.to
+            if to in LOOKUP_FIELDS:
+                # Foreign keys to users and albums are given as their facebook ids
+                self.path = "%s__%s" % (self.path, LOOKUP_FIELDS[to])
+            else:
+                self.struct_fields = [field.name for field in to._meta.fields if field.name != 'id']
+        self.paths = self.struct_fields and ["%s__%s" % (self.path, field) for field in self.struct_fields] or [self.path]
+
+    def lookup_path(self):
+        if self.struct_fields:
+            raise FqlError("%s can't be compared locally" % self.name)
+        return self.path
+
+    def to_db(self, value):
+        '''
+        Converts an fql value to the value the ORM expects for this column
+        '''
+        if value is None or isinstance(self.field, models.ForeignKey):
+            return value
+        if isinstance(self.field, models.DateTimeField) and isinstance(value, (int, long, float)):
+            return datetime.datetime.fromtimestamp(value, timezone.utc)
+        try:
+            return self.field.to_python(value)
+        except Exception:
+            raise FqlError("%r is not a valid value for %s" % (value, self.name))
+
+    def to_fql(self, values):
+        '''
+        Converts the values of self.paths of a row to the fql value of the column
+        '''
+        if self.struct_fields:
+            if all([value is None for value in values]):
+                return None
+            return dict(zip(self.struct_fields, values))
+        value = values[0]
+        if isinstance(self.field, models.DateTimeField):
+            return to_timestamp(value)
+        if isinstance(self.field, JSONField):
+            # arrays and objects are answered as such, values_list gives their json text
+            return self.field.to_python(value)
+        return value
+
+
+class CompiledQuery(object):
+    '''
+    Compiled plan of an fql query. execute(context) yields facebook shaped rows, queryset(context) returns the
+    underlying queryset
+    '''
+    def __init__(self, tree):
+        ignored, columns, table, condition, order, offset, limit = tree
+        self.model = get_table_model(table)
+        # models read by the plan, subqueries included
+        self.tables = set([self.model])
+        self.columns = [Column(self.model, name) for name in columns]
+        self.condition = condition is not None and self.compile_condition(condition) or None
+        self.order_by = [(descending and '-' or '') + Column(self.model, name).lookup_path() for name, descending in order]
+        self.offset = offset or 0
+        self.limit = limit
+        self.paths = []
+        for column in self.columns:
+            self.paths.extend(column.paths)
+
+    def scope(self, context):
+        '''
+        Tuples of the viewer, tables without a user field ( like ) are scoped through their foreign key to users
+        '''
+        field_names = [field.name for field in self.model._meta.fields]
+        if 'user' in field_names:
+            return self.model.objects.filter(user=context.user)
+        for field in self.model._meta.fields:
+            if isinstance(field, models.ForeignKey) and 'user' in [f.name for f in field.rel.to._meta.fields]:
+                return self.model.objects.filter(**{"%s__user" % field.name: context.user})
+        return self.model.objects.all()
+
+    def queryset(self, context):
+        queryset = self.scope(context)
+        if self.condition:
+            queryset = queryset.filter(self.condition(context))
+        if self.order_by:
+            queryset = queryset.order_by(*self.order_by)
+        if self.limit is not None:
+            queryset = queryset[self.offset:self.offset + self.limit]
+        elif self.offset:
+            queryset = queryset[self.offset:]
+        return queryset
+
+    def execute(self, context):
+        for values in self.queryset(context).values_list(*self.paths).iterator():
+            row = {}
+            position = 0
+            for column in self.columns:
+                row[column.name] = column.to_fql(values[position:position + len(column.paths)])
+                position += len(column.paths)
+            yield row
+
+    def compile_value(self, operand):
+        '''
+        Returns a function of the context returning the value of a constant operand
+        '''
+        if operand[0] == 'value':
+            value = operand[1]
+            return lambda context: value
+        if operand[0] == 'call' and operand[1] == 'me' and not operand[2]:
+            return lambda context: context.me
+        if operand[0] == 'call' and operand[1] == 'now' and not operand[2]:
+            return lambda context: int(time.time())
+        raise FqlError("Unsupported operand %s" % (operand[1],))
+
+    def compile_condition(self, condition):
+        '''
+        Returns a function of the context returning the Q object of a condition
+        '''
+        kind = condition[0]
+        if kind in ('and', 'or'):
+            parts = [self.compile_condition(part) for part in condition[1]]
+            if kind == 'and':
+                return lambda context: reduce(lambda q, part: q & part(context), parts[1:], parts[0](context))
+            return lambda context: reduce(lambda q, part: q | part(context), parts[1:], parts[0](context))
+        if kind == 'not':
+            part = self.compile_condition(condition[1])
+            return lambda context: ~part(context)
+        if kind == 'in':
+            return self.compile_membership(condition[1], condition[2])
+        return self.compile_comparison(*condition[1:])
+
+    def compile_membership(self, left, values):
+        if left[0] != 'column':
+            raise FqlError("IN needs a column on its left side")
+        column = Column(self.model, left[1])
+        path = "%s__in" % column.lookup_path()
+        if isinstance(values, tuple):
+            subquery = CompiledQuery(values)
+            if len(subquery.columns) != 1:
+                raise FqlError("A subquery must select exactly one column")
+            subpath = subquery.columns[0].lookup_path()
+            self.tables.update(subquery.tables)
+            return lambda context: Q(**{path: subquery.queryset(context).values_list(subpath, flat=True)})
+        getters = [self.compile_value(value) for value in values]
+        return lambda context: Q(**{path: [column.to_db(getter(context)) for getter in getters]})
+
+    def compile_comparison(self, operator, left, right):
+        if left[0] == 'call' and left[1] == 'strpos':
+            return self.compile_strpos(operator, left, right)
+        if right[0] == 'call' and right[1] == 'strpos':
+            return self.compile_strpos(FLIPPED[operator], right, left)
+        if left[0] != 'column':
+            operator, left, right = FLIPPED[operator], right, left
+        if left[0] != 'column' or right[0] == 'column':
+            raise FqlError("Comparisons need a column on one side and a value on the other")
+        column = Column(self.model, left[1])
+        path = column.lookup_path()
+        getter = self.compile_value(right)
+
+        def compare(context):
+            value = column.to_db(getter(context))
+            if value is None:
+                q = Q(**{"%s__isnull" % path: True})
+                return operator in ('!=', '<>') and ~q or q
+            if operator in ('!=', '<>'):
+                return ~Q(**{path: value})
+            return Q(**{"%s__%s" % (path, LOOKUPS[operator]): value})
+        return compare
+
+    def compile_strpos(self, operator, call, position):
+        '''
+        strpos(column, 'text') >= 0 ( or > -1 ) is a containment test, strpos(...) < 0 ( or = -1 ) its negation.
+        strpos(lower(column), 'text') tests case insensitively
+        '''
+        arguments = call[2]
+        if len(arguments) != 2 or arguments[1][0] != 'value' or position[0] != 'value':
+            raise FqlError("strpos needs a column and a string")
+        target, text, position = arguments[0], arguments[1][1], position[1]
+        lookup = 'contains'
+        if target[0] == 'call' and target[1] == 'lower' and len(target[2]) == 1:
+            target, lookup = target[2][0], 'icontains'
+        if target[0] != 'column':
+            raise FqlError("strpos needs a column and a string")
+        if (operator, position) in (('>=', 0), ('>', -1), ('!=', -1), ('<>', -1)):
+            negate = False
+        elif (operator, position) in (('<', 0), ('=', -1), ('<=', -1)):
+            negate = True
+        else:
+            raise FqlError("strpos can only be tested for >= 0 or < 0 locally")
+        q = Q(**{"%s__%s" % (Column(self.model, target[1]).lookup_path(), lookup): text})
+        return lambda context: negate and ~q or q
+
+
+class PlanCache(object):
+    '''
+    Thread safe LRU cache of compiled plans keyed by normalized query text
+    '''
+    def __init__(self, max_size=FQL_PLAN_CACHE_SIZE):
+        self.max_size = max_size
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, query):
+        key = normalize(query)
+        with self._lock:
+            plan = self._plans.pop(key, None)
+            if plan is not None:
+                self._plans[key] = plan
+                self.hits += 1
+                return plan
+            self.misses += 1
+        plan = CompiledQuery(Parser(tokenize(query)).parse())
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.max_size:
+                self._plans.popitem(last=False)
+        return plan
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
+
+plan_cache = PlanCache()
+
+
+def compile_fql(query):
+    '''
+    Returns the compiled plan of an fql query, from the plan cache if it has been compiled before
+    '''
+    return plan_cache.get(query)
+
+
+def execute_fql(query, user, me=None):
+    '''
+    Yields the rows of an fql query answered from the local tables of given system user
+    '''
+    return compile_fql(query).execute(FqlContext(user, me))
+
+
+def fql(query, user, me=None):
+    '''
+    Local counterpart of graph.fql, returns a list of rows
+    '''
+    return list(execute_fql(query, user, me))
+
+
+def batch_fql(queries_dict, user, me=None):
+    '''
+    Local counterpart of graph.batch_fql, returns a dict of query name => rows
+    '''
+    context = FqlContext(user, me)
+    return dict([(unicode(name), list(compile_fql(query).execute(context))) for name, query in queries_dict.items()])
@@ -0,0 +1,154 @@
+'''
+Local fql server. The fql view answers the requests open_facebook's graph.fql and graph.batch_fql send to
+https://graph.facebook.com/fql?q=... from the local tables ( see apps.fbschema.fql_engine ), so a client whose
+api_url points at this application reads our replica instead of facebook.
+
+Responses are streamed row by row. Results are cached per viewer and query, cache keys include a generation number
+per table which is bumped whenever the table is written, so a write makes all cached results reading the table stale
+at once. Writes bump it once per batch of tuples rather than once per tuple - save_update_delete through rows_changed,
+the other write paths ( FacebookUser.save_profiles, the friend and like tasks ) by calling invalidate. Generations are
+TableGeneration rows rather than cache entries, the tables are written by worker processes whose cache may not be
+the one of the web processes.
+'''
+import hashlib
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from apps.fbschema.fql_engine import FqlContext, FqlError, compile_fql, normalize
+from apps.fbschema.models import TableGeneration
+from apps.fbschema.signals import rows_changed
+
+logger = logging.getLogger(__name__)
+
+FQL_CACHE_TIMEOUT = getattr(settings, 'FBSCHEMA_FQL_CACHE_TIMEOUT', 300)
+# Larger results are streamed without being cached
+FQL_CACHE_MAX_ROWS = getattr(settings, 'FBSCHEMA_FQL_CACHE_MAX_ROWS', 5000)
+
+
+def create_generation(table, viewer):
+    '''
+    Stores the generation of a table which has none yet and returns it
+    '''
+    # Starting from the clock, a generation which was lost can't come back with results cached under it
+    value = int(time.time() * 1000)
+    try:
+        with transaction.commit_on_success():
+            TableGeneration.objects.create(table=table, viewer=viewer, value=value)
+    except IntegrityError:
+        # created by another process in the meantime
+        value = TableGeneration.objects.get(table=table, viewer=viewer).value
+    return value
+
+
+def invalidate(model, user_id):
+    '''
+    Makes cached results reading given table of given user stale, user_id is None for tuples shared by all users
+    ( the like table, the profiles of the user table )
+    '''
+    generation = TableGeneration.objects.filter(table=model.fqlname, viewer=user_id or 0)
+    if not generation.update(value=F('value') + 1):
+        create_generation(model.fqlname, user_id or 0)
+        generation.update(value=F('value') + 1)
+
+
+def generations(models, user_id):
+    '''
+    Generations of given tables of given user, and of their tuples shared by all users, in one query
+    '''
+    keys = []
+    for model in sorted(models, key=lambda model: model.fqlname):
+        keys.extend([(model.fqlname, user_id or 0), (model.fqlname, 0)])
+    found = dict([((table, viewer), value) for table, viewer, value in TableGeneration.objects.filter(
+        table__in=set([key[0] for key in keys]), viewer__in=set([key[1] for key in keys])).values_list('table', 'viewer', 'value')])
+    for key in keys:
+        if key not in found:
+            found[key] = create_generation(*key)
+    return [found[key] for key in keys]
+
+
+def result_key(query, plan, context):
+    text = u"%s|%s|%s|%s" % (normalize(query), context.user.id, context._me, generations(plan.tables, context.user.id))
+    return 'fbschema:fql:result:%s' % hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def cached_rows(query, plan, context):
+    '''
+    Yields the rows of a compiled query, from the result cache if possible. Rows of a cache miss are cached once
+    all of them have been yielded
+    '''
+    key = result_key(query, plan, context)
+    rows = cache.get(key)
+    if rows is not None:
+        for row in rows:
+            yield row
+        return
+    rows = []
+    for row in plan.execute(context):
+        if rows is not None:
+            rows.append(row)
+            if len(rows) > FQL_CACHE_MAX_ROWS:
+                rows = None
+        yield row
+    if rows is not None:
+        cache.set(key, rows, FQL_CACHE_TIMEOUT)
+
+
+def stream_result_set(query, plan, context):
+    '''
+    Yields the json array of the rows of a query, piece by piece
+    '''
+    yield '['
+    separator = ''
+    for row in cached_rows(query, plan, context):
+        yield separator + json.dumps(row)
+        separator = ','
+    yield ']'
+
+
+def stream_fql(q, user, me=None):
+    '''
+    Compiles q, a query or a json object of named queries as sent by batch_fql, and returns an iterator over the
+    facebook shaped json response. Queries are compiled before anything is streamed, so FqlError is raised here
+    '''
+    context = FqlContext(user, me)
+    if q.lstrip().startswith('{'):
+        try:
+            queries = json.loads(q)
+        except ValueError, e:
+            raise FqlError("Invalid multiquery json: %s" % e)
+        plans = [(name, queries[name], compile_fql(queries[name])) for name in sorted(queries)]
+        return stream_multiquery(plans, context)
+    return stream_query(q, compile_fql(q), context)
+
+
+def stream_query(query, plan, context):
+    yield '{"data": '
+    for piece in stream_result_set(query, plan, context):
+        yield piece
+    yield '}'
+
+
+def stream_multiquery(plans, context):
+    yield '{"data": ['
+    separator = ''
+    for name, query, plan in plans:
+        yield '%s{"name": %s, "fql_result_set": ' % (separator, json.dumps(name))
+        for piece in stream_result_set(query, plan, context):
+            yield piece
+        yield '}'
+        separator = ','
+    yield ']}'
+
+
+def invalidate_on_rows_changed(sender, request, added, updated, deleted, **kwargs):
+    if getattr(sender, 'fqlname', None) and (added or updated or deleted):
+        invalidate(sender, request.user.id)
+
+
+rows_changed.connect(invalidate_on_rows_changed, dispatch_uid='fbschema_fql_cache')
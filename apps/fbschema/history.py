@@ -0,0 +1,195 @@
+'''
+Changelog of the fql tables. Every save_update_delete logs the tuples it added, the fields it changed and the tuples it
+deleted as ChangeLog tuples ( through the rows_changed signal ), and every settings.FBSCHEMA_HISTORY_SNAPSHOT_EVERY
+changes a ChangeSnapshot of the whole table is taken. A table "as it was on some day" is rebuilt from the nearest
+snapshot taken before that day plus the changes logged between the two, so history can grow for years without
+making reconstruction slower.
+
+Usage -
+    albums = as_of(request.user, FacebookAlbum, datetime.datetime(2013, 1, 1))
+    albums.filter(owner=facebook_user).count()
+    changes(request.user, FacebookAlbum, key=aid)
+'''
+import datetime
+import json
+import logging
+
+from django.conf import settings
+from django.db.models import ForeignKey
+from django.utils import timezone
+
+from apps.fbschema.history_models import ChangeLog, ChangeSnapshot
+from apps.fbschema.ingest import get_ingest_plan
+from apps.fbschema.signals import rows_changed
+from apps.fbschema.bulk_utils import BULK_CHUNK_SIZE, chunked, iterate_in_pages
+
+logger = logging.getLogger(__name__)
+
+HISTORY_ENABLED = getattr(settings, 'FBSCHEMA_HISTORY', True)
+HISTORY_SNAPSHOT_EVERY = getattr(settings, 'FBSCHEMA_HISTORY_SNAPSHOT_EVERY', 5000)
+
+
+def serialize_value(field, value):
+    '''
+    json friendly form of a field value, foreign keys as ids and datetimes as UTC iso strings
+    '''
+    if isinstance(field, ForeignKey):
+        return getattr(value, 'pk', value)
+    if isinstance(value, datetime.datetime):
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value, timezone.get_default_timezone())
+        return value.astimezone(timezone.utc).isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+def serialize_row(model, data_dict):
+    plan = get_ingest_plan(model)
+    return dict([(field.name, serialize_value(field, data_dict[field.name])) for field in plan.fields])
+
+
+def record_changes(sender, request, added, updated, deleted, **kwargs):
+    '''
+    rows_changed receiver, logs the changes of a save_update_delete call
+    '''
+    if not getattr(sender, 'fqlname', None) or not getattr(sender, 'primary_identifier', None):
+        return
+    primary_identifier = sender.primary_identifier
+    now = timezone.now()
+    entries = []
+
+    def entry(key, action, changes, old_values=None):
+        return ChangeLog(user=request.user, table=sender.fqlname, key=unicode(key), action=action, timestamp=now,
+                         changes=json.dumps(changes), old_values=old_values is not None and json.dumps(old_values) or None)
+
+    for data_dict in added:
+        entries.append(entry(data_dict[primary_identifier], ChangeLog.ADD, serialize_row(sender, data_dict)))
+    for old_values, data_dict in updated:
+        old_row = serialize_row(sender, old_values)
+        new_row = serialize_row(sender, data_dict)
+        changed = [name for name in new_row if new_row[name] != old_row[name]]
+        if changed:
+            entries.append(entry(data_dict[primary_identifier], ChangeLog.UPDATE, dict([(name, new_row[name]) for name in changed]),
+                                 dict([(name, old_row[name]) for name in changed])))
+    for old_values in deleted:
+        entries.append(entry(old_values[primary_identifier], ChangeLog.DELETE, {}, serialize_row(sender, old_values)))
+
+    for chunk in chunked(entries, BULK_CHUNK_SIZE):
+        ChangeLog.objects.bulk_create(chunk)
+    if entries:
+        maybe_snapshot(sender, request.user)
+
+
+def maybe_snapshot(model, user):
+    '''
+    Takes a snapshot if the table has none yet or enough changes have been logged since the last one
+    '''
+    last = ChangeSnapshot.objects.filter(user=user, table=model.fqlname).order_by('-id')[:1]
+    last_change_id = last and last[0].last_change_id or 0
+    if not last or ChangeLog.objects.filter(user=user, table=model.fqlname, id__gt=last_change_id).count() >= HISTORY_SNAPSHOT_EVERY:
+        take_snapshot(model, user)
+
+
+def take_snapshot(model, user):
+    plan = get_ingest_plan(model)
+    last_change = ChangeLog.objects.filter(user=user, table=model.fqlname).order_by('-id').values_list('id', flat=True)[:1]
+    rows = iterate_in_pages(model.objects.filter(user=user).values('id', *plan.field_names))
+    snapshot = ChangeSnapshot(user=user, table=model.fqlname, taken=timezone.now(), last_change_id=last_change and last_change[0] or 0)
+    snapshot.set_rows((unicode(values[model.primary_identifier]), serialize_row(model, plan.load_values(values))) for values in rows)
+    snapshot.save()
+    logger.info("Snapshot of %s for %s, %d tuples" % (model.fqlname, user, snapshot.row_count))
+    return snapshot
+
+
+def changes(user, model, key=None, since=None):
+    '''
+    Logged changes of a table, of one tuple if key ( primary_identifier value ) is given
+    '''
+    entries = ChangeLog.objects.filter(user=user, table=model.fqlname)
+    if key is not None:
+        entries = entries.filter(key=unicode(key))
+    if since is not None:
+        entries = entries.filter(timestamp__gte=since)
+    return entries
+
+
+def as_of(user, model, when):
+    '''
+    Returns a HistoricalTable, the tuples of the table as they were at given time
+    '''
+    snapshot = ChangeSnapshot.objects.filter(user=user, table=model.fqlname, taken__lte=when).order_by('-taken', '-id')[:1]
+    if snapshot:
+        rows = snapshot[0].get_rows()
+        entries = changes(user, model).filter(id__gt=snapshot[0].last_change_id)
+    else:
+        rows = {}
+        entries = changes(user, model)
+    for entry in entries.filter(timestamp__lte=when).order_by('id').iterator():
+        if entry.action == ChangeLog.DELETE:
+            rows.pop(entry.key, None)
+        elif entry.action == ChangeLog.ADD:
+            rows[entry.key] = entry.get_changes()
+        else:
+            rows.setdefault(entry.key, {}).update(entry.get_changes())
+    return HistoricalTable(model, user, rows)
+
+
+class HistoricalTable(object):
+    '''
+    Read only, queryset like view of a table at some time. Tuples are unsaved model instances, filter and get
+    support exact lookups on field names
+    '''
+    def __init__(self, model, user, rows):
+        self.model = model
+        self.user = user
+        self.rows = rows
+        self._instances = None
+
+    def instance(self, values):
+        kwargs = {}
+        for name, value in values.items():
+            field = self.model._meta.get_field(name)
+            if isinstance(field, ForeignKey):
+                kwargs[field.attname] = value
+            else:
+                kwargs[name] = field.to_python(value)
+        return self.model(user=self.user, **kwargs)
+
+    def all(self):
+        if self._instances is None:
+            self._instances = [self.instance(self.rows[key]) for key in sorted(self.rows)]
+        return self._instances
+
+    def filter(self, **kwargs):
+        lookups = [(self.model._meta.get_field(name).attname, getattr(value, 'pk', value)) for name, value in kwargs.items()]
+        table = HistoricalTable(self.model, self.user, {})
+        table._instances = [instance for instance in self.all()
+                            if all([getattr(instance, attname) == value for attname, value in lookups])]
+        return table
+
+    def get(self, **kwargs):
+        found = self.filter(**kwargs).all()
+        if len(found) != 1:
+            raise (self.model.DoesNotExist if not found else self.model.MultipleObjectsReturned)(
+                "%d %s tuples match %s" % (len(found), self.model.__name__, kwargs))
+        return found[0]
+
+    def count(self):
+        return len(self.all())
+
+    def exists(self):
+        return bool(self.all())
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def __getitem__(self, index):
+        return self.all()[index]
+
+
+if HISTORY_ENABLED:
+    rows_changed.connect(record_changes, dispatch_uid='fbschema_history')
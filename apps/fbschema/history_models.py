@@ -0,0 +1,82 @@
+import base64
+import json
+import zlib
+
+from django.db import models
+from django.contrib.auth.models import User
+
+'''
+Changelog of the fql tables, see apps.fbschema.history
+'''
+
+class ChangeLog(models.Model):
+    '''
+    One added, updated or deleted tuple of an fql table. An add holds all field values of the tuple, an update only
+    the fields which changed along with their old values and a delete the values the tuple had
+    '''
+    ADD                 = 'add'
+    UPDATE              = 'update'
+    DELETE              = 'delete'
+    ACTION_CHOICES      = ((ADD, 'Add'), (UPDATE, 'Update'), (DELETE, 'Delete'))
+
+    user                = models.ForeignKey(User, help_text="System user the tuple belongs to")
+    table               = models.CharField( max_length=100, help_text="fqlname of the model" )
+    key                 = models.CharField( max_length=255, help_text="primary_identifier value of the tuple" )
+    action              = models.CharField( max_length=10, choices=ACTION_CHOICES )
+    changes             = models.TextField( help_text="json, field name => new value" )
+    old_values          = models.TextField( blank=True, null=True, help_text="json, field name => value before the change" )
+    timestamp           = models.DateTimeField( db_index=True )
+
+    def get_changes(self):
+        return json.loads(self.changes)
+
+    def get_old_values(self):
+        return json.loads(self.old_values or '{}')
+
+    def __unicode__(self):
+        return "%s %s %s %s" % (self.timestamp, self.action, self.table, self.key)
+
+    class Meta:
+        ordering = ('id',)
+        index_together = (("user", "table", "timestamp"), ("user", "table", "key"))
+
+
+class ChangeSnapshot(models.Model):
+    '''
+    Full copy of a table of a user, taken every settings.FBSCHEMA_HISTORY_SNAPSHOT_EVERY changes so that
+    reconstructing the table only replays the changes logged after the nearest snapshot
+    '''
+    user                = models.ForeignKey(User, help_text="System user the tuples belong to")
+    table               = models.CharField( max_length=100, help_text="fqlname of the model" )
+    taken               = models.DateTimeField( db_index=True )
+    last_change_id      = models.IntegerField( default=0, help_text="Id of the last ChangeLog tuple the snapshot includes" )
+    row_count           = models.IntegerField( default=0 )
+    data                = models.TextField( help_text="zlib compressed json lines, [key, { field name : value }]" )
+
+    def get_rows(self):
+        rows = {}
+        for line in zlib.decompress(base64.b64decode(self.data)).splitlines():
+            key, values = json.loads(line)
+            rows[key] = values
+        return rows
+
+    def set_rows(self, rows):
+        '''
+        rows is an iterable of (key, values) pairs, they are compressed one by one as json lines so that a snapshot of
+        a large table is never held in memory uncompressed
+        '''
+        compressor = zlib.compressobj()
+        data = []
+        self.row_count = 0
+        for key, values in rows:
+            data.append(compressor.compress(json.dumps([key, values]) + '\n'))
+            self.row_count += 1
+        data.append(compressor.flush())
+        self.data = base64.b64encode(''.join(data))
+
+    def __unicode__(self):
+        return "%s %s %s (%d tuples)" % (self.user, self.table, self.taken, self.row_count)
+
+    class Meta:
+        ordering = ('id',)
+        index_together = (("user", "table", "taken"),)
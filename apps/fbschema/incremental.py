@@ -0,0 +1,116 @@
+'''
+Incremental sync. Album, photo, link and stream tuples carry a timestamp ( the model's incremental_field ), once an
+owner's tuples have been synced the newest timestamp is stored as a SyncHighWaterMark and later syncs add
+"AND <incremental_field> >= <mark>" to the fql clause, so only changed tuples are downloaded.
+
+An incremental response can't tell which tuples have been deleted on facebook, hence incremental results are stored
+like a stream ( save and update, never delete ) and every settings.FBSCHEMA_FULL_SYNC_INTERVAL_DAYS an owner's
+tuples are downloaded and reconciled in full again.
+'''
+import datetime
+import logging
+import re
+
+from django.conf import settings
+from django.utils import timezone
+
+from apps.fbschema.sync_models import SyncHighWaterMark
+from apps.fbschema.ingest import SyncStats
+
+logger = logging.getLogger(__name__)
+
+FULL_SYNC_INTERVAL_DAYS = getattr(settings, 'FBSCHEMA_FULL_SYNC_INTERVAL_DAYS', 7)
+
+
+def clause_limit(clause):
+    '''
+    Row limit of an fql clause, None if it has none
+    '''
+    match = re.search(r'\blimit\s+(\d+)\s*$', clause, re.IGNORECASE)
+    return int(match.group(1)) if match else None
+
+
+class HighWaterMarks(object):
+    '''
+    High water marks of a model for the user of a request, loaded in one query
+    Usage -
+        marks = HighWaterMarks(request, FacebookPhoto)
+        response_data = graph.fql(marks.fql_query_me())
+        marks.save_update_delete(request, response_data, bulk=True)
+
+    With full=True every owner is reconciled in full, whatever the marks say
+    '''
+    def __init__(self, request, model, full=False):
+        self.user = request.user
+        self.model = model
+        self.full = full
+        self.marks = dict([(mark.owner_uid, mark) for mark in SyncHighWaterMark.objects.filter(user=self.user, table=model.fqlname)])
+        # owner uid -> (since, limit) of the query sent for the owner
+        self.queried = {}
+
+    def since(self, owner_uid=None):
+        '''
+        Timestamp to query changed tuples of the owner from, None when a full reconciliation is due
+        '''
+        mark = self.marks.get(owner_uid)
+        if self.full or mark is None or mark.value is None or mark.last_full_sync is None:
+            return None
+        if mark.last_full_sync < timezone.now() - datetime.timedelta(days=FULL_SYNC_INTERVAL_DAYS):
+            return None
+        return mark.value
+
+    def fql_query_me(self):
+        since = self.since()
+        self.queried[None] = (since, clause_limit(self.model.me_clause))
+        return self.model.fql_query_me(since)
+
+    def fql_query_my_friends(self, friend_uid):
+        since = self.since(friend_uid)
+        self.queried[friend_uid] = (since, clause_limit(self.model.my_friend_clause))
+        return self.model.fql_query_my_friends(friend_uid, since)
+
+    def save_update_delete(self, request, response_data, owner_uid=None, stream_nature=False, **kwargs):
+        '''
+        Stores the response of a query built by fql_query_me/fql_query_my_friends and moves the owner's mark. response_data
+        may be any iterable of tuples. Tuples are only deleted when the response is a full and complete result set.
+        Returns a SyncStats
+        '''
+        since, limit = self.queried.pop(owner_uid, (self.since(owner_uid), None))
+        rows = TrackedRows(response_data, self.model.incremental_field)
+        stats = self.model.save_update_delete(request, rows, stream_nature=stream_nature or since is not None, limit=limit, **kwargs)
+        if limit is not None and rows.count >= limit:
+            # Tuples past the limit are unknown, moving the mark isn't safe
+            logger.info("%s of %s for owner %s hit the limit of %d rows" % (self.model.fqlname, self.user, owner_uid or 'me', limit))
+        else:
+            # save_update_delete returns before comparing anything for an empty response, nothing was reconciled
+            self.advance(owner_uid, rows.newest, full=since is None and rows.count > 0)
+        return stats
+
+    def advance(self, owner_uid, newest, full=False):
+        mark = self.marks.get(owner_uid)
+        if mark is None:
+            mark = self.marks[owner_uid] = SyncHighWaterMark(user=self.user, table=self.model.fqlname, owner_uid=owner_uid)
+        if newest is not None:
+            mark.value = max(mark.value or 0, newest)
+        if full:
+            mark.last_full_sync = timezone.now()
+        mark.save()
+
+
+class TrackedRows(object):
+    '''
+    Passes response tuples through, counting them and keeping the newest value of the incremental field
+    '''
+    def __init__(self, response_data, field):
+        self.response_data = response_data
+        self.field = field
+        self.count = 0
+        self.newest = None
+
+    def __iter__(self):
+        for response_data_dict in self.response_data:
+            self.count += 1
+            value = response_data_dict.get(self.field)
+            if value:
+                self.newest = max(self.newest, int(value))
+            yield response_data_dict
@@ -0,0 +1,141 @@
+'''
+Ingest plans of fbschema models. Everything prepare_dict needs to know about a model, i.e. its field list and
+the converter of each field, is worked out once per model and kept in a registry instead of being introspected
+again for every tuple of every response
+'''
+import hashlib
+import json
+
+from django.db.models import ForeignKey
+from django.utils.encoding import force_unicode
+
+from apps.fbschema.fields import JSONField
+from apps.fbschema.parse_utils import get_converter
+from apps.fbschema.struct_cache import prefetch_structs
+from apps.fbschema.resolvers import LOOKUP_FIELDS, UnresolvedForeignKey, get_resolver
+from apps.fbschema.utils import get_fql_fields
+
+_ingest_plans = {}
+
+
+class IngestPlan(object):
+    '''
+    Compiled form of a model for cleaning fql responses
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.fields = get_fql_fields(model)
+        self.field_names = [getattr(field, 'name') for field in self.fields]
+        self.key_set = frozenset(self.field_names)
+        self.converters = [(getattr(field, 'name'), get_converter(field)) for field in self.fields]
+        self.struct_fields = [(getattr(field, 'name'), field.rel.to) for field in self.fields \
+                              if isinstance(field, ForeignKey) and hasattr(field.rel.to, 'struct_key')]
+        self.resolved_fields = [field for field in self.fields if isinstance(field, ForeignKey) and field.rel.to in LOOKUP_FIELDS]
+        self.json_fields = [field for field in self.fields if isinstance(field, JSONField)]
+        # Fields written when an existing tuple is updated, the content hash included
+        self.write_fields = self.fields + [model._meta.get_field('row_hash')]
+
+        primary_identifier = getattr(model, 'primary_identifier', None)
+        if primary_identifier:
+            self.primary_field = model._meta.get_field(primary_identifier)
+        else:
+            self.primary_field = None
+
+    def check_keys(self, keys):
+        '''
+        Returned data set keys must be equal to the model fields in concern, because requested keys were generated
+        from model fields. Raises ValueError otherwise
+        '''
+        keys = frozenset(keys)
+        if keys != self.key_set:
+            raise ValueError("Response keys do not match fields of %s, missing: %s, unexpected: %s" % (self.model.__name__,
+                             sorted(self.key_set - keys), sorted(keys - self.key_set)))
+
+    def prepare(self, response_data_dict, request=None):
+        '''
+        Cleans/Parses one tuple of the response, keys are expected to be checked already
+        '''
+        data_dict = {}
+        for key, converter in self.converters:
+            data_dict[key] = converter(response_data_dict[key], request)
+        data_dict['row_hash'] = self.row_hash(data_dict)
+        return data_dict
+
+    def row_hash(self, data_dict):
+        '''
+        Stable hash of the cleaned field values of a tuple, foreign keys count by their id. Tuples whose hash
+        didn't change since the last sync are not written again
+        '''
+        values = []
+        for key in self.field_names:
+            value = data_dict[key]
+            if value is None:
+                values.append(u'\x00')
+            elif isinstance(value, (list, dict)):
+                values.append(json.dumps(value, sort_keys=True).decode('utf-8'))
+            else:
+                values.append(force_unicode(getattr(value, 'pk', value)))
+        return hashlib.sha1(u'\x1f'.join(values).encode('utf-8')).hexdigest()
+
+    def load_values(self, values):
+        '''
+        values() querysets give json columns as text, decodes them in a values dict of the plan fields
+        '''
+        for field in self.json_fields:
+            values[field.name] = field.to_python(values[field.name])
+        return values
+
+    def prepare_rows(self, response_data, request=None):
+        '''
+        Cleans/Parses a whole response. Fql returns the same keys for every tuple of a response, so they are
+        checked only once. Distinct struct values and foreign keys of the response are resolved in bulk before any
+        tuple is cleaned, a required foreign key which doesn't resolve raises UnresolvedForeignKey listing all of them
+        '''
+        if not response_data:
+            return []
+        self.check_keys(response_data[0].keys())
+        for key, struct_model in self.struct_fields:
+            prefetch_structs(struct_model, [response_data_dict[key] for response_data_dict in response_data])
+        if self.resolved_fields:
+            self.prefetch_foreign_keys(response_data, get_resolver(request))
+        return [self.prepare(response_data_dict, request) for response_data_dict in response_data]
+
+    def prefetch_foreign_keys(self, response_data, resolver):
+        for field in self.resolved_fields:
+            keys = set([response_data_dict[field.name] for response_data_dict in response_data])
+            resolver.load(field.rel.to, keys)
+            if not field.null:
+                unresolved = resolver.unresolved(field.rel.to, keys)
+                if unresolved:
+                    raise UnresolvedForeignKey(field, unresolved)
+
+
+class SyncStats(object):
+    '''
+    Outcome of a save_update_delete call, counts of tuples per operation. Stats of several calls can be added up
+    '''
+    def __init__(self, added=0, updated=0, unchanged=0, deleted=0):
+        self.added = added
+        self.updated = updated
+        self.unchanged = unchanged
+        self.deleted = deleted
+
+    def __add__(self, other):
+        return SyncStats(self.added + other.added, self.updated + other.updated,
+                         self.unchanged + other.unchanged, self.deleted + other.deleted)
+
+    def __unicode__(self):
+        return u"added %d, updated %d, unchanged %d, deleted %d" % (self.added, self.updated, self.unchanged, self.deleted)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+def get_ingest_plan(model):
+    '''
+    Returns the ingest plan of given model, building it on first use
+    '''
+    plan = _ingest_plans.get(model)
+    if plan is None:
+        plan = _ingest_plans[model] = IngestPlan(model)
+    return plan
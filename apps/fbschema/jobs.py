@@ -0,0 +1,189 @@
+'''
+Background job engine for table downloads. Views enqueue a SyncJob and return right away, worker processes started
+by `python manage.py fbschema_worker` claim pending jobs from the database and run the task, no external broker
+is needed. With settings.FBSCHEMA_JOBS_EAGER jobs run inline in the request, handy on the development server.
+'''
+import logging
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+
+from django.conf import settings
+from django.db import close_connection, connections, reset_queries, router, transaction
+from django.utils import timezone
+
+from apps.fbschema.sync_models import SyncJob
+from apps.fbschema.metrics import InstrumentedGraph, record_job
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = getattr(settings, 'FBSCHEMA_JOB_WORKERS', 2)
+JOB_POLL_INTERVAL = getattr(settings, 'FBSCHEMA_JOB_POLL_INTERVAL', 2)
+JOBS_EAGER = getattr(settings, 'FBSCHEMA_JOBS_EAGER', False)
+# Offline runs, see apps.fbschema.fakegraph
+FAKE_GRAPH = getattr(settings, 'FBSCHEMA_FAKE_GRAPH', None)
+RECORD_FIXTURES = getattr(settings, 'FBSCHEMA_RECORD_FIXTURES', None)
+GRAPH_API_URL = getattr(settings, 'FBSCHEMA_GRAPH_API_URL', None)
+
+TASKS = {}
+
+
+def register_task(function):
+    '''
+    Decorator registering a task under its function name. A task is called as task(request, graph) where request
+    is either the HttpRequest ( eager mode ) or a JobRequest, sync code only relies on request.user
+    '''
+    TASKS[function.__name__] = function
+    return function
+
+
+def get_task(name):
+    import apps.fbschema.tasks
+    return TASKS[name]
+
+
+class JobRequest(object):
+    '''
+    Stands in for the HttpRequest when a task runs in a worker process
+    '''
+    def __init__(self, user, job=None):
+        self.user = user
+        self.job = job
+
+
+def get_graph(user, request=None):
+    '''
+    Graph a job of given user talks to facebook with, the persistent graph of the request in eager mode and the
+    stored access token otherwise. settings.FBSCHEMA_FAKE_GRAPH replaces it with a fake graph, with
+    settings.FBSCHEMA_RECORD_FIXTURES the responses it receives are recorded
+    '''
+    if FAKE_GRAPH:
+        from apps.fbschema.fakegraph import make_fake_graph
+        return make_fake_graph(FAKE_GRAPH, user)
+    if request is not None:
+        from django_facebook.api import require_persistent_graph
+        graph = require_persistent_graph(request)
+    else:
+        graph = user.get_profile().get_offline_graph()
+        if graph is None:
+            raise ValueError("No facebook access token stored for user %s" % user)
+    if GRAPH_API_URL:
+        graph.api_url = GRAPH_API_URL
+    if RECORD_FIXTURES:
+        from apps.fbschema.fakegraph import RecordingGraph
+        graph = RecordingGraph(graph, RECORD_FIXTURES)
+    return graph
+
+
+def enqueue_job(request, task):
+    '''
+    Queues given task for the user of the request and returns the SyncJob
+    '''
+    get_task(task) # fail early on unknown task names
+    job = SyncJob.objects.create(user=request.user, task=task)
+    if JOBS_EAGER:
+        run_job(job, request, get_graph(request.user, request))
+    return job
+
+
+def worker_name(pid=None):
+    return "%s:%s" % (socket.gethostname(), pid or os.getpid())
+
+
+def claim_job():
+    '''
+    Marks the oldest claimable pending job as running and returns it, None if there is nothing to do. Jobs of a user
+    depend on each other ( friend batches need the friend table ... ) so users having a running job are skipped.
+    Claiming is a single UPDATE conditional on the job still being pending and its user having no running job, so
+    two workers never run the same job
+    '''
+    connection = connections[router.db_for_write(SyncJob)]
+    qn = connection.ops.quote_name
+    table = qn(SyncJob._meta.db_table)
+    # MySQL can't read the updated table in a subquery, unless it is materialized as a derived table
+    sql = ("UPDATE %(table)s SET %(status)s = %%s, %(started)s = %%s, %(worker)s = %%s WHERE %(id)s = %%s AND %(status)s = %%s "
+           "AND NOT EXISTS (SELECT 1 FROM (SELECT %(user)s FROM %(table)s WHERE %(status)s = %%s) running "
+           "WHERE running.%(user)s = %(table)s.%(user)s)") % {
+           'table': table, 'id': qn('id'), 'user': qn('user_id'), 'status': qn('status'), 'started': qn('started'),
+           'worker': qn('worker')}
+    for job_id in SyncJob.objects.filter(status=SyncJob.PENDING).values_list('id', flat=True)[:10]:
+        with transaction.commit_on_success(using=connection.alias):
+            cursor = connection.cursor()
+            cursor.execute(sql, [SyncJob.RUNNING, connection.ops.value_to_db_datetime(timezone.now()), worker_name(), job_id, SyncJob.PENDING, SyncJob.RUNNING])
+        if cursor.rowcount:
+            return SyncJob.objects.get(id=job_id)
+    return None
+
+
+def run_job(job, request=None, graph=None):
+    '''
+    Runs a claimed job and records its outcome, a failing task marks the job failed with its traceback
+    '''
+    job.status = SyncJob.RUNNING
+    job.started = job.started or timezone.now()
+    try:
+        if request is None:
+            request = JobRequest(job.user, job)
+        if graph is None:
+            graph = get_graph(job.user)
+        get_task(job.task)(request, InstrumentedGraph(graph, job.user))
+        job.status = SyncJob.DONE
+    except Exception:
+        logger.exception("Job %s failed" % job)
+        job.status = SyncJob.FAILED
+        job.message = traceback.format_exc()
+    job.finished = timezone.now()
+    job.save()
+    record_job(job)
+    return job
+
+
+def requeue_stale_jobs():
+    '''
+    Puts back jobs left running by dead worker processes of this host
+    '''
+    host = socket.gethostname()
+    for job in SyncJob.objects.filter(status=SyncJob.RUNNING, worker__startswith="%s:" % host):
+        pid = int(job.worker.split(':')[-1])
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            logger.info("Requeueing %s left by dead worker %s" % (job, job.worker))
+            SyncJob.objects.filter(id=job.id, status=SyncJob.RUNNING).update(status=SyncJob.PENDING, worker=None)
+
+
+def run_worker(poll_interval=JOB_POLL_INTERVAL, once=False):
+    '''
+    Worker loop, claims and runs jobs until interrupted. With once=True it returns when the queue is empty
+    '''
+    # Connections must not be shared with the parent process
+    close_connection()
+    while True:
+        job = claim_job()
+        if job is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+        logger.info("Worker %s running %s" % (worker_name(), job))
+        run_job(job)
+        reset_queries()
+
+
+def start_workers(processes=JOB_WORKERS, poll_interval=JOB_POLL_INTERVAL):
+    '''
+    Starts given number of worker processes and waits for them
+    '''
+    requeue_stale_jobs()
+    close_connection()
+    workers = [multiprocessing.Process(target=run_worker, args=(poll_interval,)) for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
@@ -0,0 +1,27 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+
+from apps.fbschema.aggregates import AGGREGATES_ENABLED, has_aggregates, rebuild_aggregates
+from apps.fbschema.fql_engine import FqlError, get_table_model
+
+
+class Command(BaseCommand):
+    args = "[table ...]"
+    help = "Rebuilds the leaderboards and counts of given fql tables ( all tables having aggregates by default ) from the stored tuples"
+
+    def handle(self, *tables, **options):
+        if tables:
+            try:
+                aggregated = [get_table_model(table) for table in tables]
+            except FqlError, e:
+                raise CommandError(e)
+        else:
+            aggregated = [model for model in models.get_models() if getattr(model, 'fqlname', None)]
+        aggregated = [model for model in aggregated if has_aggregates(model)]
+        if not AGGREGATES_ENABLED:
+            self.stdout.write("settings.FBSCHEMA_AGGREGATES is off, syncs won't keep the rebuilt aggregates up to date\n")
+        for model in aggregated:
+            for user in User.objects.filter(id__in=model.objects.values('user')):
+                rebuild_aggregates(model, user)
+                self.stdout.write("%s of %s rebuilt\n" % (model.fqlname, user))
@@ -0,0 +1,55 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from apps.fbschema.benchmarks import SIZES, SYNC_MODELS, run_benchmarks, save_baseline, load_baseline, compare
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks ingestion in a test database of the default database backend. Run it once per backend, "
+            "setting DATABASES['default']['TEST_NAME'] to benchmark sqlite on disk rather than in memory")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', default=','.join([str(size) for size in SIZES]),
+                    help="Comma separated response sizes of the end to end benchmarks"),
+        make_option('--tables', default=','.join(SYNC_MODELS), help="Comma separated fql tables to sync"),
+        make_option('--micro-only', action='store_true', default=False),
+        make_option('--sync-only', action='store_true', default=False),
+        make_option('--no-bulk', action='store_true', default=False, help="Save tuples one by one, like bulk=False"),
+        make_option('--staging', action='store_true', default=False, help="Sync through the staging table, like staging=True"),
+        make_option('--output', help="File the results are saved to as a json baseline"),
+        make_option('--compare', help="Baseline file to compare the results with, regressions make the command fail"),
+        make_option('--tolerance', type='float', default=0.2, help="Fraction a metric may get worse before it is a regression"),
+        make_option('--noinput', action='store_false', dest='interactive', default=True,
+                    help="Don't ask before destroying an existing test database"),
+    )
+
+    def handle(self, *args, **options):
+        baseline = options['compare'] and load_baseline(options['compare'])
+        sizes = [int(size) for size in options['sizes'].split(',') if size]
+        tables = [table.strip() for table in options['tables'].split(',') if table.strip()]
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=not options['interactive'])
+        try:
+            document = run_benchmarks(sizes, tables, micro=not options['sync_only'], sync=not options['micro_only'],
+                                      bulk=not options['no_bulk'], staging=options['staging'],
+                                      log=lambda message: self.stdout.write(message + '\n'))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['output']:
+            save_baseline(document, options['output'])
+            self.stdout.write("Results saved to %s\n" % options['output'])
+        if baseline:
+            try:
+                comparison = compare(document, baseline, options['tolerance'])
+            except ValueError, e:
+                raise CommandError(e)
+            regressions = 0
+            for name, metric, previous_value, value, regressed in comparison:
+                regressions += regressed
+                self.stdout.write("%-50s %-20s %12.2f -> %12.2f%s\n" % (name, metric, previous_value, value, regressed and '  REGRESSION' or ''))
+            if regressions:
+                raise CommandError("%d metrics regressed compared to %s" % (regressions, options['compare']))
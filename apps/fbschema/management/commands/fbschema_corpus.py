@@ -0,0 +1,48 @@
+import datetime
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from apps.fbschema.corpus import CORPUS_PROCESSES, CorpusPipeline
+from apps.fbschema.corpus_models import TermCounts
+from apps.fbschema.fql_engine import FqlError
+
+
+def parse_date(value):
+    return value and timezone.make_aware(datetime.datetime.strptime(value, "%Y-%m-%d"), timezone.get_default_timezone()) or None
+
+
+class Command(BaseCommand):
+    args = "table"
+    help = "Prints the most frequent terms of the text columns of an fql table of a system user"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--user', help="Username of the system user"),
+        make_option('--owner', type='int', help="Facebook id of the owner of the tuples"),
+        make_option('--since', help="YYYY-MM-DD, first day of the time window"),
+        make_option('--until', help="YYYY-MM-DD, day after the time window"),
+        make_option('--top', type='int', default=20),
+        make_option('--processes', type='int', default=CORPUS_PROCESSES),
+        make_option('--clear-cache', dest='clear_cache', action='store_true', default=False, help="Forget the cached term counts first"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give one table")
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError("No system user %s" % options['user'])
+        if options['clear_cache']:
+            TermCounts.objects.all().delete()
+        pipeline = CorpusPipeline(processes=options['processes'])
+        try:
+            terms = pipeline.top_terms(user, args[0], options['top'], owner=options['owner'],
+                                       since=parse_date(options['since']), until=parse_date(options['until']))
+        except (FqlError, ValueError), e:
+            raise CommandError(e)
+        for term, count in terms:
+            self.stdout.write(u"%s\t%d\n" % (term, count))
+        self.stdout.write("%(texts)d texts, %(cached)d cached, %(counted)d counted\n" % pipeline.stats)
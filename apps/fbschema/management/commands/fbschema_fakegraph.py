@@ -0,0 +1,45 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from apps.fbschema.fakegraph import FakeGraphServer, make_fake_graph
+
+'''
+Options passed on to make_fake_graph, when given
+'''
+GRAPH_OPTIONS = ('fixtures', 'me', 'friends', 'albums', 'photos', 'links', 'likes', 'posts', 'notifications',
+                 'revision', 'churn', 'seed', 'latency', 'row_latency', 'timeout_rate', 'max_rows')
+
+
+class Command(BaseCommand):
+    help = "Serves recorded or synthetic fql responses over http, a local stand-in for https://graph.facebook.com/fql"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--host', default='127.0.0.1'),
+        make_option('--port', type='int', default=8001),
+        make_option('--fixtures', help="Directory of responses recorded with settings.FBSCHEMA_RECORD_FIXTURES, synthetic data otherwise"),
+        make_option('--me', type='int', help="Facebook id of the synthetic viewer"),
+        make_option('--friends', type='int', help="Friends of the synthetic viewer"),
+        make_option('--albums', type='int', help="Albums per user"),
+        make_option('--photos', type='int', help="Photos per album"),
+        make_option('--links', type='int', help="Links per user"),
+        make_option('--likes', type='int', help="Likes per user"),
+        make_option('--posts', type='int', help="News feed posts of the viewer"),
+        make_option('--notifications', type='int', help="Notifications of the viewer"),
+        make_option('--revision', type='int', help="Simulated activity, each revision touches a churn fraction of the tuples"),
+        make_option('--churn', type='float'),
+        make_option('--seed', type='int'),
+        make_option('--latency', type='float', help="Mean seconds a request takes"),
+        make_option('--row-latency', dest='row_latency', type='float', help="Seconds added per returned tuple"),
+        make_option('--timeout-rate', dest='timeout_rate', type='float', help="Fraction of requests timing out"),
+        make_option('--max-rows', dest='max_rows', type='int', help="Responses above this many tuples fail as too large"),
+    )
+
+    def handle(self, *args, **options):
+        graph = make_fake_graph(dict([(name, options[name]) for name in GRAPH_OPTIONS if options.get(name) is not None]))
+        server = FakeGraphServer(graph, (options['host'], options['port']))
+        self.stdout.write("Serving fake graph at http://%s:%d/fql\n" % (options['host'], options['port']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
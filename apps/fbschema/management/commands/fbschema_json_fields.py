@@ -0,0 +1,66 @@
+import ast
+import json
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from apps.fbschema.bulk_utils import iterate_in_pages
+from apps.fbschema.edges import rebuild_edges
+from apps.fbschema.fields import JSONField
+from apps.fbschema.models import FacebookPhoto, FacebookLink, FacebookStream, FacebookUserProfile
+
+'''
+Models having json columns
+'''
+JSON_MODELS = (FacebookPhoto, FacebookLink, FacebookStream, FacebookUserProfile)
+
+
+def legacy_value(text):
+    '''
+    Value of a column stored before it held json, the python repr of the fql array or object. None if text is json
+    already or isn't a repr either
+    '''
+    try:
+        json.loads(text)
+        return None
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ("Rewrites arrays and objects stored as python reprs by earlier versions as json, then rebuilds the id edges "
+            "of the tables having edge_fields")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--no-edges', action='store_true', default=False, help="Only convert the json columns"),
+    )
+
+    def handle(self, *args, **options):
+        for model in JSON_MODELS:
+            names = [field.name for field in model._meta.fields if isinstance(field, JSONField)]
+            converted = 0
+            for values in iterate_in_pages(model.objects.values('id', *names)):
+                changes = {}
+                for name in names:
+                    if isinstance(values[name], basestring):
+                        value = legacy_value(values[name])
+                        if value is not None:
+                            changes[name] = value
+                if changes:
+                    # row_hash is left alone, the next sync of the tuple writes it again
+                    model.objects.filter(id=values['id']).update(**changes)
+                    converted += 1
+            self.stdout.write("%s: %d tuples converted\n" % (model.__name__, converted))
+
+        if options['no_edges']:
+            return
+        for model in JSON_MODELS:
+            if not getattr(model, 'edge_fields', None):
+                continue
+            for user in User.objects.filter(id__in=model.objects.values('user')):
+                self.stdout.write("%s of %s: %d edges\n" % (model.__name__, user, rebuild_edges(model, user)))
@@ -0,0 +1,23 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import models
+
+import apps.fbschema.models
+from apps.fbschema.models import FacebookUserProfile
+from apps.fbschema.search import SEARCH_ENABLED, create_search_index, rebuild_search, search_backend
+
+
+class Command(BaseCommand):
+    help = "Creates the full text index if the database has one and writes the search documents of all stored tuples again"
+
+    def handle(self, *args, **options):
+        create_search_index(None, app=apps.fbschema.models)
+        if not SEARCH_ENABLED:
+            self.stdout.write("settings.FBSCHEMA_SEARCH is off, syncs won't keep the index up to date\n")
+        self.stdout.write("Backend: %s\n" % search_backend())
+        self.stdout.write("profiles: %d tuples indexed\n" % rebuild_search(FacebookUserProfile))
+        for model in models.get_models():
+            if not getattr(model, 'fqlname', None) or not getattr(model, 'search_fields', None):
+                continue
+            for user in User.objects.filter(id__in=model.objects.values('user')):
+                self.stdout.write("%s of %s: %d tuples indexed\n" % (model.fqlname, user, rebuild_search(model, user)))
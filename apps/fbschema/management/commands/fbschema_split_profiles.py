@@ -0,0 +1,48 @@
+import datetime
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from apps.fbschema.models import PROFILE_MAX_AGE_HOURS, FacebookUser, FacebookUserProfile
+
+
+class Command(BaseCommand):
+    help = "Converts a user table stored before profiles were shared, one full tuple per viewer, into FacebookUserProfile " \
+           "tuples and the thin FacebookUser tuples pointing at them. Ids of the FacebookUser tuples are kept, so the " \
+           "foreign keys of the other tables stay valid"
+
+    def handle(self, *args, **options):
+        using = router.db_for_write(FacebookUser)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        user_table, profile_table = FacebookUser._meta.db_table, FacebookUserProfile._meta.db_table
+        cursor = connection.cursor()
+        columns = set([column[0] for column in connection.introspection.get_table_description(cursor, user_table)])
+        if FacebookUser._meta.get_field('profile').column in columns:
+            self.stdout.write("%s has been converted already\n" % user_table)
+            return
+
+        # creates the profile table
+        call_command('syncdb', interactive=False, database=using, verbosity=0)
+        cursor = connection.cursor()
+        for field in FacebookUser._meta.local_fields:
+            if field.column not in columns:
+                cursor.execute("ALTER TABLE %s ADD COLUMN %s %s NULL" % (qn(user_table), qn(field.column), field.db_type(connection)))
+
+        # the shared columns the old tuples hold, the most recently stored tuple of a uid provides its profile
+        shared = [field.column for field in FacebookUserProfile._meta.local_fields
+                  if field.column in columns and field.name not in ('id', 'uid', 'row_hash', 'refreshed')]
+        # refreshed long ago and without a row_hash, so the next sync downloads and writes every profile again
+        refreshed = timezone.now() - datetime.timedelta(hours=PROFILE_MAX_AGE_HOURS + 1)
+        with transaction.commit_on_success(using=using):
+            cursor.execute("INSERT INTO %s (uid, refreshed, %s) SELECT uid, %%s, %s FROM %s WHERE id IN (SELECT MAX(id) FROM %s GROUP BY uid)" % (
+                qn(profile_table), ', '.join([qn(column) for column in shared]), ', '.join([qn(column) for column in shared]),
+                qn(user_table), qn(user_table)), [connection.ops.value_to_db_datetime(refreshed)])
+            profiles = cursor.rowcount
+            cursor.execute("UPDATE %s SET %s = (SELECT id FROM %s WHERE %s.uid = %s.uid), row_hash = NULL" % (
+                qn(user_table), qn(FacebookUser._meta.get_field('profile').column), qn(profile_table), qn(profile_table), qn(user_table)))
+            users = cursor.rowcount
+        self.stdout.write("%d profiles created for %d %s tuples\n" % (profiles, users, user_table))
+        self.stdout.write("The columns %s of %s aren't read anymore and can be dropped\n" % (', '.join(shared), user_table))
@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from apps.fbschema.jobs import JOB_WORKERS, JOB_POLL_INTERVAL, start_workers, run_worker
+
+
+class Command(BaseCommand):
+    help = "Runs worker processes which download fql tables queued by the table views"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', default=JOB_WORKERS,
+                    help="Number of worker processes, defaults to settings.FBSCHEMA_JOB_WORKERS"),
+        make_option('--poll-interval', type='float', default=JOB_POLL_INTERVAL,
+                    help="Seconds an idle worker waits before looking for new jobs"),
+        make_option('--once', action='store_true', default=False,
+                    help="Run pending jobs in this process and exit once the queue is empty"),
+    )
+
+    def handle(self, *args, **options):
+        if options['once']:
+            run_worker(options['poll_interval'], once=True)
+        else:
+            start_workers(options['processes'], options['poll_interval'])
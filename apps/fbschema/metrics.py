@@ -0,0 +1,283 @@
+'''
+Instrumentation of the sync pipeline. save_update_delete times its phases ( fetch - waiting for the response,
+parse - cleaning tuples, diff - comparing them with the local tuples, write - inserts, updates, deletes and the
+changelog ), counts their queries and the tuples added, updated, left unchanged and deleted, per model and system
+user. Graph requests of jobs are timed into a latency histogram.
+
+Measurements add up in a registry of the process, which is flushed into SyncMetric totals at the end of every job
+( and every FBSCHEMA_METRICS_FLUSH_INTERVAL seconds during long ones ), so the metrics view serves what all worker
+processes measured, in the Prometheus text format.
+
+Every measurement is also sent as the metric_observed signal while it has listeners, callables listed in
+settings.FBSCHEMA_METRICS_HOOKS are connected to it.
+'''
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
+from django.db.backends.util import CursorWrapper
+from django.db.models import F
+from django.utils.importlib import import_module
+
+from apps.fbschema.signals import metric_observed
+from apps.fbschema.sync_models import SyncMetric
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = getattr(settings, 'FBSCHEMA_METRICS', True)
+METRICS_FLUSH_INTERVAL = getattr(settings, 'FBSCHEMA_METRICS_FLUSH_INTERVAL', 10)
+METRICS_HOOKS = getattr(settings, 'FBSCHEMA_METRICS_HOOKS', ())
+# Addresses allowed to read the metrics view without being staff
+METRICS_ALLOWED_IPS = getattr(settings, 'FBSCHEMA_METRICS_ALLOWED_IPS', ('127.0.0.1',))
+
+# Seconds
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+'''
+Metric families, name => (type, help)
+'''
+METRICS = {
+    'fbschema_syncs_total': ('counter', "save_update_delete calls"),
+    'fbschema_sync_rows_total': ('counter', "Response tuples by outcome, unchanged tuples are skipped"),
+    'fbschema_sync_phase_seconds_total': ('counter', "Seconds spent per phase of save_update_delete"),
+    'fbschema_sync_phase_queries_total': ('counter', "SQL queries run per phase of save_update_delete"),
+    'fbschema_jobs_total': ('counter', "Jobs run by status"),
+    'fbschema_job_seconds_total': ('counter', "Seconds jobs ran"),
+    'fbschema_api_request_seconds': ('histogram', "Latency of graph api requests"),
+}
+SYNC_PHASES = ('fetch', 'parse', 'diff', 'write')
+
+
+def format_labels(labels):
+    return ','.join(['%s="%s"' % (name, unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for name, value in sorted(labels.items())])
+
+
+class Registry(object):
+    '''
+    Totals measured by this process since its last flush, (series name, formatted labels) => value
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = defaultdict(float)
+        self.flushed = time.time()
+
+    def add(self, name, value, labels):
+        key = (name, format_labels(labels))
+        with self.lock:
+            self.values[key] += value
+
+    def inc(self, name, value=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        self.add(name, value, labels)
+        if metric_observed.has_listeners():
+            metric_observed.send(sender=None, name=name, kind='counter', value=value, labels=labels)
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        '''
+        Adds a value to a histogram
+        '''
+        if not METRICS_ENABLED:
+            return
+        for bound in buckets:
+            # every bucket is exposed, empty ones too
+            self.add('%s_bucket' % name, value <= bound and 1 or 0, dict(labels, le=bound))
+        self.add('%s_bucket' % name, 1, dict(labels, le='+Inf'))
+        self.add('%s_sum' % name, value, labels)
+        self.add('%s_count' % name, 1, labels)
+        if metric_observed.has_listeners():
+            metric_observed.send(sender=None, name=name, kind='histogram', value=value, labels=labels)
+
+    def flush(self):
+        '''
+        Adds the totals of this process to the SyncMetric totals
+        '''
+        with self.lock:
+            values, self.values = self.values, defaultdict(float)
+            self.flushed = time.time()
+        for (name, labels), value in values.items():
+            if SyncMetric.objects.filter(name=name, labels=labels).update(value=F('value') + value):
+                continue
+            try:
+                with transaction.commit_on_success():
+                    SyncMetric.objects.create(name=name, labels=labels, value=value)
+            except IntegrityError:
+                # created by another process in the meantime
+                SyncMetric.objects.filter(name=name, labels=labels).update(value=F('value') + value)
+
+    def maybe_flush(self):
+        if time.time() - self.flushed >= METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+
+registry = Registry()
+
+
+class CountingCursor(CursorWrapper):
+    '''
+    Cursor counting the statements it executes into a SyncTimer, without logging them like the debug cursor does
+    '''
+    def __init__(self, cursor, db, timer):
+        super(CountingCursor, self).__init__(cursor, db)
+        self.timer = timer
+
+    def execute(self, sql, params=()):
+        self.timer.executed += 1
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.timer.executed += 1
+        return self.cursor.executemany(sql, param_list)
+
+
+class SyncTimer(object):
+    '''
+    Wall time and queries per phase of one save_update_delete call. Queries are counted by wrapping the cursors the
+    connection hands out for the duration of the sync in a CountingCursor
+    '''
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.queries = defaultdict(int)
+        self.executed = 0
+
+    def __enter__(self):
+        if METRICS_ENABLED:
+            self.connection = connections[DEFAULT_DB_ALIAS]
+            # the timer of an enclosing sync, if any, keeps counting through the cursor it wrapped
+            self.wrapped = 'cursor' in vars(self.connection)
+            cursor = self.connection.cursor
+            self.connection.cursor = lambda: CountingCursor(cursor(), self.connection, self)
+            self.cursor = cursor
+        return self
+
+    def __exit__(self, *exc_info):
+        if METRICS_ENABLED:
+            if self.wrapped:
+                self.connection.cursor = self.cursor
+            else:
+                del self.connection.cursor
+
+    @contextmanager
+    def phase(self, name):
+        started, queries = time.time(), self.executed
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.time() - started
+            self.queries[name] += self.executed - queries
+
+    def timed(self, iterable, name):
+        '''
+        Yields the items of iterable, the time spent waiting for them counting as given phase
+        '''
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = iterator.next()
+                except StopIteration:
+                    return
+            yield item
+
+
+def record_sync(model, user, stats, timer):
+    '''
+    Adds the outcome of a save_update_delete call to the registry
+    '''
+    labels = {'model': model.fqlname, 'user': user.id}
+    registry.inc('fbschema_syncs_total', **labels)
+    for action in ('added', 'updated', 'unchanged', 'deleted'):
+        registry.inc('fbschema_sync_rows_total', getattr(stats, action), action=action, **labels)
+    for phase in SYNC_PHASES:
+        registry.inc('fbschema_sync_phase_seconds_total', timer.seconds[phase], phase=phase, **labels)
+        registry.inc('fbschema_sync_phase_queries_total', timer.queries[phase], phase=phase, **labels)
+    registry.maybe_flush()
+
+
+def record_job(job):
+    labels = {'task': job.task, 'user': job.user_id}
+    registry.inc('fbschema_jobs_total', status=job.status, **labels)
+    if job.started and job.finished:
+        registry.inc('fbschema_job_seconds_total', (job.finished - job.started).total_seconds(), **labels)
+    registry.flush()
+
+
+class InstrumentedGraph(object):
+    '''
+    Times the fql and batch_fql requests of a graph, anything else is passed through. apps.fbschema.streaming
+    reports the requests it sends itself through observe_request
+    '''
+    def __init__(self, graph, user):
+        self.graph = graph
+        self.user = user
+
+    def __getattr__(self, name):
+        return getattr(self.graph, name)
+
+    def observe_request(self, method, seconds, outcome='ok'):
+        registry.observe('fbschema_api_request_seconds', seconds, method=method, outcome=outcome, user=self.user.id)
+
+    def timed_request(self, method, *args, **kwargs):
+        started = time.time()
+        try:
+            response = getattr(self.graph, method)(*args, **kwargs)
+        except Exception:
+            self.observe_request(method, time.time() - started, 'error')
+            raise
+        self.observe_request(method, time.time() - started)
+        return response
+
+    def fql(self, query, **kwargs):
+        return self.timed_request('fql', query, **kwargs)
+
+    def batch_fql(self, queries_dict):
+        return self.timed_request('batch_fql', queries_dict)
+
+
+def series_order(metric):
+    # buckets in increasing order, +Inf last
+    name, labels, value = metric
+    le = None
+    for label in labels.split(','):
+        if label.startswith('le="'):
+            le = label[4:-1]
+    return (name, labels.replace('le="%s"' % le, '') if le else labels, float('inf') if le == '+Inf' else float(le or 0))
+
+
+def family_of(name):
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)]
+    return name
+
+
+def render():
+    '''
+    Totals of all processes in the Prometheus text format
+    '''
+    registry.flush()
+    families = defaultdict(list)
+    for name, labels, value in SyncMetric.objects.values_list('name', 'labels', 'value'):
+        families[family_of(name)].append((name, labels, value))
+    lines = []
+    for family in sorted(families):
+        metric_type, help = METRICS.get(family, ('untyped', ''))
+        lines.append('# HELP %s %s' % (family, help))
+        lines.append('# TYPE %s %s' % (family, metric_type))
+        for name, labels, value in sorted(families[family], key=series_order):
+            lines.append('%s{%s} %s' % (name, labels, repr(value) if value != int(value) else int(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def connect_hooks():
+    for path in METRICS_HOOKS:
+        module, name = path.rsplit('.', 1)
+        metric_observed.connect(getattr(import_module(module), name), dispatch_uid=path)
+
+
+connect_hooks()
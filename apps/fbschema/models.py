@@ -1,21 +1,42 @@
+import datetime
+import itertools
 import logging
+import re
 
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
+from django.utils import timezone
 
 from apps.fbschema.struct_models import *
+from apps.fbschema.fields import JSONField
+from apps.fbschema.sync_models import *
+from apps.fbschema.history_models import *
+from apps.fbschema.edge_models import *
+from apps.fbschema.aggregate_models import *
+from apps.fbschema.search_models import *
+from apps.fbschema.corpus_models import *
+from apps.fbschema.signals import rows_changed
+from apps.fbschema.bulk_utils import BULK_CHUNK_SIZE, bulk_update, chunked
+from apps.fbschema.streaming import MemoryCeiling
+from apps.fbschema.metrics import SyncTimer, record_sync
 from apps.fbschema.utils import get_fql_from_model
 
-from apps.fbschema.utils import compare_keys_with_fields
-
 logger = logging.getLogger(__name__)
 
+# Shared profiles downloaded by any system user less than this many hours ago are not downloaded again for friends,
+# only the columns depending on the viewer are
+PROFILE_MAX_AGE_HOURS = getattr(settings, 'FBSCHEMA_PROFILE_MAX_AGE_HOURS', 24)
+
 class BaseFbModel(models.Model):
     '''
     Abstract class to define some common method helping us to generate queries 
     '''
-    ignore_fields=['id', 'user']
+    ignore_fields=['id', 'user', 'row_hash']
+
+    ## Django Application specific fields
+    row_hash            = models.CharField( max_length=40, blank=True, null=True, editable=False, help_text="sha1 of the cleaned field values, see IngestPlan.row_hash" )
 
     @classmethod
     def fql_query(self, clause):
@@ -26,34 +47,45 @@ class BaseFbModel(models.Model):
         return get_fql_from_model(self, clause)
 
     @classmethod
-    def fql_query_me(self):
+    def fql_query_me(self, since=None):
         '''
         Returns the fql query using fql_query method. Clause is specific to return data tuples which are 
         associated directly with user itself, i.e. owner = me() in fql
         '''
-        return self.fql_query(self.me_clause)
+        return self.fql_query(self.since_clause(self.me_clause, since))
 
     @classmethod
-    def fql_query_my_friends(self, friend_uid):
+    def fql_query_my_friends(self, friend_uid, since=None):
         '''
         Returns the fql query using fql_query method. Clause is specific to return data tuples which are 
         associated directly with user's freinds, i.e. owner = %d  in fql
         '''
-        return self.fql_query(self.my_friend_clause % friend_uid)
+        return self.fql_query(self.since_clause(self.my_friend_clause % friend_uid, since))
+
+    @classmethod
+    def since_clause(self, clause, since=None):
+        '''
+        Adds a filter on model's incremental_field to clause so that only tuples changed since given unix timestamp are
+        returned, i.e. WHERE owner=me() limit 5000 => WHERE owner=me() AND modified >= 1370000000 limit 5000
+        '''
+        if since is None:
+            return clause
+        match = re.match(r'^(.*?)(\s+limit\s+\d+)?\s*$', clause, re.IGNORECASE | re.DOTALL)
+        return "%s AND %s >= %d%s" % (match.group(1), self.incremental_field, since, match.group(2) or '')
     
     @classmethod
     def local_fql_query(self, request, context_uid):
+        from apps.fbschema.resolvers import get_resolver
         '''
         Returns user related tuple from database model if no friend_uid is mentioned
         Returns user's friend related tuple from database model if friend_uid has ben mentioned
         These returned tuple will be used to generate model_sets so that we can compare it with result sets
         '''
         if not context_uid:
-            logger.info("context_uid is None due to owner_identifier=ONLY_SESSION_USER, fetching last `facebook_row_limit` tuples to compare with result data set")
-            print("context_uid is None due to owner_identifier=ONLY_SESSION_USER, fetching last `facebook_row_limit` tuples to compare with result data set")
-            return self.objects.all()[:self.facebook_row_limit]
+            logger.debug("context_uid is None due to owner_identifier=ONLY_SESSION_USER, fetching last `facebook_row_limit` tuples to compare with result data set")
+            return self.objects.filter(user=request.user).order_by('-id')[:self.facebook_row_limit]
 
-        facebookuser = FacebookUser.objects.get(user=request.user, uid=context_uid)
+        facebookuser = get_resolver(request).resolve(self._meta.get_field(self.owner_identifier), context_uid)
         kwargs = { self.owner_identifier : facebookuser }
         return self.objects.filter(user=request.user, **kwargs)
 
@@ -62,102 +94,275 @@ class BaseFbModel(models.Model):
         '''
         Returns the class name of primary identifier for a particular model, useful when we want to perform cleaning operation
         '''
-        return [ field for field in self._meta.fields if getattr(field, 'name') == self.primary_identifier ][0]
+        from apps.fbschema.ingest import get_ingest_plan
+        return get_ingest_plan(self).primary_field
 
     @classmethod
     def prepare_dict(self, response_data_dict, request=None):
-        from apps.fbschema.parse_utils import parse_clean_field_value
+        from apps.fbschema.ingest import get_ingest_plan
         '''
         Receives the response from fql graph query. Cleans/Parses the data and returns a valid
         dict that can be used to create and save a tuple/data-record.
         Applied operations on data in this process is in context with the model in concern, hence
         it should be called with proper database model, otherwise compare key function will fail
+        For whole responses use get_ingest_plan(model).prepare_rows, which compares keys once per response
         '''
-        if not compare_keys_with_fields(self, response_data_dict.keys()): #TODO: This compare test is happening for each tuple, can we do better ?
-            raise ValueError #TODO: Use proper exception
-
-        model = self # Just to make code more readable
-
-        data_dict = {}
-        fields = [field for field in model._meta.fields if getattr(field, 'name') not in model.ignore_fields]
-        for field in fields:
-            field_name = getattr(field, 'name')
-            key = field_name
-            value = parse_clean_field_value(field, response_data_dict[key], request)
-            data_dict[key] = value
-
-        return data_dict
+        plan = get_ingest_plan(self)
+        plan.check_keys(response_data_dict.keys())
+        return plan.prepare(response_data_dict, request)
 
     @classmethod
-    def save_update_delete(self, request, response_data, stream_nature=False):
-        from apps.fbschema.parse_utils import parse_clean_field_value
+    def save_update_delete(self, request, response_data, stream_nature=False, bulk=False, chunk_size=None, limit=None, staging=None):
+        from apps.fbschema.ingest import SyncStats
+        from apps.fbschema.resolvers import get_resolver
+        from apps.fbschema.staging import STAGING_SYNC, StagedSync, can_stage
         ''' 
         Main function which saves, updates and deletes on updated result sets 
         This function is always called with subclasses 
+        @response_data = List of response tuples or any iterable yielding them, like apps.fbschema.streaming.stream_fql. Tuples are
+                         cleaned, compared and written chunk by chunk so only one chunk of them is held in memory at a time
         @stream_nature = For example facebook stream is a stream of incoming items. If we compare last 'n' number of database items with incoming
                          response items and if we don't define stream_nature then existing code will delete those old database items assuming 
                          they don't exist, hence is a stream in which we always save and update, we never delete
         @ONLY_SESSION_USER = local_fql_query uses 'owner_identifier' so that it can bring database items in context to compare with response items.
                              context_uid is usally me() or a freind's uid, but in some tables only session user is allowed so there is no need of 
-                             context_uid so we return 'n' last number of records OR all records
+                             context_uid so we return 'n' last number of records OR all records. Response tuples older than those are
+                             looked up by key chunk by chunk ( see load_local_data ), so they are updated or left alone, not added again
+        @bulk = Writes new tuples with chunked bulk_create and updated tuples with multi-row UPDATE statements, one transaction per chunk
+                (see bulk_save_update). Otherwise every tuple is saved on its own
+        @chunk_size = Number of tuples cleaned and written per chunk, defaults to settings.FBSCHEMA_BULK_CHUNK_SIZE. It shrinks while the
+                      process is above settings.FBSCHEMA_INGEST_MEMORY_LIMIT
+        @limit = Row limit of the query, a response reaching it may be truncated so nothing is deleted
+        @staging = Compares and writes the response in SQL through a staging table and the native upsert of the database rather than
+                   in python, see apps.fbschema.staging. Defaults to settings.FBSCHEMA_STAGING_SYNC, bulk doesn't apply then
+        Existing tuples are only updated when the content hash of the response tuple differs from the stored row_hash.
+        Stored tuples of the owner missing from a complete response ( not stream_nature, below limit ) are deleted and
+        given to rows_changed listeners. Photos of a deleted album are kept with a NULL aid rather than deleted in
+        cascade, which the listeners would never hear of.
+        Returns a SyncStats with the number of added, updated, unchanged and deleted tuples
         '''
-        if self.owner_identifier == "ONLY_SESSION_USER":
-            context_uid = None
-        else:
-            context_uid = response_data[0][self.owner_identifier]
-            #Assumptions response_data (list) has some values (dict)
-
-        model_data_list = self.local_fql_query(request, context_uid) 
+        if staging is None:
+            staging = STAGING_SYNC
+        with SyncTimer() as timer:
+            chunk_size = chunk_size or BULK_CHUNK_SIZE
+            response_data = iter(response_data)
+            try:
+                with timer.phase('fetch'):
+                    first = response_data.next()
+            except StopIteration:
+                return SyncStats()
+            response_data = itertools.chain([first], response_data)
+
+            if self.owner_identifier == "ONLY_SESSION_USER":
+                context_uid = None
+            else:
+                context_uid = first[self.owner_identifier]
+
+            if staging and can_stage(self):
+                stats = StagedSync(self, request, chunk_size, timer).sync(response_data, context_uid, stream_nature, limit)
+            else:
+                stats = self.diff_in_python(request, response_data, context_uid, stream_nature, bulk, chunk_size, limit, timer)
+
+            #Foreign keys resolved earlier in this request may point to tuples of this table which have just been written
+            get_resolver(request).clear(self)
+
+        record_sync(self, request.user, stats, timer)
+        logger.info("%s sync of %s: %s" % (self.fqlname, request.user, stats))
+        return stats
 
+    @classmethod
+    def diff_in_python(self, request, response_data, context_uid, stream_nature, bulk, chunk_size, limit, timer):
+        from apps.fbschema.ingest import SyncStats
+        '''
+        Python diff of save_update_delete, keys and content hashes of the local tuples are loaded into a dict which the
+        response is compared with chunk by chunk
+        '''
         primary_identifier = self.primary_identifier
-    
-        #Response data set of 'primary key', we also need to make sure that data we are compared are 'cleaned'
-        response_data_set = set([parse_clean_field_value( self.primary_identifier_class(), response_data_dict[primary_identifier] ) \
-                                for response_data_dict in response_data])
-    
+
+        #Only ids, keys and content hashes of the local tuples are needed to compare them with the response, key => (id, row_hash)
+        with timer.phase('diff'):
+            local_data = dict([(key, (tuple_id, row_hash)) for tuple_id, key, row_hash in \
+                               self.local_fql_query(request, context_uid).values_list('id', primary_identifier, 'row_hash').iterator()])
+
         #Model data set of 'primary key'
-        model_data_set = set([getattr(model_data, primary_identifier) for model_data in model_data_list])
+        model_data_set = set(local_data.keys())
+        #Response data set of 'primary key', filled chunk by chunk with 'cleaned' keys
+        response_data_set = set()
+
+        stats = SyncStats()
+        rows = 0
+        for chunk in timer.timed(MemoryCeiling().chunks(response_data, chunk_size), 'fetch'):
+            rows += len(chunk)
+            stats += self.save_update_chunk(request, chunk, local_data, response_data_set, bulk, chunk_size, timer)
    
-        #Delete list
+        #Delete set
         if stream_nature:
-            delete_list = []
+            delete_set = set()
+        elif limit is not None and rows >= limit:
+            logger.info("%s response of %d tuples may be truncated, nothing deleted" % (self.fqlname, rows))
+            delete_set = set()
         else:
-            delete_list = list(model_data_set.difference(response_data_set))
-        #Add List
-        add_list = list(response_data_set.difference(model_data_set))
-        #Update List
-        update_list = list(response_data_set.intersection(model_data_set))
-        print response_data_set
-        print model_data_set
-        print add_list
-        print update_list
-        
+            delete_set = model_data_set.difference(response_data_set)
+
+        if delete_set:
+            #Delete here
+            notify = rows_changed.has_listeners(self)
+            for chunk in chunked(list(delete_set), chunk_size):
+                with timer.phase('write'):
+                    if notify:
+                        old_values = self.stored_values(request, chunk, chunk_size)
+                    self.objects.filter(id__in=[local_data[key][0] for key in chunk]).delete()
+                    if notify:
+                        rows_changed.send(sender=self, request=request, added=[], updated=[], deleted=old_values.values())
+        stats.deleted = len(delete_set)
+        return stats
 
-        for response_data_dict in response_data:
-            data_dict = self.prepare_dict(response_data_dict, request) 
-            if data_dict[primary_identifier] in add_list:
-                #Add here
-                try:
-                    data_tuple = self(user=request.user, **data_dict) 
-                    data_tuple.save()
-                except IntegrityError:
-                    '''
-                    There are some cases where due to facebook data nature we expect integrity error within ids being saved.
-                    This exception should be handled by that particular model which is expecting this case.
-                    A use case : FacebookStream
-                    with some post_id : 'x' changed his profile picture
-                    with same post_id : 'x' and seven others changed profile pictures
-                    '''
-                    logger.info("Integrity Exception handled, Model = %s" % self.__class__)
-                    print("Integrity Exception handled, Model = %s" % self.__class__)
-                    data_tuple = self.handle_integrity_exception(request, data_dict)
-                    data_tuple.save()
-            elif data_dict[primary_identifier] in update_list:
-                #Update here
-                kwargs = { primary_identifier : data_dict[primary_identifier] }
-                data_tuple = self.objects.get(user=request.user, **kwargs)
-                data_tuple = self(user=request.user, id=data_tuple.id, **data_dict) 
-                data_tuple.save()
+    @classmethod
+    def save_update_chunk(self, request, chunk, local_data, response_data_set, bulk, chunk_size, timer=None):
+        from apps.fbschema.ingest import get_ingest_plan, SyncStats
+        '''
+        Cleans, compares and writes one chunk of response tuples for save_update_delete. local_data and response_data_set are
+        kept up to date for the following chunks. timer, a SyncTimer, gets the time of the parse, diff and write phases
+        '''
+        timer = timer or SyncTimer()
+        primary_identifier = self.primary_identifier
+
+        #Every tuple is cleaned once, with the model's ingest plan
+        with timer.phase('parse'):
+            data_dicts = get_ingest_plan(self).prepare_rows(chunk, request)
+
+        with timer.phase('diff'):
+            chunk_data_set = set([data_dict[primary_identifier] for data_dict in data_dicts])
+            #Session user tables were loaded with their last facebook_row_limit tuples only, older ones are looked up by key
+            if self.owner_identifier == "ONLY_SESSION_USER":
+                self.load_local_data(request, chunk_data_set.difference(local_data), local_data, chunk_size)
+            #Add set
+            add_set = chunk_data_set.difference(local_data)
+            #Update set, tuples whose content hash is unchanged are left alone
+            update_set = set([data_dict[primary_identifier] for data_dict in data_dicts \
+                              if data_dict[primary_identifier] in local_data and data_dict['row_hash'] != local_data[data_dict[primary_identifier]][1]])
+            #Tuples seen in an earlier chunk count once
+            unchanged_set = chunk_data_set.intersection(local_data).difference(update_set).difference(response_data_set)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s chunk of %s, add %s update %s" % (self.fqlname, request.user, list(add_set), list(update_set)))
+
+        with timer.phase('write'):
+            #Listeners of rows_changed (e.g. the changelog) get the values tuples had before being updated
+            notify = rows_changed.has_listeners(self)
+            if notify:
+                old_values = self.stored_values(request, update_set, chunk_size)
+
+            if bulk:
+                self.bulk_save_update(request, data_dicts, add_set, update_set, chunk_size)
+            else:
+                for data_dict in data_dicts:
+                    if data_dict[primary_identifier] in add_set:
+                        #Add here
+                        self.save_new(request, data_dict)
+                    elif data_dict[primary_identifier] in update_set:
+                        #Update here, tuples added by an earlier chunk have no known id yet
+                        tuple_id = local_data[data_dict[primary_identifier]][0]
+                        if tuple_id is None:
+                            kwargs = { primary_identifier : data_dict[primary_identifier] }
+                            tuple_id = self.objects.filter(user=request.user, **kwargs).values_list('id', flat=True)[0]
+                        data_tuple = self(user=request.user, id=tuple_id, **data_dict) 
+                        data_tuple.save()
+
+            data_dict_map = dict([(data_dict[primary_identifier], data_dict) for data_dict in data_dicts])
+            if notify:
+                rows_changed.send(sender=self, request=request,
+                                  added=[data_dict_map[key] for key in add_set],
+                                  updated=[(old_values[key], data_dict_map[key]) for key in update_set if key in old_values],
+                                  deleted=[])
+
+        for key in add_set.union(update_set):
+            local_data[key] = (local_data.get(key, (None, None))[0], data_dict_map[key]['row_hash'])
+        response_data_set.update(chunk_data_set)
+        return SyncStats(added=len(add_set), updated=len(update_set), unchanged=len(unchanged_set))
+
+    @classmethod
+    def load_local_data(self, request, keys, local_data, chunk_size=None):
+        '''
+        Adds the stored tuples of request.user among given primary_identifier values to local_data, key => (id, row_hash)
+        '''
+        for chunk in chunked(list(keys), chunk_size or BULK_CHUNK_SIZE):
+            kwargs = { "%s__in" % self.primary_identifier : chunk }
+            local_data.update([(key, (tuple_id, row_hash)) for tuple_id, key, row_hash in \
+                               self.objects.filter(user=request.user, **kwargs).values_list('id', self.primary_identifier, 'row_hash')])
+
+    @classmethod
+    def stored_values(self, request, keys, chunk_size=None):
+        from apps.fbschema.ingest import get_ingest_plan
+        '''
+        Returns the stored values of the plan fields for given primary_identifier values, key => { field name : value }.
+        Foreign keys are given as ids, json columns decoded
+        '''
+        plan = get_ingest_plan(self)
+        stored = {}
+        for chunk in chunked(list(keys), chunk_size or BULK_CHUNK_SIZE):
+            kwargs = { "%s__in" % self.primary_identifier : chunk }
+            for values in self.objects.filter(user=request.user, **kwargs).values(*plan.field_names):
+                stored[values[self.primary_identifier]] = plan.load_values(values)
+        return stored
+
+    @classmethod
+    def save_new(self, request, data_dict):
+        '''
+        Saves a single new tuple, falling back to handle_integrity_exception of the model
+        '''
+        try:
+            data_tuple = self(user=request.user, **data_dict) 
+            data_tuple.save()
+        except IntegrityError:
+            '''
+            There are some cases where due to facebook data nature we expect integrity error within ids being saved.
+            This exception should be handled by that particular model which is expecting this case.
+            A use case : FacebookStream
+            with some post_id : 'x' changed his profile picture
+            with same post_id : 'x' and seven others changed profile pictures
+            '''
+            logger.info("Integrity Exception handled, Model = %s" % self.__name__)
+            data_tuple = self.handle_integrity_exception(request, data_dict)
+            data_tuple.save()
+
+    @classmethod
+    def bulk_save_update(self, request, data_dicts, add_set, update_set, chunk_size=None):
+        from apps.fbschema.ingest import get_ingest_plan
+        '''
+        Bulk write path of save_update_delete. Classification is done by the caller, here
+        1) New tuples are inserted by bulk_create, one transaction per chunk. If a chunk hits an IntegrityError it is
+           rolled back and its tuples are saved one by one through save_new, so handle_integrity_exception still applies
+        2) Existing tuples get their ids in one query per chunk and are written by multi-row UPDATE statements
+        '''
+        chunk_size = chunk_size or BULK_CHUNK_SIZE
+        primary_identifier = self.primary_identifier
+
+        #Facebook may return the same identifier twice (see save_new), last one wins as it would when saving one by one
+        add_dicts = {}
+        update_dicts = {}
+        for data_dict in data_dicts:
+            key = data_dict[primary_identifier]
+            if key in add_set:
+                add_dicts[key] = data_dict
+            elif key in update_set:
+                update_dicts[key] = data_dict
+
+        for chunk in chunked(add_dicts.values(), chunk_size):
+            try:
+                with transaction.commit_on_success():
+                    self.objects.bulk_create([self(user=request.user, **data_dict) for data_dict in chunk])
+            except IntegrityError:
+                logger.info("Integrity Exception in bulk insert, saving chunk one by one, Model = %s" % self.__name__)
+                for data_dict in chunk:
+                    self.save_new(request, data_dict)
+
+        fields = get_ingest_plan(self).write_fields
+        for chunk in chunked(update_dicts.keys(), chunk_size):
+            kwargs = { "%s__in" % primary_identifier : chunk }
+            with transaction.commit_on_success():
+                id_map = dict(self.objects.filter(user=request.user, **kwargs).values_list(primary_identifier, 'id'))
+                data_tuples = [self(user=request.user, id=id_map[key], **update_dicts[key]) for key in chunk if key in id_map]
+                bulk_update(self, data_tuples, fields, chunk_size)
     
 
     class Meta:
@@ -182,6 +387,9 @@ class FacebookAlbum(BaseFbModel):
     owner_identifier    = "owner"
     me_clause           = "WHERE owner=me()"
     my_friend_clause    = "WHERE owner=%d" 
+    incremental_field   = "modified" # tuples changed since last sync are queried by this field, see apps.fbschema.incremental
+    ranked_by           = {"likes": ("like_info", "like_count"), "comments": ("comment_info", "comment_count")} # leaderboards, see apps.fbschema.aggregates
+    counted_by          = ("owner", "type") # tuples per owner and per type, see apps.fbschema.aggregates
     
     ## Django Application specific fields
     user                = models.ForeignKey(User, help_text="Data belongs with this system user: Viewer") 
@@ -237,12 +445,16 @@ class FacebookPhoto(BaseFbModel):
     owner_identifier    = "owner" # for some models object_id is going to behave like owner
     me_clause           = "WHERE owner=me() limit 5000"
     my_friend_clause    = "WHERE owner=%d limit 5000" 
+    incremental_field   = "modified" # tuples changed since last sync are queried by this field, see apps.fbschema.incremental
+    ranked_by           = {"likes": ("like_info", "like_count"), "comments": ("comment_info", "comment_count")} # leaderboards, see apps.fbschema.aggregates
+    counted_by          = ("owner",)
+    search_fields       = ("caption",) # full text search, see apps.fbschema.search
     
     ## Django Application specific fields
     user                = models.ForeignKey(User, help_text="Data belongs with this system user: Viewer") 
 
     ## Fb Schema specific fields
-    aid                 = models.ForeignKey( FacebookAlbum, blank=True, null=True, related_name="photos", help_text="The ID of the album containing the \
+    aid                 = models.ForeignKey( FacebookAlbum, blank=True, null=True, on_delete=models.SET_NULL, related_name="photos", help_text="The ID of the album containing the \
                           photo being queried. The aid cannot be longer than 50 characters.")
 
     aid_cursor          = models.CharField( max_length=100, blank=True, null=True, help_text="A cursor used to paginated through \
@@ -258,13 +470,13 @@ class FacebookPhoto(BaseFbModel):
     can_delete          = models.NullBooleanField( blank=True, null=True, help_text="true if the viewer is able to delete the photo" )
     can_tag             = models.NullBooleanField( blank=True, null=True, help_text="true if the viewer is able to tag the photo" )
     caption             = models.TextField( blank=True, null=True, help_text="The caption for the photo being queried")
-    caption_tags        = models.TextField( blank=True, null=True, help_text="An array indexed by offset of arrays of the tags in the \
+    caption_tags        = JSONField( blank=True, null=True, help_text="An array indexed by offset of arrays of the tags in the \
                           caption of the photo, containing the id of the tagged object, the name of the tag, the offset of where the \
                           tag occurs in the message and the length of the tag.")
     comment_info        = models.ForeignKey( StructCommentInfo, blank=True, null=True, help_text="The comment information of the photo \
                           being queried. This is an object containing can_comment and comment_count")
     created             = models.DateTimeField( blank=True, null=True, help_text="The date when the photo being queried was added." )
-    images              = models.TextField( blank=True, null=True, help_text="An array of objects containing width, height, source each \
+    images              = JSONField( blank=True, null=True, help_text="An array of objects containing width, height, source each \
                           representing the various photo sizes.")
     like_info           = models.ForeignKey( StructLikeInfo, blank=True, null=True )
     link                = models.CharField( max_length=500, blank=True, null=True, help_text="The URL to the page containing the photo being queried.")
@@ -307,6 +519,9 @@ class FacebookLink(BaseFbModel):
     owner_identifier    = "owner" # for some models object_id is going to behave like owner
     me_clause           = "WHERE owner=me() limit 5000"
     my_friend_clause    = "WHERE owner=%d limit 5000" 
+    incremental_field   = "created_time" # tuples changed since last sync are queried by this field, see apps.fbschema.incremental
+    counted_by          = ("owner",) # tuples per owner, see apps.fbschema.aggregates
+    search_fields       = ("title", "summary", "owner_comment") # full text search, see apps.fbschema.search
     
     ## Django Application specific fields
     user                = models.ForeignKey(User, help_text="Data belongs with this system user: Viewer") 
@@ -317,7 +532,7 @@ class FacebookLink(BaseFbModel):
     caption             = models.TextField( blank=True, null=True, help_text="The caption of the link")
     comment_info        = models.ForeignKey( StructCommentInfo, blank=True, null=True, help_text="The comment information of the link being queried." )
     created_time        = models.DateTimeField( blank=True, null=True, help_text="The time the user posted the link." )
-    image_urls          = models.TextField( blank=True, null=True, help_text="The URLs to the images associated with the link, \
+    image_urls          = JSONField( blank=True, null=True, help_text="The URLs to the images associated with the link, \
                           as taken from the site's link tag." )
     like_info           = models.ForeignKey( StructLikeInfo, blank=True, null=True ) #Skipping privacy struct as of now
     link_id             = models.BigIntegerField( db_index=True, help_text="The unique identifier for the link." ) 
@@ -347,6 +562,7 @@ class FacebookNotification(BaseFbModel):
     #as compared with photo or album objects
     facebook_row_limit  = 500 #TODO : enough for now
     me_clause           = "WHERE recipient_id=me()"
+    search_fields       = ("title_text", "body_text") # full text search, see apps.fbschema.search
     
     ## Django Application specific fields
     user                = models.ForeignKey(User, help_text="Data belongs with this system user: Viewer") 
@@ -390,6 +606,10 @@ class FacebookStream(BaseFbModel):
     owner_identifier    = "ONLY_SESSION_USER" # for some models object_id is going to behave like owner
     facebook_row_limit  = 50
     me_clause           = "WHERE filter_key in (SELECT filter_key FROM stream_filter WHERE uid=me())"
+    incremental_field   = "updated_time" # tuples changed since last sync are queried by this field, see apps.fbschema.incremental
+    edge_fields         = ("tagged_ids", "with_tags") # id lists kept as IdEdge tuples as well, see apps.fbschema.edges
+    counted_by          = ("type",) # tuples per type, see apps.fbschema.aggregates
+    search_fields       = ("message", "description") # full text search, see apps.fbschema.search
 
     '''
     On facebookstream table there is no owner_identifier that means -
@@ -400,21 +620,21 @@ class FacebookStream(BaseFbModel):
     user                = models.ForeignKey(User, help_text="Data belongs with this system user: Viewer") 
 
     ## Fb Schema specific fields
-    action_links        = models.TextField( blank=True, null=True, help_text="An array containing the text and URL for each action link" )
+    action_links        = JSONField( blank=True, null=True, help_text="An array containing the text and URL for each action link" )
     actor_id            = models.BigIntegerField( blank=True, null=True, help_text="The ID of the user, page, group, or event that published the post" )
     attribution         = models.CharField( max_length=500, blank=True, null=True, help_text="For posts published by apps, the full name of that app" )
     created_time        = models.DateTimeField( blank=True, null=True, help_text="The time the post was published" )
     description         = models.TextField( blank=True, null=True, help_text="Text of stories not intentionally generated by users, \
                           such as those generated when two users become friends. You must have the 'Include recent activity stories'\
                           migration enabled in your app to retrieve this field" )
-    description_tags    = models.TextField( blank=True, null=True, help_text="The list of tags in the post description" )
+    description_tags    = JSONField( blank=True, null=True, help_text="The list of tags in the post description" )
     expiration_timestamp= models.DateTimeField( blank=True, null=True, help_text="UNIX timestamp of when the offer expires" )
     filter_key          = models.CharField( max_length=500, blank=True, null=True, help_text="The filter key to fetch data with" )
     impressions         = models.IntegerField( blank=True, null=True, help_text="Number of impressions of this post." ) 
     is_hidden           = models.NullBooleanField( blank=True, null=True, help_text="Whether a post has been set to hidden" )
     is_published        = models.NullBooleanField( blank=True, null=True, help_text="Whether the post is published" )
     message             = models.TextField( blank=True, null=True, help_text="The message written in the post" )
-    message_tags        = models.TextField( blank=True, null=True, help_text="The list of tags in the post mssage" )
+    message_tags        = JSONField( blank=True, null=True, help_text="The list of tags in the post mssage" )
     parent_post_id      = models.CharField( max_length=500, blank=True, null=True, help_text="ID of the parent post" ) 
     permalink           = models.CharField( max_length=500, blank=True, null=True, help_text="The URL of the post" )
     place               = models.BigIntegerField( blank=True, null=True, help_text="ID of the place associated with the post" ) 
@@ -423,7 +643,7 @@ class FacebookStream(BaseFbModel):
     source_id           = models.BigIntegerField( db_index=True, blank=True, null=True, help_text="The ID of the user, page, group, \
                           or event whose wall the post is on" ) 
     subscribed          = models.NullBooleanField( blank=True, null=True, help_text="Whether user is subscribed to the post" )
-    tagged_ids          = models.TextField( blank=True, null=True, help_text="An array of IDs tagged in the message of the post." )
+    tagged_ids          = JSONField( blank=True, null=True, help_text="An array of IDs tagged in the message of the post." )
     target_id           = models.BigIntegerField( db_index=True, blank=True, null=True, help_text="The user, page, group, or event to whom the post was directed" )
     timeline_visibility = models.CharField( max_length=500, blank=True, null=True, help_text="Timeline visibility information of the post" )
     type                = models.IntegerField( blank=True, null=True, help_text="The type of this story" ) 
@@ -432,7 +652,7 @@ class FacebookStream(BaseFbModel):
     via_id              = models.BigIntegerField( blank=True, null=True, help_text="ID of the user or Page the post was shared from" )
     viewer_id           = models.BigIntegerField( blank=True, null=True, help_text="The ID of the current session user" )
     with_location       = models.NullBooleanField( blank=True, null=True, help_text="ID of the location associated with the post" )
-    with_tags           = models.TextField( blank=True, null=True, help_text="An array of IDs of entities (e.g. users) tagged in this post" )
+    with_tags           = JSONField( blank=True, null=True, help_text="An array of IDs of entities (e.g. users) tagged in this post" )
     xid                 = models.BigIntegerField( blank=True, null=True, help_text="When querying for the feed of a live stream box, \
                           this is the xid associated with the Live Stream box (you can provide 'default' if one is not available)" )
 
@@ -450,21 +670,23 @@ class FacebookStream(BaseFbModel):
         unique_together = (("user", "post_id"),)
 
 
-class FacebookUser(BaseFbModel):
+class FacebookUserProfile(models.Model):
     '''
-    User Table
+    Columns of the user table which are the same whoever looks at the user. They are stored once per facebook user
+    however many system users have the user in their social graph, see FacebookUser
     '''
-    fqlname             = "user"
+    ignore_fields=['id', 'uid', 'row_hash', 'refreshed']
+    search_fields=['first_name', 'username', 'about_me', 'activities', 'interests', 'books', 'movies', 'quotes'] # full text search, see apps.fbschema.search
 
     ## Django Application specific fields
-    user                = models.ForeignKey(User, help_text="Data belongs with this system user") 
-    #TODO: Move this foreignkey to FacebookFriends model along with 'friend relation' information
-    #Moral of the story is : if in any fql schema if there is any 'viewer related' field then we will need this foreignkey 'user'
+    uid                 = models.BigIntegerField( unique=True, help_text="The user ID" )
+    row_hash            = models.CharField( max_length=40, blank=True, null=True, editable=False, help_text="sha1 of the cleaned field values" )
+    refreshed           = models.DateTimeField( db_index=True, help_text="Last time the profile was downloaded, by any system user" )
 
     ## Fb Schema specific fields
     about_me            = models.TextField( blank=True, null=True, help_text="More information about the user being queried")
     activities          = models.TextField( blank=True, null=True, help_text="The user's activities")
-    affiliations        = models.TextField( blank=True, null=True, help_text="The networks to which the user being queried \
+    affiliations        = JSONField( blank=True, null=True, help_text="The networks to which the user being queried \
                           belongs. The status field within this field will only return results in English") 
                           # max_length = 3000 represents is an array ( Array doesn't have fixed fields, so for now CharField is enough )
     age_range           = models.ForeignKey(StructAgeRange, blank=True, null=True)
@@ -474,11 +696,10 @@ class FacebookUser(BaseFbModel):
                           on the user's locale")
     
     books               = models.TextField( blank=True, null=True, help_text="The user's favorite books")
-    can_message         = models.NullBooleanField( blank=True, null=True, help_text="Whether the user can send a message to another user" )
     ## <Lean:Stopage> I am currently picking up fields I am interested in, and will try to basic import process which can update things
     
-    devices             = models.CharField( max_length=1000, blank=True, null=True, help_text="An array of objects containing fields os")
-    education           = models.TextField( blank=True, null=True, help_text="A list of the user's education history. Contains\
+    devices             = JSONField( blank=True, null=True, help_text="An array of objects containing fields os")
+    education           = JSONField( blank=True, null=True, help_text="A list of the user's education history. Contains\
                           year and type fields, and school object (name, id, type, and optional year, degree, concentration array, classes array,\
                           and with array )")
     email               = models.EmailField( blank=True, null=True, help_text="A string containing the user's primary Facebook email address \
@@ -489,22 +710,151 @@ class FacebookUser(BaseFbModel):
     interests           = models.TextField( blank=True, null=True, help_text="The user's interests" )
     likes_count         = models.IntegerField( blank=True, null=True, help_text="Count of all the pages this user has liked" )
     movies              = models.TextField( blank=True, null=True, help_text="The user's favorite movies")
-    mutual_friend_count = models.IntegerField( blank=True, null=True, help_text="The number of mutual friends shared by the \
-                          user being queried and the session user")
     quotes              = models.TextField( blank=True, null=True, help_text="The user's favorite quotes")
     relationship_status = models.CharField( max_length=50, blank=True, null=True, help_text="The type of relationship for the user being queried")
     religion            = models.CharField( max_length=50, blank=True, null=True, help_text="The user's religion")
     sex                 = models.CharField( max_length=50, blank=True, null=True, help_text="The user's gender")
     subscriber_count    = models.IntegerField( blank=True, null=True, help_text="The user's total number of subscribers")
-    movies              = models.TextField( blank=True, null=True, help_text="The user's favorite television shows")
-    uid                 = models.BigIntegerField( db_index=True, help_text="The user ID") # primary_key=True ? - No if you want to make it multi-user oriented
+    tv                  = models.TextField( blank=True, null=True, help_text="The user's favorite television shows")
     username            = models.CharField( max_length=500, blank=True, null=True, help_text="The user's username")
     wall_count          = models.IntegerField( blank=True, null=True, help_text="The user ID") # primary_key=True ?
     website             = models.CharField( max_length=1000, blank=True, null=True, help_text="The website")
-    work                = models.TextField( max_length=3000, blank=True, null=True, help_text="A list of the user's work history.\
+    work                = JSONField( blank=True, null=True, help_text="A list of the user's work history.\
                           Contains employer, location, position, start_date and end_date fields")
+
     def __unicode__(self):
         return self.username
+
+
+class FacebookUser(BaseFbModel):
+    '''
+    User Table. A tuple is the relation of a system user ( viewer ) with a facebook user and holds the columns which depend on the viewer,
+    the other columns are read from and written to the shared FacebookUserProfile of the uid ( see save_profiles ). Foreign keys
+    of the other tables still point here, they are resolved per viewer
+    '''
+    fqlname             = "user"
+    ignore_fields       = BaseFbModel.ignore_fields + ['profile']
+    shared_field        = "profile" # fql columns which aren't fields of this model are fields of the model this foreign key points to
+
+    ## Django Application specific fields
+    user                = models.ForeignKey(User, help_text="Data belongs with this system user") 
+    profile             = models.ForeignKey(FacebookUserProfile, related_name="viewers", help_text="Viewer independent columns")
+
+    ## Fb Schema specific fields
+    can_message         = models.NullBooleanField( blank=True, null=True, help_text="Whether the user can send a message to another user" )
+    mutual_friend_count = models.IntegerField( blank=True, null=True, help_text="The number of mutual friends shared by the \
+                          user being queried and the session user")
+    uid                 = models.BigIntegerField( db_index=True, help_text="The user ID") # primary_key=True ? - No if you want to make it multi-user oriented
+
+    def __unicode__(self):
+        return self.profile.username
+
+    @classmethod
+    def viewer_field_names(self):
+        '''
+        Columns of the user table stored on this model rather than on the shared profile
+        '''
+        return [field.name for field in self._meta.fields if field.name not in self.ignore_fields]
+
+    @classmethod
+    def fql_query_viewer(self, clause):
+        '''
+        Returns the fql query of the viewer columns only, for users whose shared profile is fresh
+        '''
+        return "SELECT %s FROM %s %s" % (", ".join(self.viewer_field_names()), self.fqlname, clause)
+
+    @classmethod
+    def fresh_uids(self, uids):
+        '''
+        Returns the uids among given ones whose shared profile was downloaded less than settings.FBSCHEMA_PROFILE_MAX_AGE_HOURS ago
+        '''
+        since = timezone.now() - datetime.timedelta(hours=PROFILE_MAX_AGE_HOURS)
+        fresh = set()
+        for chunk in chunked(list(uids), BULK_CHUNK_SIZE):
+            fresh.update(FacebookUserProfile.objects.filter(uid__in=chunk, refreshed__gte=since).values_list('uid', flat=True))
+        return fresh
+
+    @classmethod
+    def save_profiles(self, request, response_data):
+        from apps.fbschema.ingest import get_ingest_plan
+        from apps.fbschema.resolvers import get_resolver
+        from apps.fbschema.fql_server import invalidate
+        '''
+        Stores tuples of a user table response for request.user, either all columns or the viewer columns only ( see
+        fql_query_viewer ). The shared profile of a uid is written only when its content differs from what any system user
+        downloaded last, the viewer's FacebookUser tuple is created or overwritten. Returns the FacebookUser tuples
+        '''
+        plan = get_ingest_plan(self)
+        profile_plan = get_ingest_plan(FacebookUserProfile)
+        converters = dict(plan.converters)
+        viewer_field_names = self.viewer_field_names()
+        now = timezone.now()
+
+        data_dicts = []
+        for response_data_dict in response_data:
+            if len(response_data_dict) == len(viewer_field_names):
+                data_dicts.append(dict([(name, converters[name](response_data_dict[name], request)) for name in viewer_field_names]))
+            else:
+                plan.check_keys(response_data_dict.keys())
+                data_dicts.append(plan.prepare(response_data_dict, request))
+
+        # A resumed batch may have been stored already, existing tuples are overwritten
+        profiles = {}
+        existing = {}
+        for chunk in chunked([data_dict['uid'] for data_dict in data_dicts], BULK_CHUNK_SIZE):
+            profiles.update([(uid, (profile_id, row_hash)) for uid, profile_id, row_hash in \
+                             FacebookUserProfile.objects.filter(uid__in=chunk).values_list('uid', 'id', 'row_hash')])
+            existing.update(self.objects.filter(user=request.user, uid__in=chunk).values_list('uid', 'id'))
+
+        unchanged = []
+        changed = 0
+        facebook_users = []
+        for data_dict in data_dicts:
+            uid = data_dict['uid']
+            profile_id, row_hash = profiles.get(uid, (None, None))
+            if 'row_hash' in data_dict:
+                shared = dict([(name, data_dict[name]) for name in profile_plan.field_names])
+                shared_hash = profile_plan.row_hash(shared)
+                if shared_hash == row_hash:
+                    unchanged.append(profile_id)
+                else:
+                    profile_id = self.save_profile(FacebookUserProfile(id=profile_id, uid=uid, row_hash=shared_hash, refreshed=now, **shared))
+                    profiles[uid] = (profile_id, shared_hash)
+                    changed += 1
+            elif profile_id is None:
+                logger.info("No profile of user %s is stored, its viewer columns are skipped" % uid)
+                continue
+            facebook_user = self(user=request.user, id=existing.get(uid), profile_id=profile_id,
+                                 **dict([(name, data_dict[name]) for name in viewer_field_names]))
+            facebook_user.save()
+            existing[uid] = facebook_user.id
+            facebook_users.append(facebook_user)
+
+        for chunk in chunked(unchanged, BULK_CHUNK_SIZE):
+            FacebookUserProfile.objects.filter(id__in=chunk).update(refreshed=now)
+
+        #Cached fql results reading the user table are stale, once for the whole response
+        if facebook_users:
+            invalidate(self, request.user.id)
+        if changed:
+            invalidate(self, None)
+
+        #Foreign keys resolved earlier in this request may point to tuples which have just been created
+        get_resolver(request).clear(self)
+        return facebook_users
+
+    @classmethod
+    def save_profile(self, profile):
+        '''
+        Saves a shared profile and returns its id, another system user may have stored the uid in the meantime
+        '''
+        try:
+            with transaction.commit_on_success():
+                profile.save()
+        except IntegrityError:
+            profile.id = FacebookUserProfile.objects.get(uid=profile.uid).id
+            profile.save()
+        return profile.id
     
     class Meta:
         unique_together = (("user", "uid"),)
@@ -516,6 +866,9 @@ class FacebookFriend(BaseFbModel):
     Friend Table
     '''
     fqlname             = "friend"
+    primary_identifier  = "uid2"
+    owner_identifier    = "ONLY_SESSION_USER" # uid1 is always me()
+    facebook_row_limit  = 5000 # most friends facebook allows, the whole friend list is compared with the response
 
     ## Django Application specific fields
     user                = models.ForeignKey(User, help_text="Data belongs with this system user")
@@ -552,5 +905,10 @@ class FacebookLike(BaseFbModel):
         unique_together = (("object_id", "user_id"),) #Not having 'user' tells that it's a viewer free model
 
 
-
-
+#The changelog, the id edges, the aggregates, the local fql server's result cache and the search index follow rows_changed,
+#see apps.fbschema.history, apps.fbschema.edges, apps.fbschema.aggregates, apps.fbschema.fql_server and apps.fbschema.search
+import apps.fbschema.history
+import apps.fbschema.edges
+import apps.fbschema.aggregates
+import apps.fbschema.fql_server
+import apps.fbschema.search
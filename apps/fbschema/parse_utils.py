@@ -2,17 +2,21 @@
 Facebook field cleaning and parsing function
 '''
 import datetime
+import json
 import re
 
 from django.db.models import CharField, DateTimeField, ForeignKey, TextField, BigIntegerField
+from apps.fbschema.fields import JSONField
 from apps.fbschema.struct_models import *
+from apps.fbschema.struct_cache import intern_struct
 from apps.fbschema.models import *
+from apps.fbschema.resolvers import LOOKUP_FIELDS, get_resolver
 
 def parse_fbarray(fbarray):
     '''
-    Parse facebook array
+    Parse facebook array, for text columns. Json columns keep arrays and objects as they are, see convert_json
     '''
-    return fbarray.__str__()
+    return json.dumps(fbarray, sort_keys=True)
 
 def parse_fbdate(fbdate):
     '''
@@ -34,60 +38,101 @@ def parse_fbdate(fbdate):
             return datetime.datetime.strptime(safe_fbdate, format)
 
 
+def convert_text(value, request=None):
+    if value is not None and type(value) is not str and type(value) is not unicode:
+        # Converting facebook array into strings is solving problem as of now
+        value = parse_fbarray(value)
+    return value
+
+def convert_json(value, request=None):
+    #tables: photo, link, stream, user. Lists and dicts are stored as json by JSONField
+    return value
+
+def convert_date(value, request=None):
+    if value:
+        value = parse_fbdate(value)
+    return value
+
+def convert_bigint(value, request=None):
+    if not value:
+        return None
+    return int(value)
+
+def convert_age_range(value, request=None):
+    #table: user
+    if value:
+        value = intern_struct(StructAgeRange, value) # max has to be done with exception handling
+    return value
+
+def convert_resolved_foreign_key(field):
+    '''
+    Returns the converter of a foreign key to FacebookUser / FacebookAlbum, the id is resolved through the
+    ForeignKeyResolver of the request, see apps.fbschema.resolvers
+    '''
+    #TODO: user=request.user AND uid=value => uid=value ONLY ( Also see model class: FacebookLike notes )
+    '''
+    Field which are already supplied as parameters while saving response data in views,
+    and are not in data_dict 'must' be in ignore_fields of model class
+    Because then they should be at once place if supplied as parameteres then not in data_dict and vice_versa
+    '''
+    def convert(value, request=None):
+        return get_resolver(request).resolve(field, value)
+    return convert
+
+def convert_comment_info(value, request=None):
+    #table: album
+    if value:
+        value = intern_struct(StructCommentInfo, value)
+        #TODO: comment_order and comment_list in next pass, see StructCommentInfo
+    return value
+
+def convert_like_info(value, request=None):
+    #table: album
+    if value:
+        value = intern_struct(StructLikeInfo, value)
+    return value
+
+def convert_identity(value, request=None):
+    return value
+
+'''
+Dispatch tables used by get_converter. Order of FIELD_CONVERTERS matters, EmailField for example is a CharField and JSONField a TextField
+'''
+FIELD_CONVERTERS = (
+    (JSONField, convert_json),
+    (CharField, convert_text),
+    (TextField, convert_text),
+    (DateTimeField, convert_date),
+    (BigIntegerField, convert_bigint),
+)
+
+FOREIGN_KEY_CONVERTERS = {
+    'StructAgeRange': convert_age_range,
+    'StructCommentInfo': convert_comment_info,
+    'StructLikeInfo': convert_like_info,
+}
+
+def get_converter(field):
+    '''
+    Returns the function which cleans values received from fql queries for given model field. Their processing is
+    based on what data type they are going to be here in system, furthermore foreign keys are resolved by the name
+    of related model to tackle facebook's struct data type
+    '''
+    if isinstance(field, ForeignKey):
+        if field.rel.to in LOOKUP_FIELDS:
+            #For viewer field
+            return convert_resolved_foreign_key(field)
+        return FOREIGN_KEY_CONVERTERS.get(field.rel.to.__name__, convert_identity)
+    for field_class, converter in FIELD_CONVERTERS:
+        if isinstance(field, field_class):
+            return converter
+    return convert_identity
+
 def parse_clean_field_value(field, value, request=None):
     '''
     Main function to process fields received from fql queries
     Their processing is based on what data type they are going to be here in system
     Furthermore we need some extra introspection to tackle facebook's array and structs data type
+    Ingestion of whole responses goes through apps.fbschema.ingest which picks the converters only once per model
     '''
-    if( (isinstance(field, CharField) or isinstance(field, TextField)) and (type(value) is not str and type(value) is not unicode)):
-        # Converting facebook array into strings is solving problem as of now
-        value = parse_fbarray(value)
-    elif(isinstance(field, DateTimeField) and value):
-        value = parse_fbdate(value)
-    elif(isinstance(field, ForeignKey )):
-        '''
-        # What's going on here -
-        print type(field.rel.to)
-        print field.rel.to.__class__.__name__
-        print field.rel.to.__name__
-        print type(field.rel.to)
-        print isinstance(field.rel.to, StructAgeRange)
-        '''
-        if(field.rel.to.__name__ == "StructAgeRange") and value:
-                #table: user
-                value = StructAgeRange.objects.get_or_create( min= value['min'] )[0] # max has to be done with exception handling
-        elif(field.rel.to.__name__ == "FacebookUser"):
-                #For viewer field
-                #TODO: user=request.user AND uid=value => uid=value ONLY ( Also see model class: FacebookLike notes )
-                value = FacebookUser.objects.get( user=request.user, uid=value )
-                '''
-                Field which are already supplied as parameters while saving response data in views,
-                and are not in data_dict 'must' be in ignore_fields of model class
-                Because then they should be at once place if supplied as parameteres then not in data_dict and vice_versa
-                '''
-        elif(field.rel.to.__name__ == "FacebookAlbum"):
-                value = FacebookAlbum.objects.get( user=request.user, aid=value )
-        elif(field.rel.to.__name__ == "StructCommentInfo") and value:
-                #table: album
-                value = StructCommentInfo.objects.get_or_create( can_comment=value.get('can_comment', None), \
-                        comment_count=value.get('comment_count', None) or value.get('count', None) )[0] 
-                '''
-                value = StructCommentInfo.objects.get_or_create( can_comment=value.get('can_comment', None), \
-                comment_count=value.get('comment_count', None) or value.get('count', None), \
-                comment_order=value.get('comment_order', None), \
-                comment_list=value.get('comment_list', None))[0] 
-                #TODO: In next pass uncomment this line ^
-                '''
-        elif(field.rel.to.__name__ == "StructLikeInfo") and value:
-                #table: album
-                value = StructLikeInfo.objects.get_or_create( can_like=value.get('can_like', None), \
-                        like_count=value.get('like_count', None) or value.get('count', None), \
-                        user_likes=value.get('user_likes', None) )[0] 
-                
-    elif(isinstance(field, BigIntegerField) and not value):
-        value = None
-    elif(isinstance(field, BigIntegerField) and value):
-        return int(value)
-    return value
-
+    return get_converter(field)(value, request)
@@ -0,0 +1,108 @@
+'''
+Foreign key resolution of fql responses. Facebook returns plain ids ( owner, user_id, recipient_id, aid ... ) for
+tuples which are stored locally as FacebookUser / FacebookAlbum. Instead of one get() per foreign key per tuple,
+all ids referenced by a response are loaded with one IN query per target model and kept in an id -> tuple map
+for the rest of the sync, i.e. the request.
+'''
+import logging
+
+from django.core.exceptions import ObjectDoesNotExist
+
+from apps.fbschema.models import FacebookUser, FacebookAlbum
+from apps.fbschema.bulk_utils import chunked
+
+logger = logging.getLogger(__name__)
+
+# Facebook id field by which a foreign key to these models is resolved
+LOOKUP_FIELDS = {
+    FacebookUser: 'uid',
+    FacebookAlbum: 'aid',
+}
+
+# Keeps IN lists well under sqlite's parameter limit
+LOOKUP_CHUNK_SIZE = 500
+
+
+class UnresolvedForeignKey(ObjectDoesNotExist):
+    '''
+    Raised when a required foreign key refers to a tuple which is not stored locally, for example a photo of a friend
+    whose profile has not been downloaded into the 'user' table yet
+    '''
+    def __init__(self, field, keys):
+        self.field = field
+        self.keys = sorted(set(keys))
+        super(UnresolvedForeignKey, self).__init__("%s.%s refers to %s tuples which are not stored locally, %s=%s" % (
+            field.model.__name__, field.name, field.rel.to.__name__, LOOKUP_FIELDS[field.rel.to], self.keys))
+
+
+class ForeignKeyResolver(object):
+    '''
+    Maps facebook ids to locally stored tuples of one system user. Ids which don't resolve are remembered as well,
+    so that they are not queried again
+    '''
+    def __init__(self, user):
+        self.user = user
+        self._maps = {}
+
+    def normalize(self, model, key):
+        return model._meta.get_field(LOOKUP_FIELDS[model]).to_python(key)
+
+    def load(self, model, keys):
+        '''
+        Loads all given ids which are not mapped yet, with one IN query per chunk. Only id and the lookup field of
+        tuples are fetched, that is all a foreign key needs
+        '''
+        lookup_field = LOOKUP_FIELDS[model]
+        id_map = self._maps.setdefault(model, {})
+        keys = set([self.normalize(model, key) for key in keys]).difference(id_map)
+        keys.discard(None)
+        for chunk in chunked(keys, LOOKUP_CHUNK_SIZE):
+            kwargs = { "%s__in" % lookup_field : chunk }
+            for instance in model.objects.filter(user=self.user, **kwargs).only('id', lookup_field):
+                id_map[getattr(instance, lookup_field)] = instance
+            for key in chunk:
+                id_map.setdefault(key, None)
+
+    def get(self, model, key):
+        '''
+        Returns the tuple of given id, or None if it is not stored locally
+        '''
+        key = self.normalize(model, key)
+        id_map = self._maps.setdefault(model, {})
+        if key not in id_map:
+            self.load(model, [key])
+        return id_map.get(key)
+
+    def unresolved(self, model, keys):
+        return [key for key in keys if self.get(model, key) is None]
+
+    def resolve(self, field, key):
+        '''
+        Returns the tuple a foreign key field refers to. Nullable foreign keys ( like aid of a photo whose album is not
+        stored ) resolve to None, required ones raise UnresolvedForeignKey
+        '''
+        instance = self.get(field.rel.to, key)
+        if instance is None:
+            if not field.null:
+                raise UnresolvedForeignKey(field, [key])
+            logger.debug("%s.%s=%s is not stored locally, saving it as NULL" % (field.model.__name__, field.name, key))
+        return instance
+
+    def clear(self, model=None):
+        '''
+        Forgets mapped ids, it has to be called once tuples of a mapped model are written
+        '''
+        if model is None:
+            self._maps.clear()
+        else:
+            self._maps.pop(model, None)
+
+
+def get_resolver(request):
+    '''
+    Returns the resolver of the sync running in given request, creating it on first use
+    '''
+    resolver = getattr(request, '_fbschema_resolver', None)
+    if resolver is None or resolver.user != request.user:
+        resolver = request._fbschema_resolver = ForeignKeyResolver(request.user)
+    return resolver
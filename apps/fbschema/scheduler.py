@@ -0,0 +1,99 @@
+'''
+Friend batch scheduler. Friend batch tasks walk through the whole friend list of a user in batches instead of a
+hard coded slice of it, and store a SyncCheckpoint after every batch. A task that crashes or times out picks up
+where it stopped when it runs again, once a pass has covered all friends the next run starts a new pass.
+
+A friend whose query alone keeps timing out ( too much data even for a batch of one ) would stop every run at the
+same place. After settings.FBSCHEMA_FETCH_RETRIES attempts it is recorded as a SyncFailure and the pass moves on.
+'''
+import logging
+
+from django.utils import timezone
+
+from apps.fbschema.models import FacebookFriend, SyncCheckpoint, SyncFailure
+from apps.fbschema.fetch import BatchFetcher
+
+logger = logging.getLogger(__name__)
+
+
+class FriendBatchScheduler(object):
+    '''
+    Usage -
+        def store(friends, response_dataset):
+            ... store batch_fql response of these friends ...
+
+        scheduler = FriendBatchScheduler(request, 'table_photo_friends_batch', batch_size=2)
+        scheduler.run(graph, lambda friend: FacebookPhoto.fql_query_my_friends(friend.uid2), store)
+    '''
+    def __init__(self, request, table, batch_size, restart=False):
+        self.user = request.user
+        self.table = table
+        self.batch_size = batch_size
+        self.checkpoint, created = SyncCheckpoint.objects.get_or_create(user=self.user, table=table)
+        if restart or self.checkpoint.completed or created:
+            self.start_pass()
+        else:
+            logger.info("Resuming %s of %s at friend %d/%d" % (table, self.user, self.checkpoint.done, self.checkpoint.total))
+
+    def friends(self):
+        return FacebookFriend.objects.filter(user=self.user).order_by('id')
+
+    def start_pass(self):
+        checkpoint = self.checkpoint
+        checkpoint.last_friend_id = 0
+        checkpoint.done = 0
+        checkpoint.total = self.friends().count()
+        checkpoint.completed = False
+        checkpoint.started = timezone.now()
+        checkpoint.save()
+
+    def pending_friends(self):
+        return self.friends().filter(id__gt=self.checkpoint.last_friend_id)
+
+    def run(self, graph, query_for_friend, handle_batch):
+        '''
+        Fetches the remaining friends of the pass through a BatchFetcher, starting at batch_size friends per
+        batch_fql request. The checkpoint moves past friends as soon as they and all friends before them are stored
+        or skipped
+        '''
+        failed_uids = set(self.failures().values_list('uid', flat=True))
+
+        def store(friends, response_dataset):
+            handle_batch(friends, response_dataset)
+            stored = failed_uids.intersection([friend.uid2 for friend in friends])
+            if stored:
+                self.failures().filter(uid__in=stored).delete()
+                failed_uids.difference_update(stored)
+
+        fetcher = BatchFetcher(graph, initial_batch_size=self.batch_size)
+        fetcher.fetch(self.pending_friends(), query_for_friend, store, progress=self.advance, skip=self.skip)
+        self.finish()
+
+    def failures(self):
+        return SyncFailure.objects.filter(user=self.user, table=self.table)
+
+    def skip(self, friend, error):
+        '''
+        Records a friend the fetcher gave up on, the checkpoint moves past it
+        '''
+        failure, created = SyncFailure.objects.get_or_create(user=self.user, table=self.table, uid=friend.uid2)
+        failure.attempts += 1
+        failure.message = unicode(error)
+        failure.save()
+
+    def advance(self, friends):
+        '''
+        Records given friends as processed, all friends before them must have been processed already
+        '''
+        checkpoint = self.checkpoint
+        checkpoint.last_friend_id = max([friend.id for friend in friends])
+        checkpoint.done += len(friends)
+        checkpoint.total = max(checkpoint.total, checkpoint.done)
+        checkpoint.save()
+        logger.info("%s of %s: %d/%d friends" % (self.table, self.user, checkpoint.done, checkpoint.total))
+
+    def finish(self):
+        if not self.pending_friends().exists():
+            self.checkpoint.completed = True
+            self.checkpoint.total = self.checkpoint.done
+            self.checkpoint.save()
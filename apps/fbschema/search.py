@@ -0,0 +1,347 @@
+'''
+Full text search over the text columns of the fql tables ( search_fields of a model, e.g. message of stream, caption
+of photo, about_me of the shared profiles ). Every searchable tuple has a SearchDocument which the rows_changed
+signal of save_update_delete, and post_save of profiles, keep up to date. Documents are indexed by -
+    fts5        sqlite, an external content fts5 table following the documents through triggers, ranked by bm25
+    mysql       a FULLTEXT index on the documents, ranked by MATCH ... AGAINST
+    postings    anything else, a SearchPosting per term of a document written here, ranked by bm25 as well
+chosen by settings.FBSCHEMA_SEARCH_BACKEND or else by the database. A system user searches its own tuples and the
+profiles of the users it has in its social graph.
+
+fbschema_search_index indexes the tuples stored before search was turned on.
+
+Usage -
+    results = search(request.user, "beach party", tables=['stream', 'photo'], page=2)
+    for hit in results.hits:
+        print hit.table, hit.score, hit.tuple
+    results.has_next
+'''
+import logging
+import math
+import re
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.models.signals import post_delete, post_save, post_syncdb
+
+from apps.fbschema.bulk_utils import BULK_CHUNK_SIZE, chunked, iterate_in_pages
+from apps.fbschema.fql_engine import get_table_model
+from apps.fbschema.models import FacebookUser, FacebookUserProfile
+from apps.fbschema.search_models import SearchDocument, SearchPosting
+from apps.fbschema.signals import rows_changed
+
+logger = logging.getLogger(__name__)
+
+SEARCH_ENABLED = getattr(settings, 'FBSCHEMA_SEARCH', True)
+# 'fts5', 'mysql' or 'postings', None picks by database
+SEARCH_BACKEND = getattr(settings, 'FBSCHEMA_SEARCH_BACKEND', None)
+SEARCH_PAGE_SIZE = 20
+
+FTS_TABLE = 'fbschema_searchdocument_fts'
+MYSQL_INDEX = 'fbschema_searchdocument_body'
+MAX_TERM_LENGTH = 50
+# terms of a query taken into account
+MAX_QUERY_TERMS = 10
+# ranking of the postings backend, the defaults of sqlite's bm25()
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+_backends = {}
+
+
+def tokenize(text):
+    return [term[:MAX_TERM_LENGTH] for term in TERM_RE.findall(text.lower())]
+
+
+def search_using():
+    return router.db_for_write(SearchDocument)
+
+
+def search_backend(using=None):
+    using = using or search_using()
+    if SEARCH_BACKEND:
+        return SEARCH_BACKEND
+    backend = _backends.get(using)
+    if backend is None:
+        connection = connections[using]
+        if connection.vendor == 'mysql':
+            backend = 'mysql'
+        elif connection.vendor == 'sqlite' and has_fts5(connection):
+            backend = 'fts5'
+        else:
+            backend = 'postings'
+        _backends[using] = backend
+    return backend
+
+
+def has_fts5(connection):
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA compile_options')
+    return 'ENABLE_FTS5' in [row[0] for row in cursor.fetchall()]
+
+
+def create_search_index(sender, app=None, db=None, **kwargs):
+    '''
+    post_syncdb receiver, creates the full text index of the documents if the database has one
+    '''
+    if getattr(app, '__name__', None) != 'apps.fbschema.models':
+        return
+    using = db or search_using()
+    backend = search_backend(using)
+    cursor = connections[using].cursor()
+    if backend == 'fts5':
+        cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(body, content='fbschema_searchdocument', content_rowid='id')" % FTS_TABLE)
+        for name, event, statements in (
+                ('ai', 'INSERT', "INSERT INTO %(fts)s(rowid, body) VALUES (new.id, new.body);"),
+                ('ad', 'DELETE', "INSERT INTO %(fts)s(%(fts)s, rowid, body) VALUES ('delete', old.id, old.body);"),
+                ('au', 'UPDATE', "INSERT INTO %(fts)s(%(fts)s, rowid, body) VALUES ('delete', old.id, old.body); "
+                                 "INSERT INTO %(fts)s(rowid, body) VALUES (new.id, new.body);")):
+            cursor.execute("CREATE TRIGGER IF NOT EXISTS fbschema_searchdocument_%s AFTER %s ON fbschema_searchdocument BEGIN %s END"
+                           % (name, event, statements % {'fts': FTS_TABLE}))
+    elif backend == 'mysql':
+        cursor.execute("SHOW INDEX FROM fbschema_searchdocument WHERE Key_name = %s", [MYSQL_INDEX])
+        if not cursor.fetchall():
+            cursor.execute("ALTER TABLE fbschema_searchdocument ADD FULLTEXT INDEX %s (body)" % MYSQL_INDEX)
+
+
+# Documents
+
+def document_table(model):
+    # profiles are searched as the user table
+    return model is FacebookUserProfile and FacebookUser.fqlname or model.fqlname
+
+
+def document_key_field(model):
+    return getattr(model, 'primary_identifier', None) or 'uid'
+
+
+def document_body(model, data_dict):
+    return u'\n'.join([unicode(data_dict[name]) for name in model.search_fields if data_dict.get(name)])
+
+
+def write_documents(model, user, stale_keys, data_dicts):
+    '''
+    Drops the documents of stale_keys and adds those of data_dicts. user is None for profiles
+    '''
+    table, key_field = document_table(model), document_key_field(model)
+    postings = search_backend() == 'postings'
+    for chunk in chunked([unicode(key) for key in stale_keys], BULK_CHUNK_SIZE):
+        SearchDocument.objects.filter(user=user, table=table, key__in=chunk).delete()
+        if postings:
+            SearchPosting.objects.filter(user=user, table=table, key__in=chunk).delete()
+    for chunk in chunked(data_dicts, BULK_CHUNK_SIZE):
+        documents, terms = [], []
+        for data_dict in chunk:
+            body = document_body(model, data_dict)
+            if not body:
+                continue
+            key = unicode(data_dict[key_field])
+            uid = user is None and data_dict[key_field] or None
+            documents.append(SearchDocument(user=user, table=table, key=key, uid=uid, body=body))
+            if postings:
+                counts = defaultdict(int)
+                length = 0
+                for term in tokenize(body):
+                    counts[term] += 1
+                    length += 1
+                terms.extend([SearchPosting(user=user, table=table, key=key, uid=uid, term=term, count=count, length=length)
+                              for term, count in counts.items()])
+        SearchDocument.objects.bulk_create(documents)
+        for posting_chunk in chunked(terms, BULK_CHUNK_SIZE):
+            SearchPosting.objects.bulk_create(posting_chunk)
+
+
+def update_search(sender, request, added, updated, deleted, **kwargs):
+    '''
+    rows_changed receiver, keeps the documents of a save_update_delete call's tuples
+    '''
+    if not getattr(sender, 'search_fields', None):
+        return
+    key_field = document_key_field(sender)
+    changed = [data_dict for old_values, data_dict in updated
+               if [name for name in sender.search_fields if old_values[name] != data_dict[name]]]
+    # added tuples may have had a document already when they were recovered by handle_integrity_exception
+    stale_keys = [data_dict[key_field] for data_dict in list(added) + changed] + [old_values[key_field] for old_values in deleted]
+    write_documents(sender, request.user, stale_keys, list(added) + changed)
+
+
+def index_profile(sender, instance, **kwargs):
+    '''
+    post_save receiver of the shared profiles, save_profiles only saves profiles whose content changed
+    '''
+    write_documents(FacebookUserProfile, None, [instance.uid], [dict([(name, getattr(instance, name)) for name in ['uid'] + list(instance.search_fields)])])
+
+
+def unindex_profile(sender, instance, **kwargs):
+    write_documents(FacebookUserProfile, None, [instance.uid], [])
+
+
+def rebuild_search(model, user=None):
+    '''
+    Writes the documents of all stored tuples of model of a system user ( all profiles for FacebookUserProfile ) again,
+    returns their number
+    '''
+    key_field = document_key_field(model)
+    queryset = model.objects.all()
+    if user is not None:
+        queryset = queryset.filter(user=user)
+    table = document_table(model)
+    SearchDocument.objects.filter(user=user, table=table).delete()
+    SearchPosting.objects.filter(user=user, table=table).delete()
+    count = 0
+    for page in chunked(iterate_in_pages(queryset.values('id', key_field, *model.search_fields)), BULK_CHUNK_SIZE):
+        write_documents(model, user, [], page)
+        count += len(page)
+    return count
+
+
+# Searching
+
+class SearchHit(object):
+    def __init__(self, table, key, score):
+        self.table = table
+        self.key = key
+        self.score = score
+        self.tuple = None
+
+    def __repr__(self):
+        return "<SearchHit %s %s %.3f>" % (self.table, self.key, self.score)
+
+
+class SearchResults(object):
+    '''
+    A page of hits, best first. hit.tuple is the model instance of the hit, FacebookUser of the searching system
+    user for profiles
+    '''
+    def __init__(self, hits, page, per_page, has_next):
+        self.hits = hits
+        self.page = page
+        self.per_page = per_page
+        self.has_next = has_next
+
+    def __iter__(self):
+        return iter(self.hits)
+
+    def __len__(self):
+        return len(self.hits)
+
+
+class Searcher(object):
+    '''
+    Ranked queries of one system user, in the SQL of the backend
+    '''
+    def __init__(self, user, tables, using=None):
+        self.user = user
+        self.tables = tables
+        self.using = using or search_using()
+        self.connection = connections[self.using]
+        self.backend = search_backend(self.using)
+
+    def qn(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def scope(self, alias):
+        '''
+        Condition on the tuples of the system user and the profiles of its social graph
+        '''
+        sql = '(%s.user_id = %%s OR %s.uid IN (SELECT uid FROM %s WHERE user_id = %%s))' % (alias, alias, self.qn(FacebookUser._meta.db_table))
+        params = [self.user.pk, self.user.pk]
+        if self.tables:
+            sql += ' AND %s.%s IN (%s)' % (alias, self.qn('table'), ', '.join(['%s'] * len(self.tables)))
+            params.extend(self.tables)
+        return sql, params
+
+    def fetch(self, sql, params):
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        return [SearchHit(table, key, float(score or 0)) for table, key, score in cursor.fetchall()]
+
+    def search(self, query, limit, offset):
+        terms = []
+        for term in tokenize(query):
+            if term not in terms:
+                terms.append(term)
+        terms = terms[:MAX_QUERY_TERMS]
+        if not terms:
+            return []
+        return getattr(self, 'search_%s' % self.backend)(terms, limit, offset)
+
+    def search_fts5(self, terms, limit, offset):
+        scope, params = self.scope('d')
+        # every term quoted, fts5 query syntax in the text is taken literally
+        match = ' '.join(['"%s"' % term.replace('"', '""') for term in terms])
+        return self.fetch('SELECT d.%s, d.%s, -bm25(%s) FROM %s JOIN fbschema_searchdocument d ON d.id = %s.rowid '
+                          'WHERE %s MATCH %%s AND %s ORDER BY bm25(%s), d.id LIMIT %%s OFFSET %%s'
+                          % (self.qn('table'), self.qn('key'), FTS_TABLE, FTS_TABLE, FTS_TABLE, FTS_TABLE, scope, FTS_TABLE),
+                          [match] + params + [limit, offset])
+
+    def search_mysql(self, terms, limit, offset):
+        scope, params = self.scope('d')
+        # boolean mode, every term required
+        match = ' '.join(['+%s' % term for term in terms])
+        return self.fetch('SELECT d.%s, d.%s, MATCH (d.body) AGAINST (%%s IN BOOLEAN MODE) AS score FROM fbschema_searchdocument d '
+                          'WHERE MATCH (d.body) AGAINST (%%s IN BOOLEAN MODE) AND %s ORDER BY score DESC, d.id LIMIT %%s OFFSET %%s'
+                          % (self.qn('table'), self.qn('key'), scope), [match, match] + params + [limit, offset])
+
+    def search_postings(self, terms, limit, offset):
+        scope, params = self.scope('p')
+        term_list = ', '.join(['%s'] * len(terms))
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT p.term, COUNT(*) FROM fbschema_searchposting p WHERE p.term IN (%s) AND %s GROUP BY p.term'
+                       % (term_list, scope), terms + params)
+        frequencies = dict(cursor.fetchall())
+        if len(frequencies) < len(terms):
+            # a term no document has
+            return []
+        document_scope, document_params = self.scope('d')
+        cursor.execute('SELECT COUNT(*) FROM fbschema_searchdocument d WHERE %s' % document_scope, document_params)
+        documents = cursor.fetchone()[0]
+        # bm25, the average length of the matching documents stands for the average of all documents
+        cursor.execute('SELECT AVG(p.length) FROM fbschema_searchposting p WHERE p.term IN (%s) AND %s' % (term_list, scope), terms + params)
+        average_length = float(cursor.fetchone()[0] or 1)
+        weights = []
+        for term in terms:
+            weights.extend([term, math.log(1.0 + (documents - frequencies[term] + 0.5) / (frequencies[term] + 0.5))])
+        term_score = 'CASE p.term %s END * p.count * %s / (p.count + %s * (%s + %s * p.length / %s))' % (
+            ' '.join(['WHEN %s THEN %s'] * len(terms)), BM25_K1 + 1, BM25_K1, 1 - BM25_B, BM25_B, average_length)
+        return self.fetch('SELECT p.%s, p.%s, SUM(%s) AS score FROM fbschema_searchposting p '
+                          'WHERE p.term IN (%s) AND %s GROUP BY p.%s, p.%s HAVING COUNT(*) = %%s '
+                          'ORDER BY score DESC, p.%s, p.%s LIMIT %%s OFFSET %%s'
+                          % (self.qn('table'), self.qn('key'), term_score, term_list, scope,
+                             self.qn('table'), self.qn('key'), self.qn('table'), self.qn('key')), weights + terms + params + [len(terms), limit, offset])
+
+    def load_tuples(self, hits):
+        by_table = defaultdict(list)
+        for hit in hits:
+            by_table[hit.table].append(hit)
+        for table, table_hits in by_table.items():
+            model = get_table_model(table)
+            key_field = document_key_field(model)
+            kwargs = { "%s__in" % key_field : [hit.key for hit in table_hits] }
+            tuples = dict([(unicode(getattr(data_tuple, key_field)), data_tuple) for data_tuple in model.objects.filter(user=self.user, **kwargs)])
+            for hit in table_hits:
+                hit.tuple = tuples.get(hit.key)
+
+
+def search(user, query, tables=None, page=1, per_page=SEARCH_PAGE_SIZE):
+    '''
+    Tuples of the system user, and profiles of its social graph, matching every term of query, best first. tables
+    limits the search to some fql tables. Returns a page of SearchResults
+    '''
+    searcher = Searcher(user, tables)
+    page = max(int(page), 1)
+    hits = searcher.search(query, per_page + 1, (page - 1) * per_page)
+    has_next = len(hits) > per_page
+    hits = hits[:per_page]
+    searcher.load_tuples(hits)
+    return SearchResults([hit for hit in hits if hit.tuple is not None], page, per_page, has_next)
+
+
+post_syncdb.connect(create_search_index, dispatch_uid='fbschema_search')
+if SEARCH_ENABLED:
+    rows_changed.connect(update_search, dispatch_uid='fbschema_search')
+    post_save.connect(index_profile, sender=FacebookUserProfile, dispatch_uid='fbschema_search_profile')
+    post_delete.connect(unindex_profile, sender=FacebookUserProfile, dispatch_uid='fbschema_search_profile')
@@ -0,0 +1,44 @@
+from django.db import models
+from django.contrib.auth.models import User
+
+'''
+Full text index of the fql tables, see apps.fbschema.search
+'''
+
+class SearchDocument(models.Model):
+    '''
+    Searchable text of a tuple, its search_fields joined. sqlite indexes it in an fts5 table kept up to date by triggers
+    and MySQL with a FULLTEXT index, both created by syncdb. Shared profiles belong with no system user
+    '''
+    user                = models.ForeignKey(User, blank=True, null=True, help_text="System user the tuple belongs to, none for profiles")
+    table               = models.CharField( max_length=100, help_text="fqlname of the model" )
+    key                 = models.CharField( max_length=255, help_text="primary_identifier value of the tuple, uid for profiles" )
+    uid                 = models.BigIntegerField( blank=True, null=True, db_index=True, help_text="uid of a profile, the system users having it in\
+                          their social graph search it" )
+    body                = models.TextField()
+
+    def __unicode__(self):
+        return "%s %s" % (self.table, self.key)
+
+    class Meta:
+        index_together = (("user", "table", "key"),)
+
+
+class SearchPosting(models.Model):
+    '''
+    Inverted index of the documents for databases without a full text index of their own, one tuple per distinct
+    term of a document
+    '''
+    user                = models.ForeignKey(User, blank=True, null=True, help_text="System user the tuple belongs to, none for profiles")
+    table               = models.CharField( max_length=100, help_text="fqlname of the model" )
+    key                 = models.CharField( max_length=255, help_text="primary_identifier value of the tuple, uid for profiles" )
+    uid                 = models.BigIntegerField( blank=True, null=True, help_text="uid of a profile" )
+    term                = models.CharField( max_length=50 )
+    count               = models.IntegerField( help_text="Occurrences of the term in the document" )
+    length              = models.IntegerField( help_text="Terms in the document" )
+
+    def __unicode__(self):
+        return "%s %s %s: %d" % (self.table, self.key, self.term, self.count)
+
+    class Meta:
+        index_together = (("term", "user"), ("term", "uid"), ("user", "table", "key"))
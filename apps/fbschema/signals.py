@@ -0,0 +1,14 @@
+'''
+Signals of the fbschema sync, they let other parts of the application follow what a sync changes in the local tables
+'''
+from django.dispatch import Signal
+
+# Sent by BaseFbModel.save_update_delete once a response has been written, sender is the model.
+# added is a list of data_dicts, updated a list of (old_values, data_dict) pairs where old_values holds the stored
+# values of the plan fields ( foreign keys as ids ) before the update and deleted a list of old_values of deleted tuples
+rows_changed = Signal(providing_args=["request", "added", "updated", "deleted"])
+
+# Sent by apps.fbschema.metrics for every measurement while it has listeners, sender is None. kind is 'counter' or
+# 'histogram', labels a dict such as {'model': 'album', 'user': 1}. Hooks forwarding metrics to statsd and the like
+# connect here, or are listed in settings.FBSCHEMA_METRICS_HOOKS
+metric_observed = Signal(providing_args=["name", "kind", "value", "labels"])
@@ -0,0 +1,216 @@
+'''
+In memory social graph of a system user, built from its FacebookFriend edges. Friendships are stored in compressed
+sparse row form - the sorted uids, and for the node at position i its neighbours' positions at
+indices[indptr[i]:indptr[i + 1]], sorted - so a graph of thousands of users is a few numpy int64 arrays, and
+degrees, mutual friends, k hop neighbourhoods, paths and components are answered without a query, set operations
+and breadth first expansions working on whole arrays. Facebook uids don't fit 32 bits, hence int64 everywhere.
+
+Graphs are cached per process and built again on first use after the friend table of the user is written, by this
+process or a worker, the generation numbers of apps.fbschema.fql_server tell.
+
+Usage -
+    graph = social_graph(request.user)
+    graph.degree(uid)
+    graph.mutual_friends(uid, other_uid)
+    graph.k_hop(uid, 2)
+    graph.path(uid, other_uid)
+    graph.components()
+'''
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy
+from django.conf import settings
+
+from apps.fbschema.fql_server import generations
+from apps.fbschema.models import FacebookFriend
+
+logger = logging.getLogger(__name__)
+
+SOCIAL_GRAPH_CACHE_SIZE = getattr(settings, 'FBSCHEMA_SOCIAL_GRAPH_CACHE_SIZE', 20)
+
+
+class SocialGraph(object):
+    '''
+    Undirected graph of uids in compressed sparse row form. Self loops and repeated edges are dropped
+    '''
+    def __init__(self, nodes, indptr, indices):
+        self.nodes = nodes
+        self.indptr = indptr
+        self.indices = indices
+
+    @classmethod
+    def from_edges(cls, edges):
+        '''
+        Graph of an iterable of (uid1, uid2) pairs
+        '''
+        pairs = numpy.fromiter(itertools.chain.from_iterable(edges), dtype=numpy.int64).reshape(-1, 2)
+        pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+        pairs = numpy.concatenate([pairs, pairs[:, ::-1]])
+        nodes = numpy.unique(pairs)
+        sources, targets = numpy.searchsorted(nodes, pairs[:, 0]), numpy.searchsorted(nodes, pairs[:, 1])
+        order = numpy.lexsort((targets, sources))
+        sources, targets = sources[order], targets[order]
+        distinct = numpy.ones(len(sources), dtype=bool)
+        distinct[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+        indptr = numpy.zeros(len(nodes) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(sources[distinct], minlength=len(nodes)), out=indptr[1:])
+        return cls(nodes, indptr, targets[distinct].astype(numpy.int64))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, uid):
+        return self.position(uid) is not None
+
+    @property
+    def edge_count(self):
+        return len(self.indices) // 2
+
+    def position(self, uid):
+        position = int(numpy.searchsorted(self.nodes, uid))
+        if position < len(self.nodes) and self.nodes[position] == uid:
+            return position
+        return None
+
+    def uids(self, positions):
+        return self.nodes[numpy.asarray(positions, dtype=numpy.int64)].tolist()
+
+    def neighbours(self, position):
+        return self.indices[self.indptr[position]:self.indptr[position + 1]]
+
+    def expand(self, frontier):
+        '''
+        The (source, target) positions of all edges leaving the positions of frontier, as two arrays
+        '''
+        starts = self.indptr[frontier]
+        counts = self.indptr[frontier + 1] - starts
+        total = int(counts.sum())
+        offsets = numpy.repeat(starts - numpy.cumsum(counts) + counts, counts) + numpy.arange(total)
+        return numpy.repeat(frontier, counts), self.indices[offsets]
+
+    def friends(self, uid):
+        position = self.position(uid)
+        return position is not None and self.uids(self.neighbours(position)) or []
+
+    def degree(self, uid):
+        position = self.position(uid)
+        return position is not None and int(self.indptr[position + 1] - self.indptr[position]) or 0
+
+    def degrees(self):
+        '''
+        { uid : number of friends } of all users
+        '''
+        return dict(zip(self.nodes.tolist(), numpy.diff(self.indptr).tolist()))
+
+    def mutual_friends(self, uid1, uid2):
+        '''
+        Sorted uids of the friends two users have in common, who connect them
+        '''
+        position1, position2 = self.position(uid1), self.position(uid2)
+        if position1 is None or position2 is None:
+            return []
+        return self.uids(numpy.intersect1d(self.neighbours(position1), self.neighbours(position2), assume_unique=True))
+
+    def k_hop(self, uid, k):
+        '''
+        Sorted uids of the users at most k friendships away from a user, the user excluded
+        '''
+        start = self.position(uid)
+        if start is None:
+            return []
+        visited = numpy.zeros(len(self.nodes), dtype=bool)
+        visited[start] = True
+        frontier = numpy.array([start], dtype=numpy.int64)
+        for hop in range(k):
+            if not len(frontier):
+                break
+            reached = numpy.unique(self.expand(frontier)[1])
+            frontier = reached[~visited[reached]]
+            visited[frontier] = True
+        visited[start] = False
+        return self.uids(numpy.flatnonzero(visited))
+
+    def path(self, uid1, uid2):
+        '''
+        uids of a shortest chain of friendships from uid1 to uid2, both included, None if they aren't connected
+        '''
+        start, end = self.position(uid1), self.position(uid2)
+        if start is None or end is None:
+            return None
+        parents = numpy.full(len(self.nodes), -1, dtype=numpy.int64)
+        parents[start] = start
+        frontier = numpy.array([start], dtype=numpy.int64)
+        while len(frontier) and parents[end] < 0:
+            sources, targets = self.expand(frontier)
+            unseen = parents[targets] < 0
+            frontier, first = numpy.unique(targets[unseen], return_index=True)
+            parents[frontier] = sources[unseen][first]
+        if parents[end] < 0:
+            return None
+
+        positions = [end]
+        while positions[-1] != start:
+            positions.append(int(parents[positions[-1]]))
+        return self.uids(positions[::-1])
+
+    def components(self):
+        '''
+        Connected components, lists of sorted uids, largest first
+        '''
+        # every node takes the smallest label among its neighbours until nothing changes
+        labels = numpy.arange(len(self.nodes))
+        sources = numpy.repeat(labels, numpy.diff(self.indptr))
+        while True:
+            smallest = labels.copy()
+            numpy.minimum.at(smallest, sources, labels[self.indices])
+            smallest = smallest[smallest]
+            if (smallest == labels).all():
+                break
+            labels = smallest
+        order = numpy.argsort(labels, kind='mergesort')
+        boundaries = numpy.flatnonzero(numpy.diff(labels[order])) + 1
+        components = [self.uids(positions) for positions in numpy.split(order, boundaries) if len(positions)]
+        return sorted(components, key=lambda component: (-len(component), component[0]))
+
+
+class GraphCache(object):
+    '''
+    Thread safe LRU cache of the graphs of system users, a graph is built again when the generation of the friend
+    table of its user changed
+    '''
+    def __init__(self, max_size=SOCIAL_GRAPH_CACHE_SIZE):
+        self.max_size = max_size
+        self._graphs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, generation):
+        with self._lock:
+            cached = self._graphs.pop(user_id, None)
+            if cached is not None and cached[0] == generation:
+                self._graphs[user_id] = cached
+                return cached[1]
+        edges = FacebookFriend.objects.filter(user=user_id).values_list('uid1', 'uid2')
+        graph = SocialGraph.from_edges(edges.iterator())
+        logger.debug("Social graph of user %s built: %d users, %d friendships" % (user_id, len(graph), graph.edge_count))
+        with self._lock:
+            self._graphs[user_id] = (generation, graph)
+            while len(self._graphs) > self.max_size:
+                self._graphs.popitem(last=False)
+        return graph
+
+    def clear(self):
+        with self._lock:
+            self._graphs.clear()
+
+
+graph_cache = GraphCache()
+
+
+def social_graph(user):
+    '''
+    SocialGraph of the friend table of a system user, up to date with its last write
+    '''
+    return graph_cache.get(user.id, generations([FacebookFriend], user.id))
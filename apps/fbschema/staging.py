@@ -0,0 +1,282 @@
+'''
+Set based sync, save_update_delete(staging=True). Cleaned response tuples are loaded into a temporary staging table
+and compared with the stored tuples in SQL instead of pulling every local key into a python dict -
+1) tuples are matched on the natural key of the model ( its unique constraint, see upsert_key ), every staged tuple
+   gets the id and row_hash of its stored counterpart and is classified as added, updated or unchanged
+2) added and updated tuples are written by one native upsert, INSERT ... ON DUPLICATE KEY UPDATE on MySQL and
+   INSERT ... ON CONFLICT DO UPDATE on sqlite >= 3.24 and PostgreSQL >= 9.5
+3) stored tuples of the owner missing from the response are found by an anti join and deleted
+so memory stays flat however large the response or the table, the database does the work.
+
+A response repeating a key ( see FacebookStream.handle_integrity_exception ) leaves one staged tuple, the last one,
+there are no IntegrityErrors to recover from. Only session user tables ( stream, notification ) are compared with
+all stored tuples of the system user, not only the last facebook_row_limit ones.
+
+Models without a unique constraint including the system user and backends without native upsert keep the python diff.
+'''
+import logging
+
+from django.conf import settings
+from django.db import connections, router, transaction
+
+from apps.fbschema.bulk_utils import BULK_CHUNK_SIZE, chunked
+from apps.fbschema.ingest import SyncStats, get_ingest_plan
+from apps.fbschema.metrics import SyncTimer
+from apps.fbschema.resolvers import get_resolver
+from apps.fbschema.signals import rows_changed
+from apps.fbschema.streaming import MemoryCeiling
+from apps.fbschema.struct_cache import struct_cache
+
+logger = logging.getLogger(__name__)
+
+STAGING_SYNC = getattr(settings, 'FBSCHEMA_STAGING_SYNC', False)
+
+SQLITE_UPSERT_VERSION = (3, 24, 0)
+POSTGRESQL_UPSERT_VERSION = 90500
+
+# action of a staged tuple, unchanged ones have none
+ADDED = 'a'
+UPDATED = 'u'
+
+
+def upsert_key(model):
+    '''
+    Names of the fields identifying a tuple of model, its unique constraint including the system user. None if there
+    is none, a key without the user ( e.g. the globally unique FacebookNotification.notification_id ) would let the
+    upsert take over the tuples of other system users
+    '''
+    if 'user' not in [field.name for field in model._meta.fields]:
+        return None
+    for field_names in model._meta.unique_together:
+        if 'user' in field_names:
+            return list(field_names)
+    return None
+
+
+def supports_upsert(connection):
+    if connection.vendor == 'mysql':
+        return True
+    if connection.vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= SQLITE_UPSERT_VERSION
+    if connection.vendor == 'postgresql':
+        from django.db.backends.postgresql_psycopg2.version import get_version
+        return get_version(connection) >= POSTGRESQL_UPSERT_VERSION
+    return False
+
+
+def can_stage(model):
+    return upsert_key(model) is not None and supports_upsert(connections[router.db_for_write(model)])
+
+
+def upsert_sql(connection, table, columns, key_columns, source_sql):
+    '''
+    INSERT INTO table (columns) source_sql, tuples whose key_columns exist already get the other columns updated
+    '''
+    qn = connection.ops.quote_name
+    update_columns = [column for column in columns if column not in key_columns]
+    sql = 'INSERT INTO %s (%s) %s' % (qn(table), ', '.join([qn(column) for column in columns]), source_sql)
+    if connection.vendor == 'mysql':
+        return '%s ON DUPLICATE KEY UPDATE %s' % (sql, ', '.join(['%s = VALUES(%s)' % (qn(column), qn(column)) for column in update_columns]))
+    return '%s ON CONFLICT (%s) DO UPDATE SET %s' % (sql, ', '.join([qn(column) for column in key_columns]),
+                                                     ', '.join(['%s = excluded.%s' % (qn(column), qn(column)) for column in update_columns]))
+
+
+class StagedSync(object):
+    '''
+    One save_update_delete call of a model through its staging table, a temporary table of the connection holding the
+    cleaned response. The table has the write_fields columns of the ingest plan plus
+        stage_seq - position of the tuple in the response, pages are taken by it
+        stage_target_id, stage_target_hash - id and row_hash of the stored tuple with the same key
+        stage_action - ADDED, UPDATED or NULL
+    '''
+    def __init__(self, model, request, chunk_size=None, timer=None):
+        self.model = model
+        self.request = request
+        self.chunk_size = chunk_size or BULK_CHUNK_SIZE
+        self.timer = timer or SyncTimer()
+        self.using = router.db_for_write(model)
+        self.connection = connections[self.using]
+        self.plan = get_ingest_plan(model)
+
+        self.table_name = model._meta.db_table
+        self.stage_name = 'fbschema_stage_%s' % self.table_name
+        self.user_column = model._meta.get_field('user').column
+        self.columns = [field.column for field in self.plan.write_fields]
+        self.key_columns = [model._meta.get_field(name).column for name in upsert_key(model)]
+        # every staged tuple belongs with request.user, the staging table is keyed without the user column
+        self.stage_key_columns = [column for column in self.key_columns if column != self.user_column]
+        self.key_positions = [self.columns.index(column) for column in self.stage_key_columns]
+        self.seq = 0
+        self.rows = 0
+
+    def qn(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def execute(self, sql, params=()):
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        return cursor
+
+    def create(self):
+        self.drop()
+        columns = ['stage_seq integer NOT NULL', 'stage_target_id integer NULL', 'stage_target_hash varchar(40) NULL', 'stage_action char(1) NULL']
+        columns.extend(['%s %s NULL' % (self.qn(field.column), field.db_type(self.connection)) for field in self.plan.write_fields])
+        self.execute('CREATE TEMPORARY TABLE %s (%s, UNIQUE (%s))' % (self.qn(self.stage_name), ', '.join(columns),
+                     ', '.join([self.qn(column) for column in self.stage_key_columns])))
+
+    def drop(self):
+        temporary = self.connection.vendor == 'mysql' and 'TEMPORARY ' or ''
+        self.execute('DROP %sTABLE IF EXISTS %s' % (temporary, self.qn(self.stage_name)))
+
+    def load(self, chunk):
+        '''
+        Cleans a chunk of response tuples and stages them, a key staged before is overwritten
+        '''
+        with self.timer.phase('parse'):
+            data_dicts = self.plan.prepare_rows(chunk, self.request)
+        with self.timer.phase('diff'):
+            staged = []
+            skipped = 0
+            for data_dict in data_dicts:
+                data_tuple = self.model(user=self.request.user, **data_dict)
+                values = [field.get_db_prep_save(field.pre_save(data_tuple, True), connection=self.connection) for field in self.plan.write_fields]
+                if [position for position in self.key_positions if values[position] is None]:
+                    # NULLs never match in a unique constraint, such a tuple would be added again by every sync
+                    skipped += 1
+                    continue
+                self.seq += 1
+                staged.append([self.seq] + values)
+            if staged:
+                source_sql = 'VALUES (%s)' % ', '.join(['%s'] * (len(self.columns) + 1))
+                self.connection.cursor().executemany(upsert_sql(self.connection, self.stage_name, ['stage_seq'] + self.columns,
+                                                                self.stage_key_columns, source_sql), staged)
+            if skipped:
+                logger.info("%s: %d tuples without %s skipped" % (self.model.fqlname, skipped, '/'.join(self.stage_key_columns)))
+        self.rows += len(chunk)
+
+    def match(self, alias):
+        '''
+        Condition matching stored tuples, of the table named alias, with staged tuples
+        '''
+        conditions = []
+        params = []
+        for column in self.key_columns:
+            if column == self.user_column:
+                conditions.append('%s.%s = %%s' % (alias, self.qn(column)))
+                params.append(self.request.user.pk)
+            else:
+                conditions.append('%s.%s = %s.%s' % (alias, self.qn(column), self.qn(self.stage_name), self.qn(column)))
+        return ' AND '.join(conditions), params
+
+    def lookup(self, where='1 = 1', params=()):
+        '''
+        Sets stage_target_id and stage_target_hash of the staged tuples matching where
+        '''
+        match, match_params = self.match('t')
+        stored = lambda column: '(SELECT t.%s FROM %s t WHERE %s)' % (column, self.qn(self.table_name), match)
+        self.execute('UPDATE %s SET stage_target_id = %s, stage_target_hash = %s WHERE %s' % (self.qn(self.stage_name), stored('id'),
+                     stored(self.qn('row_hash')), where), match_params + match_params + list(params))
+
+    def classify(self):
+        '''
+        Looks the stored counterparts up and returns the SyncStats of the upsert
+        '''
+        self.lookup()
+        self.execute("UPDATE %s SET stage_action = CASE WHEN stage_target_id IS NULL THEN '%s' "
+                     "WHEN stage_target_hash IS NULL OR stage_target_hash <> %s THEN '%s' END"
+                     % (self.qn(self.stage_name), ADDED, self.qn('row_hash'), UPDATED))
+        counts = dict(self.execute('SELECT stage_action, COUNT(*) FROM %s GROUP BY stage_action' % self.qn(self.stage_name)).fetchall())
+        return SyncStats(added=int(counts.get(ADDED, 0)), updated=int(counts.get(UPDATED, 0)), unchanged=int(counts.get(None, 0)))
+
+    def upsert(self, where='1 = 1', params=()):
+        source_sql = 'SELECT %%s, %s FROM %s WHERE stage_action IS NOT NULL AND %s' % (', '.join([self.qn(column) for column in self.columns]),
+                                                                                 self.qn(self.stage_name), where)
+        self.execute(upsert_sql(self.connection, self.table_name, [self.user_column] + self.columns, self.key_columns, source_sql),
+                     [self.request.user.pk] + list(params))
+
+    def stored_values(self, ids):
+        '''
+        Values of the plan fields of stored tuples, id => { field name : value }
+        '''
+        stored = {}
+        for chunk in chunked(ids, self.chunk_size):
+            for values in self.model.objects.filter(id__in=chunk).values('id', *self.plan.field_names):
+                stored[values.pop('id')] = self.plan.load_values(values)
+        return stored
+
+    def write(self):
+        '''
+        Writes added and updated tuples. Listeners of rows_changed get them a page of chunk_size staged tuples at a time,
+        with the values updated tuples had before
+        '''
+        if not rows_changed.has_listeners(self.model):
+            self.upsert()
+            return
+        stage = self.qn(self.stage_name)
+        for start in xrange(1, self.seq + 1, self.chunk_size):
+            page, page_params = 'stage_seq >= %s AND stage_seq < %s', [start, start + self.chunk_size]
+            changed = self.execute('SELECT stage_action, stage_target_id FROM %s WHERE stage_action IS NOT NULL AND %s' % (stage, page), page_params).fetchall()
+            if not changed:
+                continue
+            updated_ids = [target_id for action, target_id in changed if action == UPDATED]
+            old_values = self.stored_values(updated_ids)
+            self.upsert(page, page_params)
+            self.lookup("stage_action = '%s' AND %s" % (ADDED, page), page_params)
+            added_ids = [target_id for (target_id,) in self.execute("SELECT stage_target_id FROM %s WHERE stage_action = '%s' AND %s"
+                                                                    % (stage, ADDED, page), page_params).fetchall()]
+            new_values = self.stored_values(added_ids + updated_ids)
+            rows_changed.send(sender=self.model, request=self.request,
+                              added=[new_values[target_id] for target_id in added_ids],
+                              updated=[(old_values[target_id], new_values[target_id]) for target_id in updated_ids],
+                              deleted=[])
+
+    def delete_missing(self, context_uid=None):
+        '''
+        Deletes stored tuples of the owner ( all tuples of the system user for ONLY_SESSION_USER models ) which are not
+        staged, returns their number. Deleting goes through the ORM so foreign keys pointing to them are set to NULL
+        '''
+        table = self.qn(self.table_name)
+        scope = ['%s.%s = %%s' % (table, self.qn(self.user_column))]
+        params = [self.request.user.pk]
+        if context_uid:
+            owner_field = self.model._meta.get_field(self.model.owner_identifier)
+            scope.append('%s.%s = %%s' % (table, self.qn(owner_field.column)))
+            params.append(get_resolver(self.request).resolve(owner_field, context_uid).pk)
+        match, match_params = self.match(table)
+        ids = [tuple_id for (tuple_id,) in self.execute('SELECT %s.id FROM %s WHERE %s AND NOT EXISTS (SELECT 1 FROM %s WHERE %s)' % (
+               table, table, ' AND '.join(scope), self.qn(self.stage_name), match), params + match_params).fetchall()]
+
+        notify = rows_changed.has_listeners(self.model)
+        for chunk in chunked(ids, self.chunk_size):
+            if notify:
+                old_values = self.stored_values(chunk)
+            self.model.objects.filter(id__in=chunk).delete()
+            if notify:
+                rows_changed.send(sender=self.model, request=self.request, added=[], updated=[], deleted=old_values.values())
+        return len(ids)
+
+    def sync(self, response_data, context_uid=None, stream_nature=False, limit=None):
+        '''
+        Stages response_data, any iterable of response tuples, and writes the differences. Arguments are the ones of
+        save_update_delete, returns a SyncStats
+        '''
+        # sqlite commits before DDL statements, the staging table is created and dropped outside the transaction
+        self.create()
+        try:
+            with struct_cache.transaction(), transaction.commit_on_success(using=self.using):
+                for chunk in self.timer.timed(MemoryCeiling().chunks(response_data, self.chunk_size), 'fetch'):
+                    self.load(chunk)
+                with self.timer.phase('diff'):
+                    stats = self.classify()
+                with self.timer.phase('write'):
+                    self.write()
+                    if stream_nature:
+                        pass
+                    elif limit is not None and self.rows >= limit:
+                        logger.info("%s response of %d tuples may be truncated, nothing deleted" % (self.model.fqlname, self.rows))
+                    else:
+                        stats.deleted = self.delete_missing(context_uid)
+        finally:
+            self.drop()
+        return stats
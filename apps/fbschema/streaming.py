@@ -0,0 +1,110 @@
+'''
+Bounded memory ingestion. open_facebook decodes a whole fql response into one list before handing it over, for
+owners with thousands of photos ( each with its images and tags ) that list alone takes a lot of a worker's memory.
+stream_fql decodes the response incrementally with ijson, when installed, and yields tuples one by one, and
+save_update_delete consumes any such iterable in chunks ( cleaning, comparing and writing a chunk before reading
+the next one ), so memory stays flat as responses grow.
+
+settings.FBSCHEMA_INGEST_MEMORY_LIMIT sets a ceiling on the resident memory of the process in MB, chunks are halved
+while it is exceeded.
+'''
+import gc
+import logging
+import resource
+import socket
+import time
+import urllib
+import urllib2
+
+from django.conf import settings
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+INGEST_MEMORY_LIMIT = getattr(settings, 'FBSCHEMA_INGEST_MEMORY_LIMIT', None)
+# Chunks are never halved below this many tuples
+INGEST_MINIMUM_CHUNK_SIZE = 10
+STREAM_TIMEOUT = 60
+
+
+def stream_fql(graph, query):
+    '''
+    Yields the tuples of an fql query as they are decoded. Without ijson, or for graphs which aren't talking to
+    facebook over http ( no access_token or api_url ), it falls back to graph.fql. If the request fails it is sent
+    again through graph.fql, so retries and open_facebook's exception mapping still apply
+    '''
+    access_token = getattr(graph, 'access_token', None)
+    api_url = getattr(graph, 'api_url', None)
+    if ijson is None or not access_token or not api_url:
+        for response_data_dict in graph.fql(query):
+            yield response_data_dict
+        return
+
+    url = '%sfql?%s' % (api_url, urllib.urlencode({'q': query, 'access_token': access_token}))
+    # instrumented graphs ( apps.fbschema.metrics ) time the request until the response starts
+    observe_request = getattr(graph, 'observe_request', None)
+    started = time.time()
+    try:
+        response = urllib2.urlopen(url, timeout=STREAM_TIMEOUT)
+    except (urllib2.URLError, socket.timeout), e:
+        if observe_request:
+            observe_request('stream_fql', time.time() - started, 'error')
+        logger.info("Streaming fql request failed (%s), retrying through open_facebook" % e)
+        for response_data_dict in graph.fql(query):
+            yield response_data_dict
+        return
+    if observe_request:
+        observe_request('stream_fql', time.time() - started)
+    try:
+        for response_data_dict in ijson.items(response, 'data.item'):
+            yield response_data_dict
+    finally:
+        response.close()
+
+
+def resident_memory():
+    '''
+    Resident memory of the process in bytes. Outside linux the peak resident memory is the best we get
+    '''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        # ru_maxrss is in kilobytes on linux, bytes on mac
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryCeiling(object):
+    '''
+    Splits an iterable into chunks, halving the chunk size whenever the process is above the memory limit once a
+    chunk has been processed
+    '''
+    def __init__(self, limit=INGEST_MEMORY_LIMIT, minimum_chunk_size=INGEST_MINIMUM_CHUNK_SIZE):
+        self.limit = limit and limit * 1024 * 1024
+        self.minimum_chunk_size = minimum_chunk_size
+
+    def exceeded(self):
+        if not self.limit:
+            return False
+        if resident_memory() <= self.limit:
+            return False
+        gc.collect()
+        return resident_memory() > self.limit
+
+    def chunks(self, iterable, chunk_size):
+        chunk = []
+        for item in iterable:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                # the consumer is done with the chunk by now
+                chunk = []
+                if chunk_size > self.minimum_chunk_size and self.exceeded():
+                    chunk_size = max(self.minimum_chunk_size, chunk_size // 2)
+                    logger.warning("Resident memory above %d MB, ingesting %d tuples at a time" % (self.limit / 1024 / 1024, chunk_size))
+        if chunk:
+            yield chunk
@@ -0,0 +1,163 @@
+'''
+Interning of struct tuples ( StructLikeInfo, StructCommentInfo, StructAgeRange ). Most response tuples share a small
+set of distinct struct values, so instead of a get_or_create per struct per tuple the distinct values of a response
+are resolved ( or created ) in bulk and kept in a bounded LRU cache keyed by the value tuple across syncs.
+
+There is no unique constraint on struct tables, two syncs creating the same value at once may both insert it.
+Lookups therefore always pick the tuple with the lowest id, so concurrent syncs settle on the same tuple and a
+duplicate is simply never referenced.
+'''
+import operator
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db.models import Q
+from django.db.models.signals import post_delete
+
+from apps.fbschema.struct_models import StructAgeRange, StructCommentInfo, StructLikeInfo
+from apps.fbschema.bulk_utils import chunked
+
+STRUCT_CACHE_SIZE = getattr(settings, 'FBSCHEMA_STRUCT_CACHE_SIZE', 10000)
+
+# Keeps OR-ed lookups well under sqlite's parameter limit
+STRUCT_LOOKUP_CHUNK_SIZE = 100
+
+
+class StructCache(object):
+    '''
+    Thread safe LRU cache of struct tuples keyed by (model, value tuple)
+    '''
+    def __init__(self, max_size=STRUCT_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def get(self, model, key):
+        with self._lock:
+            instance = self._entries.pop((model, key), None)
+            if instance is not None:
+                self._entries[(model, key)] = instance
+            return instance
+
+    def put(self, model, key, instance):
+        with self._lock:
+            self._entries.pop((model, key), None)
+            self._entries[(model, key)] = instance
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        added = getattr(self._local, 'added', None)
+        if added is not None:
+            added.append((model, key))
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Wraps a database transaction. Tuples cached within it are forgotten if it raises, the structs it created are
+        rolled back and their ids would be dangling
+        '''
+        outer = getattr(self._local, 'added', None)
+        self._local.added = []
+        try:
+            yield
+        except Exception:
+            with self._lock:
+                for cache_key in self._local.added:
+                    self._entries.pop(cache_key, None)
+            raise
+        finally:
+            added, self._local.added = self._local.added, outer
+            if outer is not None:
+                # rolled back with the enclosing transaction too
+                outer.extend(added)
+
+    def discard_instance(self, instance):
+        with self._lock:
+            for cache_key, cached in self._entries.items():
+                if cached.__class__ is instance.__class__ and cached.pk == instance.pk:
+                    del self._entries[cache_key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+struct_cache = StructCache()
+
+
+def struct_key(model, value):
+    '''
+    Returns the normalized value tuple of a struct value received from fql, values are converted the way the
+    database would return them so that keys of cached and fetched tuples compare equal
+    '''
+    return tuple([model._meta.get_field(field_name).to_python(field_value) \
+                  for field_name, field_value in zip(model.struct_fields, model.struct_key(value))])
+
+
+def _fetch_structs(model, keys):
+    '''
+    Returns {key: tuple} for keys existing in database, picking the lowest id among duplicates
+    '''
+    found = {}
+    for chunk in chunked(keys, STRUCT_LOOKUP_CHUNK_SIZE):
+        query = reduce(operator.or_, [Q(**dict(zip(model.struct_fields, key))) for key in chunk])
+        for instance in model.objects.filter(query).order_by('-pk'):
+            found[tuple([getattr(instance, field_name) for field_name in model.struct_fields])] = instance
+    return found
+
+
+def resolve_structs(model, keys):
+    '''
+    Returns {key: tuple} for given struct keys. Cache misses are fetched with one query per chunk and those which
+    still don't exist are created with bulk_create
+    '''
+    resolved = {}
+    missing = []
+    for key in set(keys):
+        instance = struct_cache.get(model, key)
+        if instance is None:
+            missing.append(key)
+        else:
+            resolved[key] = instance
+
+    if missing:
+        found = _fetch_structs(model, missing)
+        to_create = [key for key in missing if key not in found]
+        if to_create:
+            model.objects.bulk_create([model(**dict(zip(model.struct_fields, key))) for key in to_create])
+            found.update(_fetch_structs(model, to_create))
+        for key, instance in found.items():
+            struct_cache.put(model, key, instance)
+        resolved.update(found)
+
+    return resolved
+
+
+def intern_struct(model, value):
+    '''
+    Returns the struct tuple for a single struct value received from fql
+    '''
+    key = struct_key(model, value)
+    instance = struct_cache.get(model, key)
+    if instance is None:
+        instance = resolve_structs(model, [key])[key]
+    return instance
+
+
+def prefetch_structs(model, values):
+    '''
+    Resolves all distinct struct values of a response at once, so that intern_struct afterwards hits the cache
+    '''
+    return resolve_structs(model, [struct_key(model, value) for value in values if value])
+
+
+def _discard_deleted_struct(sender, instance, **kwargs):
+    struct_cache.discard_instance(instance)
+
+for _struct_model in (StructAgeRange, StructCommentInfo, StructLikeInfo):
+    post_delete.connect(_discard_deleted_struct, sender=_struct_model, dispatch_uid="struct_cache_%s" % _struct_model.__name__)
@@ -1,9 +1,21 @@
 from django.db import models
 
+'''
+Struct models store facebook's struct data types. A struct tuple is never updated, every distinct value is stored
+once and shared by all tuples pointing to it. struct_fields and struct_key() tell apps.fbschema.struct_cache how a
+struct value received from fql maps onto those fields
+'''
+
 class StructAgeRange(models.Model):
     min             = models.IntegerField()
     max             = models.IntegerField( blank=True, null=True )
 
+    struct_fields   = ('min',) # max has to be done with exception handling
+
+    @classmethod
+    def struct_key(self, value):
+        return (value['min'],)
+
 class StructCommentInfo(models.Model):
     can_comment     = models.NullBooleanField( blank=True, null=True, help_text="Whether the comments are allowed on the object" )
     comment_count   = models.IntegerField( blank=True, null=True, help_text="The number of comments on this object." )
@@ -11,8 +23,26 @@ class StructCommentInfo(models.Model):
     #comment_list   = models.TextField( blank=True, null=True, help_text="The list of comments on the post")
     #TODO: In next pass uncomment this line ^
 
+    struct_fields   = ('can_comment', 'comment_count')
+
+    @classmethod
+    def struct_key(self, value):
+        comment_count = value.get('comment_count', None)
+        if comment_count is None:
+            comment_count = value.get('count', None)
+        return (value.get('can_comment', None), comment_count)
+
 class StructLikeInfo(models.Model):
     can_like        = models.NullBooleanField( blank=True, null=True, help_text="Whether the viewer can like the object" )
     like_count      = models.IntegerField( blank=True, null=True, help_text="The number of likes on this object." )
     user_likes      = models.NullBooleanField( blank=True, null=True, help_text="Whether the viewer likes this object" )
-    
+
+    struct_fields   = ('can_like', 'like_count', 'user_likes')
+
+    @classmethod
+    def struct_key(self, value):
+        like_count = value.get('like_count', None)
+        if like_count is None:
+            like_count = value.get('count', None)
+        return (value.get('can_like', None), like_count, value.get('user_likes', None))
+
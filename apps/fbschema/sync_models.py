@@ -0,0 +1,132 @@
+from django.db import models
+from django.contrib.auth.models import User
+
+'''
+Bookkeeping models of the sync machinery, they don't map onto any fql table
+'''
+
+class SyncJob(models.Model):
+    '''
+    A table download queued by one of the table_* views and run by a worker process, see apps.fbschema.jobs
+    '''
+    PENDING             = 'pending'
+    RUNNING             = 'running'
+    DONE                = 'done'
+    FAILED              = 'failed'
+    STATUS_CHOICES      = ((PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'))
+
+    user                = models.ForeignKey(User, help_text="System user on whose behalf the job runs")
+    task                = models.CharField( max_length=100, help_text="Name of the task in apps.fbschema.tasks" )
+    status              = models.CharField( max_length=20, choices=STATUS_CHOICES, default=PENDING, db_index=True )
+    message             = models.TextField( blank=True, null=True, help_text="Traceback of a failed job" )
+    worker              = models.CharField( max_length=255, blank=True, null=True, help_text="host:pid of the worker running the job" )
+    created             = models.DateTimeField( auto_now_add=True )
+    started             = models.DateTimeField( blank=True, null=True )
+    finished            = models.DateTimeField( blank=True, null=True )
+
+    def __unicode__(self):
+        return "%s #%s (%s)" % (self.task, self.id, self.status)
+
+    class Meta:
+        ordering = ('id',)
+
+
+class SyncCheckpoint(models.Model):
+    '''
+    Durable position of a friend batch download, see apps.fbschema.scheduler. Friends are walked in the order
+    of their id, everything up to last_friend_id has been stored
+    '''
+    user                = models.ForeignKey(User, help_text="System user whose friends are being walked")
+    table               = models.CharField( max_length=100, help_text="Name of the friend batch task" )
+    last_friend_id      = models.IntegerField( default=0, help_text="Id of the last FacebookFriend tuple already processed" )
+    done                = models.IntegerField( default=0, help_text="Number of friends processed in the current pass" )
+    total               = models.IntegerField( default=0, help_text="Number of friends in the current pass" )
+    completed           = models.BooleanField( default=False, help_text="Whether the current pass has covered all friends" )
+    started             = models.DateTimeField( blank=True, null=True, help_text="When the current pass started" )
+    updated             = models.DateTimeField( auto_now=True )
+
+    def progress(self):
+        '''
+        Fraction of friends processed in the current pass
+        '''
+        if not self.total:
+            return 1.0 if self.completed else 0.0
+        return float(self.done) / self.total
+
+    def __unicode__(self):
+        return "%s %s %d/%d" % (self.user, self.table, self.done, self.total)
+
+    class Meta:
+        unique_together = (("user", "table"),)
+
+
+class SyncFailure(models.Model):
+    '''
+    Friend skipped by a friend batch download because its query kept failing on its own, see apps.fbschema.scheduler.
+    Later passes try the friend again, the record is dropped once its tuples are stored
+    '''
+    user                = models.ForeignKey(User, help_text="System user whose friends are being walked")
+    table               = models.CharField( max_length=100, help_text="Name of the friend batch task" )
+    uid                 = models.BigIntegerField( help_text="uid of the skipped friend" )
+    attempts            = models.IntegerField( default=0, help_text="Number of passes which skipped the friend" )
+    message             = models.TextField( blank=True, null=True, help_text="Last error of the friend's query" )
+    updated             = models.DateTimeField( auto_now=True )
+
+    def __unicode__(self):
+        return "%s %s %s (%d)" % (self.user, self.table, self.uid, self.attempts)
+
+    class Meta:
+        unique_together = (("user", "table", "uid"),)
+
+
+class SyncHighWaterMark(models.Model):
+    '''
+    Newest value of a model's incremental_field seen for an owner, see apps.fbschema.incremental. Later syncs only
+    ask facebook for tuples changed since then, until the next full reconciliation is due
+    '''
+    user                = models.ForeignKey(User, help_text="System user the tuples have been synced for")
+    table               = models.CharField( max_length=100, help_text="fqlname of the synced model" )
+    owner_uid           = models.BigIntegerField( blank=True, null=True, help_text="uid of the friend owning the tuples, null for the user itself" )
+    value               = models.BigIntegerField( blank=True, null=True, help_text="Unix timestamp, newest incremental_field value stored so far" )
+    last_full_sync      = models.DateTimeField( blank=True, null=True, help_text="When tuples of the owner were last reconciled in full, deletions included" )
+    updated             = models.DateTimeField( auto_now=True )
+
+    def __unicode__(self):
+        return "%s %s %s >= %s" % (self.user, self.table, self.owner_uid or 'me', self.value)
+
+    class Meta:
+        unique_together = (("user", "table", "owner_uid"),)
+
+
+class SyncMetric(models.Model):
+    '''
+    Running total of one metric series, worker processes add what they measured so that the metrics view sees all
+    of them, see apps.fbschema.metrics
+    '''
+    name                = models.CharField( max_length=100, help_text="Series name, e.g. fbschema_sync_rows_total" )
+    labels              = models.CharField( max_length=255, help_text="Prometheus label set, e.g. model=\"album\",user=\"1\"" )
+    value               = models.FloatField( default=0 )
+    updated             = models.DateTimeField( auto_now=True )
+
+    def __unicode__(self):
+        return "%s{%s} %s" % (self.name, self.labels, self.value)
+
+    class Meta:
+        unique_together = (("name", "labels"),)
+
+
+class TableGeneration(models.Model):
+    '''
+    Generation number of the tuples of an fql table of a system user, bumped whenever they are written. Results
+    cached by the web processes are keyed by it, see apps.fbschema.fql_server. It is kept in the database so that
+    writes of worker processes make them stale too
+    '''
+    table               = models.CharField( max_length=100, help_text="fqlname of the table" )
+    viewer              = models.IntegerField( default=0, help_text="Id of the system user, 0 for the tuples shared by all users" )
+    value               = models.BigIntegerField( default=0 )
+
+    def __unicode__(self):
+        return "%s %s %d" % (self.table, self.viewer, self.value)
+
+    class Meta:
+        unique_together = (("table", "viewer"),)
@@ -0,0 +1,455 @@
+'''
+Synthetic facebook data, a made up viewer with friends, albums, photos, links, likes, a news feed and notifications
+at whatever scale is asked for. Tuples are shaped like facebook's fql responses ( every column of the fbschema
+model, unix timestamps, structs as dicts, arrays as lists ) so they go through the same ingestion as real ones.
+
+    facebook = SyntheticFacebook(friends=500, albums=10, photos=50)
+    facebook.fql("SELECT aid, name FROM album WHERE owner=me()")
+
+Everything is derived from the seed, the same settings always produce the same tuples, so consecutive syncs see an
+unchanged graph. revision simulates activity, every revision touches a churn fraction of the tuples ( new modified
+time, like count and text ) the way friends editing their albums would.
+'''
+import hashlib
+import random
+import time
+
+from django.db import models
+
+from apps.fbschema.fields import JSONField
+from apps.fbschema.fql_engine import FqlError, get_table_model, parse
+from apps.fbschema.utils import get_fql_fields
+
+# 1 Nov 2013, tuples are dated in the year before it unless told otherwise
+SYNTHETIC_NOW = 1383264000
+DAY = 60 * 60 * 24
+
+FIRST_NAMES = ['Aarav', 'Priya', 'Rahul', 'Ananya', 'Vikram', 'Sneha', 'Arjun', 'Kavya', 'John', 'Emma', 'Liam',
+               'Olivia', 'Noah', 'Sophia', 'Lucas', 'Mia', 'Ravi', 'Neha', 'Karan', 'Isha']
+LAST_NAMES = ['Sharma', 'Patel', 'Iyer', 'Gupta', 'Singh', 'Reddy', 'Smith', 'Jones', 'Brown', 'Miller', 'Garcia',
+              'Khan', 'Das', 'Nair', 'Mehta']
+WORDS = ['trip', 'beach', 'friends', 'weekend', 'birthday', 'party', 'college', 'road', 'mountains', 'rain', 'coffee',
+         'sunset', 'family', 'wedding', 'concert', 'goa', 'delhi', 'cricket', 'match', 'new', 'old', 'best', 'day',
+         'night', 'photos', 'memories', 'with', 'the', 'and', 'at', 'finally', 'awesome', 'lunch', 'office', 'home']
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+          'November', 'December']
+URL_HINTS = ('link', 'url', 'src', 'picture', 'href', 'permalink', 'icon')
+
+'''
+Column restricting each table to the tuples of one owner, queries on it only generate that owner's tuples
+'''
+OWNER_COLUMNS = {
+    'user': 'uid',
+    'friend': 'uid1',
+    'like': 'user_id',
+    'album': 'owner',
+    'photo': 'owner',
+    'link': 'owner',
+    'stream': 'viewer_id',
+    'stream_filter': 'uid',
+    'notification': 'recipient_id',
+}
+
+# Tables having tuples for every user, the others only have the viewer's
+USER_TABLES = ('user', 'like', 'album', 'photo', 'link')
+
+STREAM_FILTER_COLUMNS = ['uid', 'filter_key', 'name', 'rank', 'type', 'is_visible']
+STREAM_FILTERS = [('nf', 'News Feed', 'newsfeed'), ('lf', 'Status Updates', 'friendlist'), ('app_2305272732', 'Photos', 'application')]
+
+
+def seed_of(*parts):
+    return int(hashlib.md5(':'.join([str(part) for part in parts])).hexdigest()[:16], 16)
+
+
+def coerce(value):
+    '''
+    fql compares numbers and numeric strings alike, uid=me() and uid='1000...' are the same condition
+    '''
+    if isinstance(value, basestring) and value.isdigit():
+        return int(value)
+    return value
+
+
+class SyntheticFacebook(object):
+    '''
+    friends is the number of friends of the viewer, albums, links and likes are counts per user, photos per album,
+    posts and notifications are counts for the viewer. missing is the fraction of nullable columns left empty
+    '''
+    def __init__(self, me=100000000000001, friends=100, albums=5, photos=20, links=10, likes=20, posts=100,
+                 notifications=20, seed=0, now=SYNTHETIC_NOW, history_days=365, revision=0, churn=0.05, missing=0.1):
+        self.me = int(me)
+        self.albums = albums
+        self.photos = photos
+        self.links = links
+        self.likes = likes
+        self.posts = posts
+        self.notifications = notifications
+        self.seed = seed
+        self.now = now
+        self.history_days = history_days
+        self.revision = revision
+        self.churn = churn
+        self.missing = missing
+        self.friends = [100000000000000 + seed_of(seed, 'friend', self.me, index) % 900000000000000 for index in range(friends)]
+        self.users = set([self.me] + self.friends)
+
+    def owners(self, table):
+        if table in USER_TABLES:
+            return [self.me] + self.friends
+        return [self.me]
+
+    def columns(self, table):
+        if table == 'stream_filter':
+            return STREAM_FILTER_COLUMNS
+        return [field.name for field in get_fql_fields(get_table_model(table))]
+
+    # Values
+
+    def object_id(self, table, owner, index):
+        return 10000000000 + seed_of(self.seed, table, owner, index) % 90000000000000
+
+    def timestamp(self, rng):
+        return self.now - rng.randint(0, self.history_days * DAY)
+
+    def text(self, rng, words):
+        return ' '.join([rng.choice(WORDS) for i in range(words)]).capitalize()
+
+    def url(self, rng, owner=None):
+        return 'https://www.facebook.com/%s/%d' % (owner or 'photo.php', rng.randint(1, 10 ** 12))
+
+    def friend(self, rng):
+        return rng.choice(self.friends) if self.friends else self.me
+
+    def field_value(self, rng, field):
+        '''
+        A plausible value for a model column, as facebook would send it
+        '''
+        name = field.name
+        if isinstance(field, models.ForeignKey):
+            struct = field.rel.to.__name__
+            if struct == 'StructLikeInfo':
+                return {'can_like': True, 'like_count': rng.randint(0, 60), 'user_likes': rng.random() < 0.2}
+            if struct == 'StructCommentInfo':
+                return {'can_comment': True, 'comment_count': rng.randint(0, 25), 'comment_order': 'chronological'}
+            if struct == 'StructAgeRange':
+                return {'min': 21}
+            return None
+        if isinstance(field, models.DateTimeField):
+            return self.timestamp(rng)
+        if isinstance(field, (models.BooleanField, models.NullBooleanField)):
+            return rng.random() < 0.5
+        if isinstance(field, models.BigIntegerField):
+            return rng.randint(10 ** 9, 10 ** 14)
+        if isinstance(field, models.IntegerField):
+            return rng.randint(0, 500)
+        if isinstance(field, models.EmailField):
+            return 'user%d@example.com' % rng.randint(1, 10 ** 6)
+        if isinstance(field, models.CharField):
+            if any([hint in name for hint in URL_HINTS]):
+                return self.url(rng)
+            if name.endswith('cursor'):
+                return '%016x' % rng.getrandbits(64)
+            return self.text(rng, 2)[:field.max_length]
+        if isinstance(field, JSONField):
+            return []
+        if isinstance(field, models.TextField):
+            return self.text(rng, rng.randint(3, 15))
+        return None
+
+    def base_row(self, table, rng):
+        row = {}
+        for field in get_fql_fields(get_table_model(table)):
+            if field.null and rng.random() < self.missing:
+                row[field.name] = None
+            else:
+                row[field.name] = self.field_value(rng, field)
+        return row
+
+    # Tuples
+
+    def rows(self, table, owner):
+        '''
+        Yields the tuples of a table belonging to given owner, large tables are never held in memory as a whole
+        '''
+        owner = coerce(owner)
+        if owner not in (self.users if table in USER_TABLES else (self.me,)):
+            return
+        generate = getattr(self, 'generate_%s' % table)
+        for index, row in enumerate(generate(owner)):
+            for revision in range(1, self.revision + 1):
+                if seed_of(self.seed, table, owner, index, 'revision', revision) % 10000 < self.churn * 10000:
+                    self.touch(table, row, (owner, index), revision)
+            yield row
+
+    def touch(self, table, row, position, revision):
+        rng = random.Random(seed_of(self.seed, table, position, revision))
+        field = getattr(get_table_model(table), 'incremental_field', None) if table != 'stream_filter' else None
+        if field:
+            row[field] = self.now + revision * 3600
+        if row.get('like_info'):
+            row['like_info'] = dict(row['like_info'], like_count=row['like_info']['like_count'] + 1)
+        for column in ('name', 'caption', 'message', 'title', 'about_me'):
+            if column in row:
+                row[column] = self.text(rng, rng.randint(3, 15))
+
+    def generate_user(self, uid):
+        rng = random.Random(seed_of(self.seed, 'user', uid))
+        row = self.base_row('user', rng)
+        first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        row.update({
+            'uid': uid,
+            'first_name': first_name,
+            'username': '%s.%s.%d' % (first_name.lower(), last_name.lower(), uid % 1000),
+            'email': '%s.%s@example.com' % (first_name.lower(), uid % 100000),
+            'sex': rng.choice(['male', 'female']),
+            'birthday': '%s %d, %d' % (rng.choice(MONTHS), rng.randint(1, 28), rng.randint(1970, 1995)),
+            'relationship_status': rng.choice(['Single', 'In a relationship', 'Married', None]),
+            'friend_count': len(self.friends) if uid == self.me else rng.randint(50, 1500),
+            'website': 'http://%s%s.example.com' % (first_name.lower(), uid % 1000),
+            'devices': [{'os': rng.choice(['Android', 'iOS'])}],
+            'education': [{'school': {'id': rng.randint(10 ** 9, 10 ** 12), 'name': '%s College' % rng.choice(LAST_NAMES)}, 'type': 'College'}],
+            'work': [{'employer': {'id': rng.randint(10 ** 9, 10 ** 12), 'name': '%s Ltd' % rng.choice(LAST_NAMES)}}],
+        })
+        return [row]
+
+    def generate_friend(self, uid):
+        return [{'uid1': uid, 'uid2': friend} for friend in self.friends]
+
+    def generate_like(self, uid):
+        for index in range(self.likes):
+            rng = random.Random(seed_of(self.seed, 'like', uid, index))
+            yield {
+                'object_id': self.object_id('like', uid, index),
+                'object_type': rng.choice(['page', 'photo', 'link', 'status', 'album']),
+                'post_id': None,
+                'user_id': uid,
+            }
+
+    def album_aid(self, uid, index):
+        return '%d_%d' % (uid, 10000 + index)
+
+    def generate_album(self, uid):
+        for index in range(self.albums):
+            rng = random.Random(seed_of(self.seed, 'album', uid, index))
+            row = self.base_row('album', rng)
+            created = self.timestamp(rng)
+            row.update({
+                'aid': self.album_aid(uid, index),
+                'object_id': self.object_id('album', uid, index),
+                'owner': uid,
+                'cover_pid': self.object_id('photo', uid, (index, 0)),
+                'cover_object_id': self.object_id('photo', uid, (index, 0)),
+                'created': created,
+                'modified': rng.randint(created, self.now),
+                'name': self.text(rng, rng.randint(1, 5)),
+                'photo_count': self.photos,
+                'type': 'profile' if index == 0 else rng.choice(['normal', 'mobile', 'wall']),
+                'visible': rng.choice(['everyone', 'friends', 'custom']),
+                'link': 'https://www.facebook.com/album.php?fbid=%d' % self.object_id('album', uid, index),
+            })
+            yield row
+
+    def generate_photo(self, uid):
+        for album in range(self.albums):
+            for index in range(self.photos):
+                rng = random.Random(seed_of(self.seed, 'photo', uid, album, index))
+                row = self.base_row('photo', rng)
+                object_id = self.object_id('photo', uid, (album, index))
+                created = self.timestamp(rng)
+                src = 'https://fbcdn-sphotos.example.com/%d_%d' % (object_id, rng.randint(10 ** 6, 10 ** 7))
+                row.update({
+                    'object_id': object_id,
+                    'pid': object_id,
+                    'owner': uid,
+                    'aid': self.album_aid(uid, album),
+                    'album_object_id': self.object_id('album', uid, album),
+                    'created': created,
+                    'modified': rng.randint(created, self.now),
+                    'caption': self.text(rng, rng.randint(0, 20)),
+                    'position': index + 1,
+                    'src': src + '_s.jpg',
+                    'src_small': src + '_t.jpg',
+                    'src_big': src + '_n.jpg',
+                    'images': [{'height': size * 3 / 4, 'width': size, 'source': '%s_%d.jpg' % (src, size)}
+                               for size in (2048, 960, 720, 600, 480, 320, 180, 130)],
+                    'caption_tags': {},
+                    'link': 'https://www.facebook.com/photo.php?fbid=%d' % object_id,
+                })
+                yield row
+
+    def generate_link(self, uid):
+        for index in range(self.links):
+            rng = random.Random(seed_of(self.seed, 'link', uid, index))
+            row = self.base_row('link', rng)
+            row.update({
+                'link_id': self.object_id('link', uid, index),
+                'owner': uid,
+                'created_time': self.timestamp(rng),
+                'url': 'http://www.example.com/%s/%d' % (rng.choice(WORDS), index),
+                'title': self.text(rng, rng.randint(3, 10)),
+                'summary': self.text(rng, rng.randint(10, 40)),
+                'owner_comment': self.text(rng, rng.randint(0, 12)),
+                'image_urls': ['https://external.example.com/safe_image.php?d=%d' % rng.randint(1, 10 ** 9)],
+                'via_id': None,
+            })
+            yield row
+
+    def generate_stream(self, uid):
+        for index in range(self.posts):
+            rng = random.Random(seed_of(self.seed, 'stream', uid, index))
+            row = self.base_row('stream', rng)
+            actor = self.friend(rng)
+            created = self.timestamp(rng)
+            row.update({
+                'post_id': '%d_%d' % (actor, self.object_id('stream', uid, index)),
+                'viewer_id': uid,
+                'actor_id': actor,
+                'source_id': actor,
+                'target_id': None,
+                'filter_key': rng.choice(['nf', 'nf', 'lf', 'app_2305272732']),
+                'created_time': created,
+                'updated_time': rng.randint(created, self.now),
+                'message': self.text(rng, rng.randint(0, 30)),
+                'type': rng.choice([46, 56, 80, 247]),
+                'tagged_ids': [self.friend(rng) for i in range(rng.randint(0, 3))],
+                'action_links': None,
+                'permalink': 'https://www.facebook.com/%d/posts/%d' % (actor, index),
+                'with_tags': [self.friend(rng) for i in range(rng.randint(0, 1))],
+            })
+            yield row
+
+    def generate_stream_filter(self, uid):
+        return [{'uid': uid, 'filter_key': key, 'name': name, 'rank': rank, 'type': type, 'is_visible': True}
+                for rank, (key, name, type) in enumerate(STREAM_FILTERS)]
+
+    def generate_notification(self, uid):
+        for index in range(self.notifications):
+            rng = random.Random(seed_of(self.seed, 'notification', uid, index))
+            row = self.base_row('notification', rng)
+            created = self.timestamp(rng)
+            title = '%s commented on your photo.' % rng.choice(FIRST_NAMES)
+            row.update({
+                'notification_id': self.object_id('notification', uid, index),
+                'recipient_id': uid,
+                'sender_id': self.friend(rng),
+                'created_time': created,
+                'updated_time': rng.randint(created, self.now),
+                'title_text': title,
+                'title_html': '<span>%s</span>' % title,
+                'is_unread': rng.choice([0, 1]),
+                'is_hidden': 0,
+                'object_type': 'photo',
+                'object_id': str(self.object_id('photo', uid, (0, index % max(self.photos, 1)))),
+                'href': 'https://www.facebook.com/photo.php?fbid=%d' % rng.randint(1, 10 ** 12),
+            })
+            yield row
+
+    # Queries
+
+    def fql(self, query):
+        '''
+        Answers an fql query, FqlError for queries which don't parse or read unknown tables or columns
+        '''
+        return self.execute(parse(query))
+
+    def execute(self, tree):
+        query, columns, table, condition, order, offset, limit = tree
+        if table not in OWNER_COLUMNS:
+            raise FqlError("Table %s is not known to the synthetic graph" % table)
+        known = set(self.columns(table))
+        for column in columns:
+            if column not in known:
+                raise FqlError("%s is not a member of the %s table" % (column, table))
+        condition = self.bind(condition)
+        owners = self.restricted_owners(condition, OWNER_COLUMNS[table])
+        if owners is None:
+            owners = self.owners(table)
+        rows = []
+        for owner in owners:
+            rows.extend([row for row in self.rows(table, owner) if condition is None or self.matches(row, condition)])
+        for column, descending in reversed(order):
+            rows.sort(key=lambda row: row.get(column), reverse=descending)
+        if offset or limit is not None:
+            rows = rows[offset or 0:(offset or 0) + limit if limit is not None else None]
+        return [dict([(column, row.get(column)) for column in columns]) for row in rows]
+
+    def bind(self, condition):
+        '''
+        Runs the subqueries of a condition once, replacing them with the values they return
+        '''
+        if condition is None:
+            return None
+        kind = condition[0]
+        if kind in ('and', 'or'):
+            return (kind, [self.bind(part) for part in condition[1]])
+        if kind == 'not':
+            return (kind, self.bind(condition[1]))
+        if kind == 'in' and condition[2][0] == 'query':
+            return (kind, condition[1], [('value', value) for value in self.values(condition[2])])
+        return condition
+
+    def restricted_owners(self, condition, column):
+        '''
+        Owners a condition restricts the owner column to, None if the condition doesn't
+        '''
+        if condition is None:
+            return None
+        kind = condition[0]
+        if kind == 'and':
+            for part in condition[1]:
+                owners = self.restricted_owners(part, column)
+                if owners is not None:
+                    return owners
+        elif kind == 'compare' and condition[1] == '=':
+            left, right = condition[2], condition[3]
+            if right == ('column', column):
+                left, right = right, left
+            if left == ('column', column) and right[0] != 'column':
+                return [coerce(self.value(None, right))]
+        elif kind == 'in' and condition[1] == ('column', column):
+            return [coerce(value) for value in self.values(condition[2])]
+        return None
+
+    def values(self, values):
+        if values[0] == 'query':
+            return [row.values()[0] for row in self.execute(values)]
+        return [self.value(None, operand) for operand in values]
+
+    def value(self, row, operand):
+        kind = operand[0]
+        if kind == 'value':
+            return operand[1]
+        if kind == 'column':
+            if row is None or operand[1] not in row:
+                raise FqlError("%s is not a member of the table" % operand[1])
+            return row[operand[1]]
+        name, arguments = operand[1], [self.value(row, argument) for argument in operand[2]]
+        if name == 'me':
+            return self.me
+        if name == 'now':
+            return int(time.time())
+        if name == 'lower':
+            return (arguments[0] or '').lower()
+        if name == 'strpos':
+            return (arguments[0] or '').find(arguments[1])
+        raise FqlError("Function %s is not supported" % name)
+
+    def matches(self, row, condition):
+        kind = condition[0]
+        if kind == 'and':
+            return all([self.matches(row, part) for part in condition[1]])
+        if kind == 'or':
+            return any([self.matches(row, part) for part in condition[1]])
+        if kind == 'not':
+            return not self.matches(row, condition[1])
+        if kind == 'in':
+            return coerce(self.value(row, condition[1])) in set([coerce(value) for value in self.values(condition[2])])
+        operator, left, right = condition[1:]
+        left, right = coerce(self.value(row, left)), coerce(self.value(row, right))
+        if operator == '=':
+            return left == right
+        if operator in ('!=', '<>'):
+            return left != right
+        if left is None or right is None:
+            return False
+        return {'<': left < right, '<=': left <= right, '>': left > right, '>=': left >= right}[operator]
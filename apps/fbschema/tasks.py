@@ -0,0 +1,206 @@
+'''
+Table download tasks, they fetch, parse and store fql tables. The table_* views queue them as background jobs,
+see apps.fbschema.jobs. Every task is called as task(request, graph)
+'''
+import logging
+
+from apps.fbschema.models import *
+from apps.fbschema.jobs import register_task
+from apps.fbschema.scheduler import FriendBatchScheduler
+from apps.fbschema.incremental import HighWaterMarks
+from apps.fbschema.streaming import stream_fql
+from apps.fbschema.fql_server import invalidate
+
+logger = logging.getLogger(__name__)
+
+
+@register_task
+def table_user(request, graph):
+    '''
+    To Fetch, Parse and Store user table data
+    '''
+    response_data = graph.fql(FacebookUser.fql_query('WHERE uid=me()'))
+    FacebookUser.save_profiles(request, response_data[:1])
+
+
+@register_task
+def table_friend(request, graph):
+    '''
+    To Fetch, Parse and Store friend table data, friendships which are gone are deleted
+    '''
+    response_data = graph.fql(FacebookFriend.fql_query('WHERE uid1=me()'))
+    FacebookFriend.save_update_delete(request, response_data, bulk=True)
+
+
+@register_task
+def table_user_friends_batch(request, graph):
+    '''
+    I am using batch queries, let us taste performance gain
+    '''
+    def store(friends, response_dataset):
+        response_data = []
+        for response_data_list in response_dataset.values():
+            try:
+                response_data.append(response_data_list[0])
+            except IndexError:
+                logger.info("A user query returned no information")
+        FacebookUser.save_profiles(request, response_data)
+
+    # Profiles are shared by all system users, a friend's profile fresh from anyone's download isn't downloaded again
+    fresh = FacebookUser.fresh_uids(FacebookFriend.objects.filter(user=request.user).values_list('uid2', flat=True))
+
+    def query_for_friend(friend):
+        if friend.uid2 in fresh:
+            return FacebookUser.fql_query_viewer("WHERE uid=%d" % friend.uid2)
+        return FacebookUser.fql_query("WHERE uid=%d" % friend.uid2)
+
+    # Conclusion 100 batched queries at a time are enough for a while, BatchFetcher adapts it to facebook's latency
+    scheduler = FriendBatchScheduler(request, 'table_user_friends_batch', batch_size=100)
+    scheduler.run(graph, query_for_friend, store)
+
+
+@register_task
+def table_like(request, graph):
+    '''
+    User Likes
+    '''
+    response_data = graph.fql(FacebookLike.fql_query('WHERE user_id=me()'))
+
+    for response_data_dict in response_data:
+        data_dict = FacebookLike.prepare_dict(response_data_dict, request)
+        logger.debug("like %s" % data_dict)
+        facebook_like = FacebookLike(**data_dict)
+        facebook_like.save()
+    invalidate(FacebookLike, None)
+
+
+@register_task
+def table_like_friends_batch(request, graph):
+    '''
+    table_like => me and my friends => my friends in batch queries => table_like_friends_batch
+    Warning: work under construction
+    '''
+    # OpenFacebookException at /table/like_friends_batch
+    # The indexed user_id queried on must be the logged in user
+    # Note: that means we can fetch user_id[s?] if we have object_id, but we cannot fetch all object_ids for a give user_id [ makes sense ]
+
+    def store(friends, response_dataset):
+        for response_data in response_dataset.values():
+            response_data_dict = response_data[0]
+            data_dict = FacebookLike.prepare_dict(response_data_dict, request)
+            facebook_like = FacebookLike(**data_dict)
+            facebook_like.save()
+        invalidate(FacebookLike, None)
+
+    scheduler = FriendBatchScheduler(request, 'table_like_friends_batch', batch_size=100)
+    scheduler.run(graph, lambda friend: FacebookLike.fql_query("WHERE user_id=%d" % friend.uid2), store)
+
+
+@register_task
+def table_album(request, graph):
+    '''
+    table album
+    '''
+    context_model = FacebookAlbum
+    marks = HighWaterMarks(request, context_model)
+    response_data = stream_fql(graph, marks.fql_query_me())
+    marks.save_update_delete(request, response_data, bulk=True)
+
+
+@register_task
+def table_album_friends_batch(request, graph):
+    '''
+    table album for friends
+    '''
+    context_model = FacebookAlbum
+
+    marks = HighWaterMarks(request, context_model)
+
+    def store(friends, response_dataset):
+        friends = dict([(str(friend.id), friend) for friend in friends])
+        for friend_id, response_data in response_dataset.items():
+            marks.save_update_delete(request, response_data, owner_uid=friends[str(friend_id)].uid2, bulk=True)
+
+    scheduler = FriendBatchScheduler(request, 'table_album_friends_batch', batch_size=100)
+    scheduler.run(graph, lambda friend: marks.fql_query_my_friends(friend.uid2), store)
+
+
+@register_task
+def table_photo(request, graph):
+    '''
+    table photo
+    '''
+    # depends on Album  i.e. for a photo its parent album should exist
+    context_model = FacebookPhoto
+    marks = HighWaterMarks(request, context_model)
+    response_data = stream_fql(graph, marks.fql_query_me())
+    marks.save_update_delete(request, response_data, bulk=True)
+
+
+@register_task
+def table_photo_friends_batch(request, graph):
+    '''
+    table photo for friends
+    '''
+    context_model = FacebookPhoto
+
+    marks = HighWaterMarks(request, context_model)
+
+    def store(friends, response_dataset):
+        friends = dict([(str(friend.id), friend) for friend in friends])
+        for friend_id, response_data in response_dataset.items():
+            marks.save_update_delete(request, response_data, owner_uid=friends[str(friend_id)].uid2, bulk=True)
+
+    # photo counts can be huge for each friend, starting with 2 friends at a time
+    scheduler = FriendBatchScheduler(request, 'table_photo_friends_batch', batch_size=2)
+    scheduler.run(graph, lambda friend: marks.fql_query_my_friends(friend.uid2), store)
+
+
+@register_task
+def table_notification(request, graph):
+    '''
+    table notification
+    '''
+    context_model = FacebookNotification
+    response_data = stream_fql(graph, context_model.fql_query_me())
+    context_model.save_update_delete(request, response_data, stream_nature=True, bulk=True)
+
+
+@register_task
+def table_link(request, graph):
+    '''
+    table link : Save update
+    '''
+    context_model = FacebookLink
+    marks = HighWaterMarks(request, context_model)
+    response_data = stream_fql(graph, marks.fql_query_me())
+    marks.save_update_delete(request, response_data, bulk=True)
+
+
+@register_task
+def table_link_friends_batch(request, graph):
+    '''
+    table link for friends
+    '''
+    context_model = FacebookLink
+
+    marks = HighWaterMarks(request, context_model)
+
+    def store(friends, response_dataset):
+        friends = dict([(str(friend.id), friend) for friend in friends])
+        for friend_id, response_data in response_dataset.items():
+            marks.save_update_delete(request, response_data, owner_uid=friends[str(friend_id)].uid2, bulk=True)
+
+    scheduler = FriendBatchScheduler(request, 'table_link_friends_batch', batch_size=3)
+    scheduler.run(graph, lambda friend: marks.fql_query_my_friends(friend.uid2), store)
+
+
+@register_task
+def table_stream(request, graph):
+    '''
+    table stream
+    '''
+    context_model = FacebookStream
+    marks = HighWaterMarks(request, context_model)
+    response_data = stream_fql(graph, marks.fql_query_me())
+    marks.save_update_delete(request, response_data, stream_nature=True, bulk=True)
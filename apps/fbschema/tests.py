@@ -1,15 +1,972 @@
-from django.test import TestCase
-from fb_client.apps.fbschema.utils import *
-from fb_client.apps.fbschema.models import *
+import datetime
+import subprocess
+
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from apps.fbschema.utils import *
+from apps.fbschema.models import *
+from apps.fbschema.parse_utils import parse_fbdate
+from apps.fbschema.bulk_utils import bulk_update, update_batch_size
+from apps.fbschema.ingest import get_ingest_plan
+from apps.fbschema.resolvers import UnresolvedForeignKey, get_resolver
+from apps.fbschema.struct_cache import StructCache, intern_struct, prefetch_structs, struct_cache, struct_key
+from apps.fbschema.fakegraph import SyntheticGraph
+from apps.fbschema.benchmarks import SyncBenchmark, compare
+from apps.fbschema.metrics import SyncTimer, registry, render
+from open_facebook import exceptions as open_facebook_exceptions
+from apps.fbschema.fetch import AdaptiveBatchSize, BatchFetcher
+from apps.fbschema.scheduler import FriendBatchScheduler
+from apps.fbschema.incremental import HighWaterMarks, clause_limit
+from apps.fbschema import fql_engine, fql_server, history, streaming, tasks
+from apps.fbschema.jobs import JobRequest, claim_job, enqueue_job, requeue_stale_jobs, worker_name
+from apps.fbschema.synthetic import SYNTHETIC_NOW, SyntheticFacebook
+from apps.fbschema.edges import listing
+from apps.fbschema.aggregates import top, group_counts, rebuild_aggregates
+from apps.fbschema import search
+from apps.fbschema.corpus import CorpusPipeline
+from apps.fbschema.social_graph import social_graph
+from apps.fbschema.admin_utils import KeysetPaginator, estimated_count
+from apps.fbschema.staging import can_stage, upsert_key
 
 class UtilityMethodTestcases(TestCase):
-    def get_fields_from_model_test(self):
-        self.assertIsInstance(get_fields_from_model, 'str')
-'''
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
-'''        
+    def test_get_fields_from_model(self):
+        self.assertIsInstance(get_fields_from_model(FacebookAlbum), str)
+        self.assertIn('aid', get_fields_from_model(FacebookAlbum).split(', '))
+
+    def test_compare_keys_with_fields(self):
+        fields = get_fieldlist_from_model(FacebookLink)
+        self.assertTrue(compare_keys_with_fields(FacebookLink, fields))
+        self.assertFalse(compare_keys_with_fields(FacebookLink, fields[1:]))
+
+    def test_parse_fbdate(self):
+        self.assertEqual(parse_fbdate('August 12, 1985'), datetime.datetime(1985, 8, 12))
+        self.assertEqual(parse_fbdate('August 12').month, 8)
+        self.assertIsInstance(parse_fbdate(1383264000), datetime.datetime)
+
+
+class SyntheticGraphTestcases(TestCase):
+    def test_queries(self):
+        graph = SyntheticGraph(friends=3, albums=2, photos=4)
+        friends = graph.fql("SELECT uid2 FROM friend WHERE uid1=me()")
+        self.assertEqual(len(friends), 3)
+        photos = graph.fql(FacebookPhoto.fql_query("WHERE owner=%d" % friends[0]['uid2']))
+        self.assertEqual(len(photos), 8)
+        self.assertTrue(compare_keys_with_fields(FacebookPhoto, photos[0].keys()))
+        results = graph.batch_fql({1: "SELECT aid FROM album WHERE owner=me() LIMIT 1", 2: "SELECT uid FROM user WHERE uid=me()"})
+        self.assertEqual(len(results[u'1']), 1)
+        self.assertEqual(results[u'2'], [{'uid': graph.facebook.me}])
+
+    def test_deterministic(self):
+        query = FacebookAlbum.fql_query_me()
+        self.assertEqual(SyntheticGraph(seed=3).fql(query), SyntheticGraph(seed=3).fql(query))
+
+
+class BenchmarkTestcases(TestCase):
+    def test_sync_benchmark(self):
+        # more posts than the facebook_row_limit ( 50 ) of the stream, its resyncs are measured too
+        results = SyncBenchmark(sizes=[60], tables=['album', 'stream']).run()
+        self.assertEqual([result['name'] for result in results],
+                         ['sync.album.60.insert', 'sync.album.60.unchanged', 'sync.album.60.changed',
+                          'sync.stream.60.insert', 'sync.stream.60.unchanged', 'sync.stream.60.changed'])
+        self.assertEqual(results[1]['stats'], 'added 0, updated 0, unchanged 60, deleted 0')
+        self.assertEqual(results[4]['stats'], 'added 0, updated 0, unchanged 60, deleted 0')
+        self.assertEqual(results[5]['stats'][:8], 'added 0,')
+        document = {'meta': {'vendor': 'sqlite'}, 'results': results}
+        self.assertFalse([row for row in compare(document, document) if row[-1]])
+
+
+class MetricsTestcases(TestCase):
+    def setUp(self):
+        # syncs of the tests run before add up in the registry of the process
+        registry.values.clear()
+
+    def test_render(self):
+        registry.inc('fbschema_sync_rows_total', 3, action='added', model='album', user=1)
+        registry.observe('fbschema_api_request_seconds', 0.3, method='fql', outcome='ok', user=1)
+        registry.inc('fbschema_sync_rows_total', 2, action='added', model='album', user=1)
+        text = render()
+        self.assertIn('# TYPE fbschema_sync_rows_total counter', text)
+        self.assertIn('fbschema_sync_rows_total{action="added",model="album",user="1"} 5', text)
+        self.assertIn('fbschema_api_request_seconds_bucket{le="0.25",method="fql",outcome="ok",user="1"} 0', text)
+        self.assertIn('fbschema_api_request_seconds_bucket{le="0.5",method="fql",outcome="ok",user="1"} 1', text)
+        self.assertIn('fbschema_api_request_seconds_count{method="fql",outcome="ok",user="1"} 1', text)
+
+    def test_sync_timer(self):
+        logged = len(connection.queries)
+        with SyncTimer() as outer:
+            with outer.phase('diff'):
+                SyncJob.objects.count()
+                with SyncTimer() as inner:
+                    with inner.phase('write'):
+                        SyncJob.objects.filter(status=SyncJob.PENDING).update(status=SyncJob.FAILED)
+                        SyncCheckpoint.objects.filter(completed=False).update(done=0)
+        self.assertEqual((outer.queries['diff'], inner.queries['write']), (3, 2))
+        # nothing is logged and the connection hands out its own cursors again
+        self.assertEqual(len(connection.queries), logged)
+        self.assertNotIn('cursor', vars(connections[DEFAULT_DB_ALIAS]))
+
+
+class StagedSyncTestcases(TransactionTestCase):
+    # sqlite commits before the DDL of the staging table, which a TestCase transaction doesn't survive
+    def sync(self, username, staging):
+        user = User.objects.create(username=username)
+        request = JobRequest(user)
+        facebook = SyntheticFacebook(friends=0, albums=12)
+        FacebookUser.save_profiles(request, facebook.rows('user', facebook.me))
+        results = []
+        for revision, albums in ((0, 12), (1, 12), (2, 8)):
+            facebook = SyntheticFacebook(friends=0, albums=albums, revision=revision, churn=0.3)
+            rows = list(facebook.rows('album', facebook.me))
+            if staging:
+                # repeated keys are merged, the python diff would need a handle_integrity_exception
+                rows += rows[:2]
+            results.append(str(FacebookAlbum.save_update_delete(request, rows, staging=staging)))
+        return results, FacebookAlbum.objects.filter(user=user).count()
+
+    def test_upsert_key(self):
+        self.assertEqual(upsert_key(FacebookAlbum), ['user', 'object_id', 'owner'])
+        # notification_id is unique across system users, upserting on it would move tuples between them
+        self.assertEqual((upsert_key(FacebookNotification), upsert_key(FacebookLike)), (None, None))
+        self.assertFalse(can_stage(FacebookNotification))
+
+    def test_same_outcome(self):
+        staged = self.sync('staged', True)
+        self.assertEqual(staged, self.sync('python', False))
+        self.assertEqual(staged[0][2][-9:], 'deleted 4')
+
+    def test_rollback(self):
+        request = JobRequest(User.objects.create(username='rolled'))
+        facebook = SyntheticFacebook(friends=0, albums=12)
+        FacebookUser.save_profiles(request, facebook.rows('user', facebook.me))
+        rows = list(facebook.rows('album', facebook.me))
+        for i, row in enumerate(rows):
+            row['like_info'] = {'like_count': 7000 + i, 'user_likes': False, 'can_like': True}
+        struct_cache.clear()
+        # the last chunk refers to a user which isn't stored, the structs of the chunks before are rolled back
+        broken = rows[:-1] + [dict(rows[-1], owner=1)]
+        self.assertRaises(UnresolvedForeignKey, FacebookAlbum.save_update_delete, request, broken, chunk_size=5, staging=True)
+        self.assertEqual((FacebookAlbum.objects.count(), StructLikeInfo.objects.filter(like_count__gte=7000).count()), (0, 0))
+        self.assertEqual(len(struct_cache), 0)
+
+        self.assertEqual(str(FacebookAlbum.save_update_delete(request, rows, chunk_size=5, staging=True)),
+                         'added 12, updated 0, unchanged 0, deleted 0')
+        self.assertEqual(sorted(FacebookAlbum.objects.values_list('like_info__like_count', flat=True)), range(7000, 7012))
+
+
+class SharedProfileTestcases(TestCase):
+    def test_one_profile_per_uid(self):
+        facebook = SyntheticFacebook(friends=1)
+        friend = facebook.friends[0]
+        for username in ('first', 'second'):
+            request = JobRequest(User.objects.create(username=username))
+            FacebookUser.save_profiles(request, facebook.rows('user', friend))
+        self.assertEqual(FacebookUserProfile.objects.filter(uid=friend).count(), 1)
+        self.assertEqual(FacebookUser.objects.filter(uid=friend).count(), 2)
+        self.assertEqual(FacebookUser.fresh_uids([friend, facebook.me]), set([friend]))
+
+        viewer_row = {'uid': friend, 'can_message': False, 'mutual_friend_count': 7}
+        facebook_user, = FacebookUser.save_profiles(request, [viewer_row])
+        self.assertEqual((facebook_user.mutual_friend_count, facebook_user.profile.uid), (7, friend))
+        self.assertEqual(FacebookUser.objects.filter(uid=friend).count(), 2)
+
+
+class IdEdgeTestcases(TestCase):
+    def test_edges_follow_sync(self):
+        request = JobRequest(User.objects.create(username='edges'))
+        facebook = SyntheticFacebook(friends=4, posts=30)
+        rows = list(facebook.rows('stream', facebook.me))
+        FacebookStream.save_update_delete(request, rows)
+        post = FacebookStream.objects.get(post_id=rows[0]['post_id'])
+        self.assertEqual(post.tagged_ids, rows[0]['tagged_ids'])
+
+        uid = facebook.friends[0]
+        tagging = lambda rows: set([row['post_id'] for row in rows if uid in row['tagged_ids'] + row['with_tags']])
+        self.assertEqual(set(listing(request.user, FacebookStream, uid).values_list('post_id', flat=True)), tagging(rows))
+
+        rows = rows[5:]
+        rows[0] = dict(rows[0], tagged_ids=[uid], updated_time=rows[0]['updated_time'] + 60)
+        FacebookStream.save_update_delete(request, rows)
+        self.assertEqual(set(listing(request.user, FacebookStream, uid).values_list('post_id', flat=True)), tagging(rows))
+        self.assertEqual(IdEdge.objects.filter(user=request.user).count(), sum([len(set(row['tagged_ids'])) + len(set(row['with_tags'])) for row in rows]))
+
+
+class AggregateTestcases(TestCase):
+    def aggregates(self, user):
+        return ([(album.aid, likes) for album, likes in top(user, FacebookAlbum, 'likes', 5)],
+                group_counts(user, FacebookAlbum, 'type'), group_counts(user, FacebookAlbum, 'owner'))
+
+    def test_maintained_while_syncing(self):
+        request = JobRequest(User.objects.create(username='aggregates'))
+        facebook = SyntheticFacebook(friends=0, albums=12)
+        FacebookUser.save_profiles(request, facebook.rows('user', facebook.me))
+        for revision, albums in ((0, 12), (1, 12), (2, 8)):
+            facebook = SyntheticFacebook(friends=0, albums=albums, revision=revision, churn=0.5)
+            FacebookAlbum.save_update_delete(request, list(facebook.rows('album', facebook.me)))
+
+            albums = FacebookAlbum.objects.filter(user=request.user)
+            ranked, types, owners = self.aggregates(request.user)
+            self.assertEqual([likes for aid, likes in ranked],
+                             list(albums.order_by('-like_info__like_count').values_list('like_info__like_count', flat=True)[:5]))
+            self.assertEqual(types, dict([(album_type, albums.filter(type=album_type).count()) for album_type in albums.values_list('type', flat=True)]))
+            self.assertEqual(owners, {albums[0].owner_id: albums.count()})
+
+        rebuild_aggregates(FacebookAlbum, request.user)
+        self.assertEqual(self.aggregates(request.user), (ranked, types, owners))
+
+    def test_session_user_resync(self):
+        # more posts than the facebook_row_limit ( 50 ) of the stream, the older ones aren't counted again
+        request = JobRequest(User.objects.create(username='counted'))
+        for revision in range(3):
+            facebook = SyntheticFacebook(friends=2, posts=80, revision=revision, churn=0.3)
+            FacebookStream.save_update_delete(request, facebook.rows('stream', facebook.me), stream_nature=True, bulk=True)
+        posts = FacebookStream.objects.filter(user=request.user)
+        self.assertEqual(sum(group_counts(request.user, FacebookStream, 'type').values()), posts.count())
+        self.assertEqual(group_counts(request.user, FacebookStream, 'type'),
+                         dict([(post_type, posts.filter(type=post_type).count()) for post_type in posts.values_list('type', flat=True)]))
+
+
+class SearchTestcases(TestCase):
+    def hits(self, user, query, **kwargs):
+        return [(hit.table, hit.key) for hit in search.search(user, query, **kwargs)]
+
+    def test_index_follows_sync(self):
+        request = JobRequest(User.objects.create(username='searcher'))
+        facebook = SyntheticFacebook(friends=2, posts=10)
+        FacebookUser.save_profiles(request, facebook.rows('user', facebook.friends[0]))
+        rows = list(facebook.rows('stream', facebook.me))
+        rows[3] = dict(rows[3], message="Sunset at the Zanzibar beach")
+        rows[7] = dict(rows[7], message="zanzibar again", description="beach")
+        FacebookStream.save_update_delete(request, rows)
+
+        self.assertEqual(self.hits(request.user, "zanzibar beach", per_page=1), [('stream', rows[7]['post_id'])])
+        results = search.search(request.user, "BEACH Zanzibar!")
+        self.assertEqual((len(results), results.has_next, results.hits[0].tuple.message), (2, False, "zanzibar again"))
+
+        rows[7] = dict(rows[7], message="back home", updated_time=rows[7]['updated_time'] + 60)
+        FacebookStream.save_update_delete(request, rows[1:])
+        self.assertEqual(self.hits(request.user, "zanzibar"), [('stream', rows[3]['post_id'])])
+
+        profile = FacebookUserProfile.objects.get(uid=facebook.friends[0])
+        profile.about_me = "Diving off Zanzibar"
+        profile.save()
+        self.assertEqual(self.hits(request.user, "zanzibar", tables=['user']), [('user', unicode(profile.uid))])
+        self.assertEqual(self.hits(User.objects.create(username='stranger'), "zanzibar"), [])
+
+    def test_postings(self):
+        search.SEARCH_BACKEND = 'postings'
+        try:
+            self.test_index_follows_sync()
+        finally:
+            search.SEARCH_BACKEND = None
+
+
+class CorpusTestcases(TestCase):
+    def test_top_terms(self):
+        request = JobRequest(User.objects.create(username='reader'))
+        facebook = SyntheticFacebook(friends=2, posts=40)
+        rows = list(facebook.rows('stream', facebook.me))
+        for i, row in enumerate(rows):
+            row.update(message="zanzibar beach %d" % (i % 3), description=i % 2 and "the beach" or None)
+        FacebookStream.save_update_delete(request, rows)
+
+        pipeline = CorpusPipeline(processes=0, chunk_size=7)
+        terms = dict(pipeline.top_terms(request.user, 'stream', 3))
+        self.assertEqual(terms, {'beach': 60, 'zanzibar': 40, '0': 14})
+        self.assertEqual(pipeline.stats['cached'] + pipeline.stats['counted'], 40)
+        self.assertEqual(dict(pipeline.top_terms(request.user, 'stream', 3)), terms)
+        self.assertEqual((pipeline.stats['texts'], pipeline.stats['cached'], pipeline.stats['counted']), (40, 40, 0))
+
+        rows[0] = dict(rows[0], message="back home", updated_time=rows[0]['updated_time'] + 60)
+        FacebookStream.save_update_delete(request, rows)
+        pooled = CorpusPipeline(processes=2, chunk_size=7)
+        self.assertEqual(pooled.top_terms(request.user, 'stream', 2), [('beach', 59), ('zanzibar', 39)])
+        self.assertEqual((pooled.stats['cached'], pooled.stats['counted']), (39, 1))
+
+        owner = rows[1]['actor_id']
+        self.assertEqual(dict(pipeline.top_terms(request.user, 'stream', owner=owner))['zanzibar'],
+                         len([row for row in rows[1:] if row['actor_id'] == owner]))
+
+
+class SocialGraphTestcases(TestCase):
+    def test_queries(self):
+        user = User.objects.create(username='social')
+        for uid1, uid2 in [(1, 2), (1, 3), (2, 3), (3, 4), (4, 5), (2, 1), (7, 8), (9, 9)]:
+            FacebookFriend.objects.create(user=user, uid1=uid1, uid2=uid2)
+        graph = social_graph(user)
+        self.assertEqual((len(graph), graph.edge_count, 9 in graph), (7, 6, False))
+        self.assertEqual((graph.degree(3), graph.degree(42), graph.degrees()[8]), (3, 0, 1))
+        self.assertEqual((graph.friends(3), graph.mutual_friends(1, 2), graph.mutual_friends(2, 4)), ([1, 2, 4], [3], [3]))
+        self.assertEqual((graph.k_hop(1, 1), graph.k_hop(1, 2), graph.k_hop(42, 2)), ([2, 3], [2, 3, 4], []))
+        self.assertEqual((graph.path(1, 5), graph.path(5, 5), graph.path(1, 7)), ([1, 3, 4, 5], [5], None))
+        self.assertEqual(graph.components(), [[1, 2, 3, 4, 5], [7, 8]])
+        self.assertIs(social_graph(user), graph)
+
+        # a single tuple saved bumps nothing, writers bump the generation once they are done
+        FacebookFriend.objects.create(user=user, uid1=5, uid2=7)
+        self.assertIs(social_graph(user), graph)
+        fql_server.invalidate(FacebookFriend, user.id)
+        graph = social_graph(user)
+        self.assertEqual((graph.path(1, 8), graph.components()), ([1, 3, 4, 5, 7, 8], [[1, 2, 3, 4, 5, 7, 8]]))
+        self.assertEqual(social_graph(User.objects.create(username='loner')).components(), [])
+
+        # a worker stores friends, the generation it bumps in the database is seen here
+        FacebookFriend.objects.filter(user=user, uid1=9).update(uid2=1)
+        self.assertIs(social_graph(user), graph)
+        TableGeneration.objects.filter(table='friend', viewer=user.id).update(value=F('value') + 1)
+        self.assertEqual(social_graph(user).friends(9), [1])
+
+    def test_friend_sync(self):
+        request = JobRequest(User.objects.create(username='befriended'))
+        graph = SyntheticGraph(friends=4)
+        me, friends = graph.facebook.me, sorted(graph.facebook.friends)
+        tasks.table_friend(request, graph)
+        # uids don't fit 32 bits
+        self.assertEqual((social_graph(request.user).friends(me), social_graph(request.user).nodes.dtype.name), (friends, 'int64'))
+
+        # syncing again stores nothing twice, an unfriended friend is deleted and the graph built again
+        tasks.table_friend(request, graph)
+        tasks.table_friend(request, SyntheticGraph(friends=3))
+        unfriended, = set(friends).difference(SyntheticGraph(friends=3).facebook.friends)
+        self.assertEqual(FacebookFriend.objects.filter(user=request.user).count(), 3)
+        self.assertEqual((social_graph(request.user).degree(me), unfriended in social_graph(request.user)), (3, False))
+
+
+class AdminTestcases(TestCase):
+    def test_change_lists(self):
+        request = JobRequest(User.objects.create(username='admined'))
+        facebook = SyntheticFacebook(friends=2, posts=40)
+        rows = list(facebook.rows('stream', facebook.me))
+        FacebookStream.save_update_delete(request, rows)
+        streams = FacebookStream.objects.order_by('-id')
+
+        self.assertEqual((estimated_count(streams), estimated_count(streams, 10), estimated_count(streams.filter(type=-1), 10)), (40, 10, 0))
+        pages = [list(streams[bottom:bottom + 7]) for bottom in range(0, 40, 7)]
+        paginator = KeysetPaginator(streams, 7)
+        self.assertEqual(list(paginator.page(4).object_list), pages[3])
+        # the start of page 5 was remembered reading page 4, it is read without looking up its start
+        with self.assertNumQueries(1):
+            self.assertEqual(list(paginator.page(5).object_list), pages[4])
+        self.assertEqual([list(paginator.page(number).object_list) for number in paginator.page_range], pages)
+
+        # a sync stores newer tuples, the pages shift and the starts remembered before aren't used anymore
+        facebook = SyntheticFacebook(friends=2, posts=45, revision=1)
+        FacebookStream.save_update_delete(request, facebook.rows('stream', facebook.me))
+        pages = [list(streams[bottom:bottom + 7]) for bottom in range(0, streams.count(), 7)]
+        self.assertEqual(list(KeysetPaginator(streams, 7).page(5).object_list), pages[4])
+
+        User.objects.create_superuser('root', 'root@localhost', 'secret')
+        self.client.login(username='root', password='secret')
+        response = self.client.get('/admin/fbschema/facebookstream/', {'q': rows[5]['source_id'], 'user__id__exact': request.user.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.context['cl'].result_list), set(FacebookStream.objects.filter(source_id=rows[5]['source_id'])))
+        self.assertEqual(self.client.get('/admin/fbschema/facebookstream/', {'q': 'letters', 'p': 0}).context['cl'].result_count, 0)
+        self.assertEqual(self.client.get('/admin/fbschema/facebooknotification/').status_code, 200)
+
+
+class BulkWriteTestcases(TestCase):
+    def sync_albums(self, username, bulk):
+        request = JobRequest(User.objects.create(username=username))
+        facebook = SyntheticFacebook(friends=0, albums=12)
+        FacebookUser.save_profiles(request, facebook.rows('user', facebook.me))
+        results = []
+        for revision in range(3):
+            facebook = SyntheticFacebook(friends=0, albums=12, revision=revision, churn=0.5)
+            results.append(str(FacebookAlbum.save_update_delete(request, facebook.rows('album', facebook.me), bulk=bulk, chunk_size=5)))
+        values = FacebookAlbum.objects.filter(user=request.user).order_by('aid').values_list('aid', 'name', 'modified', 'like_info__like_count')
+        return results, list(values)
+
+    def test_same_outcome(self):
+        bulk = self.sync_albums('bulk', True)
+        self.assertEqual(bulk, self.sync_albums('one_by_one', False))
+        self.assertEqual(bulk[0][0], 'added 12, updated 0, unchanged 0, deleted 0')
+
+    def test_delete_missing(self):
+        request = JobRequest(User.objects.create(username='deleting'))
+        facebook = SyntheticFacebook(friends=0, albums=4, photos=3)
+        FacebookUser.save_profiles(request, facebook.rows('user', facebook.me))
+        FacebookAlbum.save_update_delete(request, facebook.rows('album', facebook.me))
+        FacebookPhoto.save_update_delete(request, facebook.rows('photo', facebook.me))
+
+        # neither a stream nor a response cut at the row limit deletes anything
+        fewer = SyntheticFacebook(friends=0, albums=2, photos=3)
+        self.assertEqual(str(FacebookAlbum.save_update_delete(request, fewer.rows('album', facebook.me), stream_nature=True)),
+                         'added 0, updated 0, unchanged 2, deleted 0')
+        self.assertEqual(str(FacebookAlbum.save_update_delete(request, fewer.rows('album', facebook.me), limit=2)),
+                         'added 0, updated 0, unchanged 2, deleted 0')
+
+        # albums missing from a complete response are deleted and logged, their photos are kept without an album
+        stats = [str(FacebookAlbum.save_update_delete(request, fewer.rows('album', facebook.me), bulk=bulk)) for bulk in (True, False)]
+        self.assertEqual(stats, ['added 0, updated 0, unchanged 2, deleted 2', 'added 0, updated 0, unchanged 2, deleted 0'])
+        self.assertEqual(FacebookAlbum.objects.filter(user=request.user).count(), 2)
+        self.assertEqual(ChangeLog.objects.filter(user=request.user, table='album', action=ChangeLog.DELETE).count(), 2)
+        photos = FacebookPhoto.objects.filter(user=request.user)
+        self.assertEqual((photos.count(), photos.filter(aid=None).count()), (12, 6))
+
+    def test_bulk_update(self):
+        self.sync_albums('bulk', True)
+        albums = list(FacebookAlbum.objects.order_by('id'))
+        for album in albums:
+            album.name, album.photo_count = u"renamed %d" % album.id, album.id
+        fields = [FacebookAlbum._meta.get_field('name'), FacebookAlbum._meta.get_field('photo_count')]
+        # five parameters a row, sqlite takes 199 rows a statement
+        self.assertEqual(update_batch_size(connection, fields, 500), 199)
+        with self.assertNumQueries(3):
+            bulk_update(FacebookAlbum, albums, fields, chunk_size=5)
+        self.assertEqual(connection.queries[-1]['sql'], 'UPDATE "fbschema_facebookalbum" SET "name" = CASE "id" WHEN 11 THEN renamed 11 '
+                         'WHEN 12 THEN renamed 12 END, "photo_count" = CASE "id" WHEN 11 THEN 11 WHEN 12 THEN 12 END WHERE "id" IN (11, 12)')
+        self.assertEqual(list(FacebookAlbum.objects.order_by('id').values_list('name', 'photo_count')),
+                         [(u"renamed %d" % album.id, album.id) for album in albums])
+
+
+class IngestPlanTestcases(TestCase):
+    def test_plan(self):
+        plan = get_ingest_plan(FacebookLink)
+        self.assertIs(get_ingest_plan(FacebookLink), plan)
+        self.assertEqual(plan.field_names, get_fieldlist_from_model(FacebookLink))
+        self.assertEqual(plan.primary_field.name, 'link_id')
+        self.assertRaisesRegexp(ValueError, r"missing: \['title'\], unexpected: \['name'\]",
+                                plan.check_keys, [name for name in plan.field_names if name != 'title'] + ['name'])
+
+    def test_row_hash(self):
+        request = JobRequest(User.objects.create(username='hashed'))
+        facebook = SyntheticFacebook(friends=0, links=2)
+        FacebookUser.save_profiles(request, facebook.rows('user', facebook.me))
+        rows = list(facebook.rows('link', facebook.me))
+        plan = get_ingest_plan(FacebookLink)
+        data_dicts = plan.prepare_rows(rows, request)
+        self.assertEqual(data_dicts, [FacebookLink.prepare_dict(row, request) for row in rows])
+        self.assertEqual(plan.row_hash(dict(data_dicts[0], owner=data_dicts[0]['owner'].pk)), data_dicts[0]['row_hash'])
+        self.assertNotEqual(data_dicts[0]['row_hash'], data_dicts[1]['row_hash'])
+        self.assertNotEqual(plan.row_hash(dict(data_dicts[0], title=None)), plan.row_hash(dict(data_dicts[0], title=u'')))
+        self.assertEqual(plan.prepare_rows([]), [])
+
+
+class StructCacheTestcases(TestCase):
+    def setUp(self):
+        struct_cache.clear()
+
+    def test_lru(self):
+        cache = StructCache(max_size=2)
+        first, second, third = [StructAgeRange(pk=pk, min=pk) for pk in (1, 2, 3)]
+        cache.put(StructAgeRange, (1,), first)
+        cache.put(StructAgeRange, (2,), second)
+        self.assertIs(cache.get(StructAgeRange, (1,)), first)
+        cache.put(StructAgeRange, (3,), third)
+        # (2,) was the least recently used
+        self.assertEqual((len(cache), cache.get(StructAgeRange, (2,)), cache.get(StructAgeRange, (3,))), (2, None, third))
+        cache.discard_instance(StructAgeRange(pk=1, min=1))
+        self.assertEqual(cache.get(StructAgeRange, (1,)), None)
+
+    def test_interning(self):
+        values = [{'can_like': True, 'like_count': count % 3, 'user_likes': False} for count in range(10)]
+        # one lookup, one bulk insert and one lookup of the inserted tuples
+        with self.assertNumQueries(3):
+            resolved = prefetch_structs(StructLikeInfo, values)
+        self.assertEqual((len(resolved), StructLikeInfo.objects.count()), (3, 3))
+        with self.assertNumQueries(0):
+            self.assertEqual(intern_struct(StructLikeInfo, {'count': '2', 'can_like': True, 'user_likes': False}).like_count, 2)
+
+        # another process inserted a duplicate, the lowest id wins
+        duplicate = StructLikeInfo.objects.create(can_like=True, like_count=1, user_likes=False)
+        struct_cache.clear()
+        self.assertNotEqual(intern_struct(StructLikeInfo, values[1]).pk, duplicate.pk)
+        interned = intern_struct(StructLikeInfo, values[0])
+        interned.delete()
+        self.assertEqual(struct_cache.get(StructLikeInfo, struct_key(StructLikeInfo, values[0])), None)
+
+
+class ForeignKeyResolverTestcases(TestCase):
+    def test_resolver(self):
+        request = JobRequest(User.objects.create(username='resolving'))
+        facebook = SyntheticFacebook(friends=2)
+        FacebookUser.save_profiles(request, facebook.rows('user', facebook.friends[0]))
+        resolver = get_resolver(request)
+        self.assertIs(get_resolver(request), resolver)
+        with self.assertNumQueries(1):
+            resolver.load(FacebookUser, [facebook.friends[0], str(facebook.friends[1]), facebook.friends[0]])
+        with self.assertNumQueries(0):
+            # ids which didn't resolve are remembered too
+            self.assertEqual(resolver.get(FacebookUser, facebook.friends[0]).uid, facebook.friends[0])
+            self.assertEqual(resolver.unresolved(FacebookUser, facebook.friends), [facebook.friends[1]])
+
+        owner = FacebookLink._meta.get_field('owner')
+        self.assertRaises(UnresolvedForeignKey, resolver.resolve, owner, facebook.friends[1])
+        rows = list(facebook.rows('link', facebook.friends[1]))
+        self.assertRaisesRegexp(UnresolvedForeignKey, r"uid=\[%d\]" % facebook.friends[1], FacebookLink.save_update_delete, request, rows)
+
+        # stored users resolve within the same request
+        FacebookUser.save_profiles(request, facebook.rows('user', facebook.friends[1]))
+        self.assertEqual(resolver.unresolved(FacebookUser, facebook.friends), [])
+        self.assertEqual(str(FacebookLink.save_update_delete(request, rows)), 'added %d, updated 0, unchanged 0, deleted 0' % len(rows))
+
+
+class JobQueueTestcases(TestCase):
+    def test_claim(self):
+        first, second = User.objects.create(username='first'), User.objects.create(username='second')
+        jobs = [enqueue_job(JobRequest(user), task) for user, task in
+                ((first, 'table_user'), (first, 'table_friend'), (second, 'table_user'))]
+        self.assertEqual([job.status for job in jobs], [SyncJob.PENDING] * 3)
+        self.assertRaises(KeyError, enqueue_job, JobRequest(first), 'table_nothing')
+
+        claimed = claim_job()
+        self.assertEqual((claimed.id, claimed.status, claimed.worker), (jobs[0].id, SyncJob.RUNNING, worker_name()))
+        self.assertTrue(claimed.started)
+        # jobs of a user run one after the other
+        self.assertEqual(claim_job().id, jobs[2].id)
+        self.assertEqual(claim_job(), None)
+        SyncJob.objects.filter(id=jobs[0].id).update(status=SyncJob.DONE)
+        self.assertEqual(claim_job().id, jobs[1].id)
+
+    def test_anonymous(self):
+        job = enqueue_job(JobRequest(User.objects.create(username='owner')), 'table_album')
+        for url in ('/table/album', '/table/job/%d' % job.id, '/search'):
+            self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(SyncJob.objects.count(), 1)
+
+    def test_requeue_stale_jobs(self):
+        user = User.objects.create(username='requeued')
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        stale, alive, elsewhere = [SyncJob.objects.create(user=user, task='table_user', status=SyncJob.RUNNING, worker=worker)
+                                   for worker in (worker_name(dead.pid), worker_name(), 'otherhost:%d' % dead.pid)]
+        requeue_stale_jobs()
+        self.assertEqual(list(SyncJob.objects.order_by('id').values_list('status', 'worker')),
+                         [(SyncJob.PENDING, None), (SyncJob.RUNNING, alive.worker), (SyncJob.RUNNING, elsewhere.worker)])
+        self.assertEqual(claim_job(), None)
+
+
+class PoisonedGraph(SyntheticGraph):
+    '''
+    Times out every request asking for the tuples of one friend
+    '''
+    def __init__(self, poisoned, **kwargs):
+        super(PoisonedGraph, self).__init__(**kwargs)
+        self.poisoned = poisoned
+
+    def answer(self, query):
+        if str(self.poisoned) in query:
+            raise open_facebook_exceptions.FacebookUnreachable("Fake graph timed out")
+        return super(PoisonedGraph, self).answer(query)
+
+
+class BatchFetcherTestcases(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='fetcher')
+        self.graph = SyntheticGraph(friends=12, albums=3)
+        for uid in self.graph.facebook.friends:
+            FacebookFriend.objects.create(user=user, uid1=self.graph.facebook.me, uid2=uid)
+
+    def fetch(self, graph, **kwargs):
+        batches, skipped = [], []
+        fetcher = BatchFetcher(graph, initial_batch_size=kwargs.pop('initial_batch_size', 4), **kwargs)
+        fetcher.fetch(FacebookFriend.objects.order_by('id'), lambda friend: FacebookAlbum.fql_query_my_friends(friend.uid2),
+                      lambda friends, response_dataset: batches.append([friend.uid2 for friend in friends]),
+                      skip=lambda friend, error: skipped.append(friend.uid2))
+        return batches, skipped
+
+    def test_adaptive_batch_size(self):
+        size = AdaptiveBatchSize(8, target_latency=1)
+        size.success(8, 0.1)
+        self.assertEqual(int(size), 10)
+        # a smaller batch than the current size tells nothing
+        size.success(4, 0.1)
+        self.assertEqual(int(size), 10)
+        size.success(10, 2)
+        self.assertEqual(int(size), 7)
+        size.timeout(7)
+        size.timeout(3)
+        size.timeout(1)
+        self.assertEqual(int(size), 1)
+        for attempt in range(40):
+            size.success(int(size), 0.1)
+        self.assertEqual(int(size), 32)
+
+        # three albums a friend, responses of more than seven tuples are too large
+        batches, skipped = self.fetch(SyntheticGraph(friends=12, albums=3, max_rows=7), initial_batch_size=8, concurrency=1)
+        self.assertEqual((sum(map(len, batches)), max(map(len, batches)), skipped), (12, 2, []))
+
+    def test_skip(self):
+        poisoned = self.graph.facebook.friends[5]
+        batches, skipped = self.fetch(PoisonedGraph(poisoned, friends=12, albums=3))
+        self.assertEqual((sorted(sum(batches, [])), skipped), (sorted(set(self.graph.facebook.friends) - set([poisoned])), [poisoned]))
+
+        # without anywhere to record it, the friend fails the fetch
+        fetcher = BatchFetcher(PoisonedGraph(poisoned, friends=12, albums=3), initial_batch_size=4)
+        self.assertRaises(open_facebook_exceptions.FacebookUnreachable, fetcher.fetch, FacebookFriend.objects.all(),
+                          lambda friend: FacebookAlbum.fql_query_my_friends(friend.uid2), lambda friends, response_dataset: None)
+
+
+class FriendBatchTestcases(TestCase):
+    def setUp(self):
+        self.request = JobRequest(User.objects.create(username='walker'))
+        self.graph = SyntheticGraph(friends=12, albums=3)
+        for uid in self.graph.facebook.friends:
+            FacebookFriend.objects.create(user=self.request.user, uid1=self.graph.facebook.me, uid2=uid)
+
+    def walk(self, graph, batch_size=4, fail_after=None):
+        '''
+        uids whose batch a scheduler stored, the batch storing fails once fail_after uids are stored
+        '''
+        stored = []
+
+        def store(friends, response_dataset):
+            if fail_after is not None and len(stored) >= fail_after:
+                raise IOError("Worker killed")
+            self.assertEqual(len(response_dataset), len(friends))
+            stored.extend([friend.uid2 for friend in friends])
+
+        scheduler = FriendBatchScheduler(self.request, 'table_album_friends_batch', batch_size)
+        try:
+            scheduler.run(graph, lambda friend: FacebookAlbum.fql_query_my_friends(friend.uid2), store)
+        except IOError:
+            pass
+        return stored, SyncCheckpoint.objects.get(user=self.request.user)
+
+    def test_resume(self):
+        stored, checkpoint = self.walk(self.graph, fail_after=4)
+        self.assertFalse(checkpoint.completed)
+        walked = list(FacebookFriend.objects.filter(id__lte=checkpoint.last_friend_id).values_list('uid2', flat=True))
+        self.assertEqual((checkpoint.done, checkpoint.total), (len(walked), 12))
+        self.assertTrue(set(walked) <= set(stored))
+
+        resumed, checkpoint = self.walk(self.graph)
+        self.assertEqual(sorted(set(walked + resumed)), sorted(self.graph.facebook.friends))
+        self.assertFalse(set(walked) & set(resumed))
+        self.assertEqual((checkpoint.completed, checkpoint.done, checkpoint.progress()), (True, 12, 1.0))
+        # a completed pass starts over
+        self.assertEqual(len(self.walk(self.graph)[0]), 12)
+
+    def test_poisoned_friend(self):
+        poisoned = self.graph.facebook.friends[5]
+        stored, checkpoint = self.walk(PoisonedGraph(poisoned, friends=12, albums=3))
+        self.assertEqual(sorted(stored), sorted(set(self.graph.facebook.friends) - set([poisoned])))
+        self.assertEqual((checkpoint.completed, checkpoint.done), (True, 12))
+        failure = SyncFailure.objects.get(user=self.request.user)
+        self.assertEqual((failure.uid, failure.attempts, failure.table), (poisoned, 1, 'table_album_friends_batch'))
+
+        # stored by a later pass, the friend is no failure anymore
+        self.assertEqual(len(self.walk(self.graph)[0]), 12)
+        self.assertFalse(SyncFailure.objects.exists())
+
+
+class HighWaterMarkTestcases(TestCase):
+    def setUp(self):
+        self.request = JobRequest(User.objects.create(username='marked'))
+        self.graph = SyntheticGraph(friends=0, albums=6)
+        FacebookUser.save_profiles(self.request, self.graph.fql(FacebookUser.fql_query('WHERE uid=me()')))
+
+    def sync(self, graph, response_data=None, limit=None):
+        marks = HighWaterMarks(self.request, FacebookAlbum)
+        query = marks.fql_query_me()
+        if limit is not None:
+            marks.queried[None] = (marks.queried[None][0], limit)
+        stats = marks.save_update_delete(self.request, graph.fql(query) if response_data is None else response_data)
+        return query, str(stats)
+
+    def mark(self):
+        return SyncHighWaterMark.objects.get(user=self.request.user, table='album', owner_uid=None)
+
+    def test_marks(self):
+        self.assertEqual(clause_limit(FacebookPhoto.me_clause), 5000)
+        query, stats = self.sync(self.graph)
+        self.assertNotIn('modified >=', query)
+        mark = self.mark()
+        self.assertEqual(mark.value, max([row['modified'] for row in self.graph.fql(FacebookAlbum.fql_query_me())]))
+        self.assertTrue(mark.last_full_sync)
+
+        # changed tuples only, and nothing is deleted from an incremental response
+        changed = SyntheticGraph(friends=0, albums=4, revision=1, churn=0.5)
+        query, stats = self.sync(changed)
+        self.assertIn('modified >= %d' % mark.value, query)
+        self.assertEqual(FacebookAlbum.objects.filter(user=self.request.user).count(), 6)
+        self.assertTrue(self.mark().value > mark.value)
+
+        # a full reconciliation is due again, it deletes
+        SyncHighWaterMark.objects.filter(id=mark.id).update(last_full_sync=mark.last_full_sync - datetime.timedelta(days=8))
+        query, stats = self.sync(changed)
+        self.assertNotIn('modified >=', query)
+        self.assertEqual(stats[-9:], 'deleted 2')
+        self.assertTrue(self.mark().last_full_sync > mark.last_full_sync)
+        self.assertEqual(HighWaterMarks(self.request, FacebookAlbum, full=True).since(), None)
+
+    def test_no_full_sync_recorded(self):
+        # an empty response doesn't reconcile anything
+        self.sync(self.graph, response_data=[])
+        self.assertEqual((self.mark().value, self.mark().last_full_sync), (None, None))
+        self.assertNotIn('modified >=', self.sync(self.graph)[0])
+
+        # nor does one cut at the row limit, the mark stays where it was
+        mark = self.mark()
+        SyncHighWaterMark.objects.filter(id=mark.id).update(last_full_sync=None)
+        self.sync(SyntheticGraph(friends=0, albums=6, revision=1, churn=0.5), limit=6)
+        self.assertEqual((self.mark().value, self.mark().last_full_sync), (mark.value, None))
+
+
+class SessionUserTableTestcases(TestCase):
+    def test_users_apart(self):
+        requests = [JobRequest(User.objects.create(username=username)) for username in ('first', 'second')]
+        facebook = SyntheticFacebook(friends=2, posts=10)
+        FacebookStream.save_update_delete(requests[0], facebook.rows('stream', facebook.me))
+        stored = list(FacebookStream.objects.filter(user=requests[0].user).order_by('id').values_list('id', 'post_id', 'row_hash'))
+
+        # the same posts seen by another system user, some of them edited since
+        facebook = SyntheticFacebook(friends=2, posts=10, revision=1, churn=0.5)
+        for bulk in (False, True):
+            stats = FacebookStream.save_update_delete(requests[1], facebook.rows('stream', facebook.me), stream_nature=True, bulk=bulk)
+        self.assertEqual(str(stats), 'added 0, updated 0, unchanged 10, deleted 0')
+        self.assertEqual(list(FacebookStream.objects.filter(user=requests[0].user).order_by('id').values_list('id', 'post_id', 'row_hash')), stored)
+        self.assertEqual(FacebookStream.objects.filter(user=requests[1].user).count(), 10)
+
+    def test_beyond_row_limit(self):
+        # only the last facebook_row_limit ( 50 ) posts are loaded up front, older ones are looked up by key
+        request = JobRequest(User.objects.create(username='resynced'))
+        facebook = SyntheticFacebook(friends=2, posts=80)
+        FacebookStream.save_update_delete(request, facebook.rows('stream', facebook.me), stream_nature=True)
+        for bulk in (False, True):
+            stats = FacebookStream.save_update_delete(request, facebook.rows('stream', facebook.me), stream_nature=True, bulk=bulk)
+            self.assertEqual(str(stats), 'added 0, updated 0, unchanged 80, deleted 0')
+
+        facebook = SyntheticFacebook(friends=2, posts=80, revision=1, churn=0.5)
+        changed = len([row for row in facebook.rows('stream', facebook.me) if row['updated_time'] > SYNTHETIC_NOW])
+        stats = FacebookStream.save_update_delete(request, facebook.rows('stream', facebook.me), stream_nature=True, bulk=True)
+        self.assertEqual((stats.added, stats.updated), (0, changed))
+        self.assertTrue(changed)
+        self.assertEqual(FacebookStream.objects.filter(user=request.user).count(), 80)
+
+
+class HistoryTestcases(TestCase):
+    def state(self, albums):
+        return sorted([(album.aid, album.name, album.modified, album.photo_count, album.like_info_id) for album in albums])
+
+    def stream_state(self, posts):
+        return sorted([(post.post_id, post.message, post.updated_time) for post in posts])
+
+    def test_as_of(self):
+        request = JobRequest(User.objects.create(username='historian'))
+        facebook = SyntheticFacebook(friends=0, albums=10)
+        FacebookUser.save_profiles(request, facebook.rows('user', facebook.me))
+        before = timezone.now()
+        versions = []
+        snapshot_every, history.HISTORY_SNAPSHOT_EVERY = history.HISTORY_SNAPSHOT_EVERY, 6
+        try:
+            for revision, albums in ((0, 10), (1, 10), (2, 7)):
+                facebook = SyntheticFacebook(friends=0, albums=albums, revision=revision, churn=0.5)
+                FacebookAlbum.save_update_delete(request, facebook.rows('album', facebook.me))
+                versions.append((timezone.now(), self.state(FacebookAlbum.objects.filter(user=request.user))))
+        finally:
+            history.HISTORY_SNAPSHOT_EVERY = snapshot_every
+
+        # the first sync and the deletions of the third one took snapshots, the second sync is replayed from the log
+        self.assertEqual(ChangeSnapshot.objects.filter(user=request.user).count(), 2)
+        self.assertNotEqual(versions[0][1], versions[1][1])
+        for when, state in versions:
+            self.assertEqual(self.state(history.as_of(request.user, FacebookAlbum, when)), state)
+        self.assertEqual(history.as_of(request.user, FacebookAlbum, before).count(), 0)
+
+        aid = versions[2][1][0][0]
+        self.assertEqual(history.as_of(request.user, FacebookAlbum, versions[0][0]).get(aid=aid).name, versions[0][1][0][1])
+        self.assertEqual([entry.action for entry in history.changes(request.user, FacebookAlbum, key=aid)][0], ChangeLog.ADD)
+
+    def test_session_user_resync(self):
+        # posts older than the facebook_row_limit ( 50 ) last ones are logged once, their changes as updates
+        request = JobRequest(User.objects.create(username='chronicler'))
+        for revision in range(3):
+            facebook = SyntheticFacebook(friends=2, posts=80, revision=revision, churn=0.3)
+            FacebookStream.save_update_delete(request, facebook.rows('stream', facebook.me), stream_nature=True)
+        log = ChangeLog.objects.filter(user=request.user, table='stream')
+        self.assertEqual((log.filter(action=ChangeLog.ADD).count(), log.filter(action=ChangeLog.ADD).values('key').distinct().count()), (80, 80))
+        oldest = FacebookStream.objects.filter(user=request.user).order_by('id')[:30].values_list('post_id', flat=True)
+        updates = log.filter(action=ChangeLog.UPDATE, key__in=list(oldest))
+        self.assertTrue(updates.exists())
+        self.assertFalse(updates.filter(old_values=None).exists())
+        self.assertEqual(self.stream_state(history.as_of(request.user, FacebookStream, timezone.now())),
+                         self.stream_state(FacebookStream.objects.filter(user=request.user)))
+
+
+class FqlEngineTestcases(TestCase):
+    def setUp(self):
+        self.request = JobRequest(User.objects.create(username='fqler'))
+        self.facebook = SyntheticFacebook(friends=2, albums=6)
+        FacebookUser.save_profiles(self.request, self.facebook.rows('user', self.facebook.me))
+        rows = list(self.facebook.rows('album', self.facebook.me))
+        for i, row in enumerate(rows):
+            row.update(name=["Summer Beach", "beach day", "Winter"][i % 3], photo_count=i)
+        FacebookAlbum.save_update_delete(self.request, rows)
+        self.rows = rows
+
+    def fql(self, query):
+        return fql_engine.fql(query, self.request.user, me=self.facebook.me)
+
+    def test_parse(self):
+        self.assertEqual(fql_engine.parse("SELECT aid, name FROM album WHERE owner=me() AND NOT (photo_count > 2 OR name IN ('a', 'b')) LIMIT 5, 2"),
+                         ('query', ['aid', 'name'], 'album',
+                          ('and', [('compare', '=', ('column', 'owner'), ('call', 'me', [])),
+                                   ('not', ('or', [('compare', '>', ('column', 'photo_count'), ('value', 2)),
+                                                   ('in', ('column', 'name'), [('value', 'a'), ('value', 'b')])]))]),
+                          [], 5, 2))
+        self.assertEqual(fql_engine.normalize("select aid  from album\nwhere owner = me()"),
+                         fql_engine.normalize("SELECT aid FROM album WHERE owner=me()"))
+        self.assertRaisesRegexp(fql_engine.FqlError, "Expected FROM", fql_engine.parse, "SELECT aid album")
+        self.assertRaisesRegexp(fql_engine.FqlError, "after end of query", fql_engine.parse, "SELECT aid FROM album LIMIT 1 2")
+
+    def test_subquery(self):
+        FacebookFriend.objects.create(user=self.request.user, uid1=self.facebook.me, uid2=self.facebook.friends[0])
+        query = "SELECT aid FROM album WHERE owner IN (SELECT uid1 FROM friend WHERE uid2=%d)"
+        # the subquery runs inside the statement of the query
+        with self.assertNumQueries(1):
+            rows = self.fql(query % self.facebook.friends[0])
+        self.assertEqual(sorted([row['aid'] for row in rows]), sorted([row['aid'] for row in self.rows]))
+        self.assertEqual(self.fql(query % self.facebook.friends[1]), [])
+        self.assertEqual(fql_engine.compile_fql(query % 1).tables, set([FacebookAlbum, FacebookFriend]))
+
+    def test_me(self):
+        self.assertEqual(len(self.fql("SELECT aid FROM album WHERE owner=me()")), 6)
+        self.assertEqual(self.fql("SELECT owner FROM album WHERE owner=me() LIMIT 1"), [{'owner': self.facebook.me}])
+        self.assertEqual(fql_engine.fql("SELECT aid FROM album WHERE owner=me()", self.request.user, me=42), [])
+        # the viewer of the request has no facebook profile
+        self.assertRaisesRegexp(fql_engine.FqlError, "me\(\) is unknown", fql_engine.fql,
+                                "SELECT aid FROM album WHERE owner=me()", self.request.user)
+        self.assertEqual(fql_engine.fql("SELECT aid FROM album", User.objects.create(username='nobody')), [])
+
+    def test_strpos(self):
+        names = lambda query: sorted([row['name'] for row in self.fql("SELECT name FROM album WHERE %s" % query)])
+        self.assertEqual(names("strpos(name, 'Summer') >= 0"), ["Summer Beach"] * 2)
+        self.assertEqual(names("strpos(name, 'day') > -1"), ["beach day"] * 2)
+        self.assertEqual(names("strpos(lower(name), 'beach') != -1"), ["Summer Beach"] * 2 + ["beach day"] * 2)
+        self.assertEqual(names("strpos(lower(name), 'beach') < 0"), ["Winter"] * 2)
+        self.assertEqual(names("-1 = strpos(name, 'Winter')"), ["Summer Beach"] * 2 + ["beach day"] * 2)
+        self.assertRaisesRegexp(fql_engine.FqlError, ">= 0 or < 0", self.fql, "SELECT name FROM album WHERE strpos(name, 'a') = 2")
+        self.assertRaisesRegexp(fql_engine.FqlError, "a column and a string", self.fql, "SELECT name FROM album WHERE strpos(name, aid) >= 0")
+
+    def test_order_and_limit(self):
+        counts = lambda query: [row['photo_count'] for row in self.fql("SELECT photo_count FROM album " + query)]
+        self.assertEqual(counts("ORDER BY photo_count DESC"), [5, 4, 3, 2, 1, 0])
+        self.assertEqual(counts("ORDER BY photo_count LIMIT 2"), [0, 1])
+        self.assertEqual(counts("ORDER BY photo_count LIMIT 2 OFFSET 3"), [3, 4])
+        self.assertEqual(counts("ORDER BY photo_count DESC LIMIT 1, 2"), [4, 3])
+        self.assertEqual(counts("WHERE photo_count >= 2 AND NOT photo_count IN (3, 4) ORDER BY photo_count"), [2, 5])
+        self.assertEqual(counts("WHERE photo_count < 1 OR photo_count = 5 ORDER BY photo_count"), [0, 5])
+
+    def test_unknown_columns(self):
+        self.assertRaisesRegexp(fql_engine.FqlError, "colour is not a column of album", self.fql, "SELECT colour FROM album")
+        self.assertRaisesRegexp(fql_engine.FqlError, "colour is not a column of album", self.fql, "SELECT aid FROM album WHERE colour = 1")
+        self.assertRaisesRegexp(fql_engine.FqlError, "colour is not a column of album", self.fql, "SELECT aid FROM album ORDER BY colour")
+        self.assertRaisesRegexp(fql_engine.FqlError, "Table checkin is not stored locally", self.fql, "SELECT aid FROM checkin")
+        self.assertRaisesRegexp(fql_engine.FqlError, "exactly one column", self.fql,
+                                "SELECT aid FROM album WHERE owner IN (SELECT uid1, uid2 FROM friend)")
+
+    def test_plan_cache(self):
+        fql_engine.plan_cache.clear()
+        hits, misses = fql_engine.plan_cache.hits, fql_engine.plan_cache.misses
+        plan = fql_engine.compile_fql("SELECT aid FROM album WHERE owner=me()")
+        # plans don't depend on the viewer and are shared by queries differing in whitespace and keyword case
+        self.assertIs(fql_engine.compile_fql("select aid from album  where owner = me()"), plan)
+        self.assertEqual((fql_engine.plan_cache.hits - hits, fql_engine.plan_cache.misses - misses), (1, 1))
+        self.assertIsNot(fql_engine.compile_fql("SELECT aid FROM album WHERE owner=1"), plan)
+
+        cache = fql_engine.PlanCache(max_size=2)
+        first = cache.get("SELECT aid FROM album")
+        cache.get("SELECT name FROM album")
+        self.assertIs(cache.get("SELECT aid FROM album"), first)
+        cache.get("SELECT owner FROM album")
+        # the least recently used plan was evicted
+        self.assertIs(cache.get("SELECT aid FROM album"), first)
+        cache.get("SELECT name FROM album")
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+
+class FqlServerTestcases(TestCase):
+    def test_generations(self):
+        request = JobRequest(User.objects.create(username='served'))
+        facebook = SyntheticFacebook(friends=0, albums=3)
+        FacebookUser.save_profiles(request, facebook.rows('user', facebook.me))
+        FacebookAlbum.save_update_delete(request, facebook.rows('album', facebook.me))
+        query = "SELECT name FROM album ORDER BY name"
+        response = ''.join(fql_server.stream_fql(query, request.user))
+        # served from the cache, the generations are read in one query
+        with self.assertNumQueries(1):
+            self.assertEqual(''.join(fql_server.stream_fql(query, request.user)), response)
+
+        # a worker renames an album, its process bumps the generation in the database
+        album = FacebookAlbum.objects.filter(user=request.user)[0]
+        FacebookAlbum.objects.filter(id=album.id).update(name="renamed")
+        self.assertEqual(''.join(fql_server.stream_fql(query, request.user)), response)
+        TableGeneration.objects.filter(table='album', viewer=request.user.id).update(value=F('value') + 1)
+        self.assertIn('"renamed"', ''.join(fql_server.stream_fql(query, request.user)))
+
+        # single tuples are saved without bumping anything, writes bump generations once per batch
+        generation = fql_server.generations([FacebookAlbum, FacebookUser], request.user.id)
+        album.save()
+        self.assertEqual(fql_server.generations([FacebookAlbum, FacebookUser], request.user.id), generation)
+        FacebookUser.save_profiles(request, facebook.rows('user', facebook.me))
+        self.assertEqual(fql_server.generations([FacebookAlbum, FacebookUser], request.user.id)[:2], generation[:2])
+        self.assertNotEqual(fql_server.generations([FacebookAlbum, FacebookUser], request.user.id)[2], generation[2])
+        # no signal receivers on the tables, querysets are deleted in one statement
+        FacebookLink.save_update_delete(request, facebook.rows('link', facebook.me))
+        self.assertEqual(FacebookLink.objects.filter(user=request.user).count(), 10)
+        with self.assertNumQueries(1):
+            FacebookLink.objects.filter(user=request.user).delete()
+        # only writes of fql tables bump generations
+        generation = list(TableGeneration.objects.order_by('id').values_list('value', flat=True))
+        SyncJob.objects.create(user=request.user, task='table_album')
+        self.assertEqual(list(TableGeneration.objects.order_by('id').values_list('value', flat=True)), generation)
+
+
+class UnreachableGraph(SyntheticGraph):
+    '''
+    Looks like a graph talking to facebook over http, at an address nothing listens on
+    '''
+    access_token = 'token'
+    api_url = 'http://127.0.0.1:9/'
+
+    def __init__(self, **kwargs):
+        super(UnreachableGraph, self).__init__(**kwargs)
+        self.observed = []
+
+    def observe_request(self, method, seconds, outcome='ok'):
+        self.observed.append((method, outcome))
+
+
+class StreamingTestcases(TestCase):
+    def test_stream_fql_fallback(self):
+        query = FacebookAlbum.fql_query_me()
+        graph = SyntheticGraph(friends=0, albums=4)
+        rows = streaming.stream_fql(graph, query)
+        self.assertFalse(isinstance(rows, list))
+        self.assertEqual(list(rows), graph.fql(query))
+
+        # a failed http request is sent again through graph.fql
+        ijson, streaming.ijson = streaming.ijson, streaming.ijson or object()
+        try:
+            graph = UnreachableGraph(friends=0, albums=4)
+            self.assertEqual(list(streaming.stream_fql(graph, query)), graph.fql(query))
+            self.assertEqual(graph.observed, [('stream_fql', 'error')])
+        finally:
+            streaming.ijson = ijson
+
+    def test_memory_ceiling(self):
+        sizes = lambda ceiling, chunk_size: [len(chunk) for chunk in ceiling.chunks(iter(range(100)), chunk_size)]
+        self.assertEqual(sizes(streaming.MemoryCeiling(limit=None), 40), [40, 40, 20])
+        memory, resident_memory = [0], streaming.resident_memory
+        streaming.resident_memory = lambda: memory[0]
+        try:
+            memory[0] = 1024 * 1024
+            self.assertEqual(sizes(streaming.MemoryCeiling(limit=1, minimum_chunk_size=10), 40), [40, 40, 20])
+            # halved after every chunk while above the limit, never below the minimum
+            memory[0] = 2 * 1024 * 1024
+            self.assertEqual(sizes(streaming.MemoryCeiling(limit=1, minimum_chunk_size=10), 40), [40, 20, 10, 10, 10, 10])
+        finally:
+            streaming.resident_memory = resident_memory
+
+    def test_ingest_stream(self):
+        request = JobRequest(User.objects.create(username='streamed'))
+        graph = SyntheticGraph(friends=0, albums=12)
+        FacebookUser.save_profiles(request, graph.fql(FacebookUser.fql_query('WHERE uid=me()')))
+        query = FacebookAlbum.fql_query_me()
+        stats = FacebookAlbum.save_update_delete(request, streaming.stream_fql(graph, query), chunk_size=5)
+        self.assertEqual(str(stats), 'added 12, updated 0, unchanged 0, deleted 0')
+        self.assertEqual(sorted(FacebookAlbum.objects.filter(user=request.user).values_list('aid', flat=True)),
+                         sorted([row['aid'] for row in graph.fql(query)]))
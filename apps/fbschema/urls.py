@@ -21,5 +21,13 @@ urlpatterns = patterns('apps.fbschema.views',
     url(r'table/link$', 'table_link_save_update', name='fbschema_table_link'),
     
     url(r'table/stream$', 'table_stream', name='fbschema_table_stream'),
+
+    url(r'table/job/(?P<job_id>\d+)$', 'job_status', name='fbschema_job_status'),
+
+    url(r'^fql$', 'fql_endpoint', name='fbschema_fql'),
+    url(r'^metrics$', 'metrics', name='fbschema_metrics'),
+    url(r'^top/(?P<table>\w+)/(?P<metric>\w+)$', 'leaderboard', name='fbschema_leaderboard'),
+    url(r'^counts/(?P<table>\w+)/(?P<dimension>\w+)$', 'counts', name='fbschema_counts'),
+    url(r'^search$', 'search', name='fbschema_search'),
 )   
 
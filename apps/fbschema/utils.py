@@ -18,23 +18,31 @@ def get_fieldlist_from_model(model):
     '''
     Returns a python list of model fields
     '''
-    return [getattr(field, 'name') for field in model._meta.fields if getattr(field, 'name') not in model.ignore_fields]
+    return [getattr(field, 'name') for field in get_fql_fields(model)]
 
 
-def compare_keys_with_fields(model, keys):
+def get_shared_model(model):
     '''
-    Compares returned data set keys for a particular fql query with the model fields in concern.
-    Basically they must be equal because requested keys were generated from model fields 
+    Returns the model holding the viewer independent columns of an fql table model, see FacebookUser.shared_field
     '''
-    fields = get_fieldlist_from_model(model)
- 
-    for key in keys:
-        if key not in fields:
-            return False
+    shared_field = getattr(model, 'shared_field', None)
+    return shared_field and model._meta.get_field(shared_field).rel.to or None
 
-    for field in fields:
-        if field not in keys:
-            return False
 
-    return True
+def get_fql_fields(model):
+    '''
+    Returns the model fields which are columns of the fql table, those stored on the shared model included
+    '''
+    fields = [field for field in model._meta.fields if getattr(field, 'name') not in model.ignore_fields]
+    shared_model = get_shared_model(model)
+    if shared_model:
+        fields.extend([field for field in shared_model._meta.fields if getattr(field, 'name') not in shared_model.ignore_fields])
+    return fields
+
 
+def compare_keys_with_fields(model, keys):
+    '''
+    Compares returned data set keys for a particular fql query with the model fields in concern.
+    Basically they must be equal because requested keys were generated from model fields 
+    '''
+    return set(keys) == set(get_fieldlist_from_model(model))
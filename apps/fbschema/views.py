@@ -1,205 +1,281 @@
+import json
 import logging
+from functools import wraps
 
 from django.conf import settings
 from django.contrib import messages
-from django.http import Http404, HttpResponse, HttpResponseRedirect
-from django.shortcuts import render_to_response
+from django.http import Http404, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.shortcuts import render_to_response, get_object_or_404
 from django.template.context import RequestContext
 from django.utils.translation import ugettext as _
 from django.views.decorators.csrf import csrf_exempt
 from django.core.urlresolvers import reverse
+from django.db.models import ForeignKey
 
 from apps.fbschema.models import *
-
-from django_facebook.api import require_persistent_graph
+from apps.fbschema.jobs import enqueue_job
+from apps.fbschema.aggregates import top, group_counts
+from apps.fbschema.search import SEARCH_PAGE_SIZE, search as search_tuples
+from apps.fbschema.resolvers import LOOKUP_FIELDS
+from apps.fbschema.fql_engine import FqlError, get_table_model
+from apps.fbschema.fql_server import stream_fql
+from apps.fbschema.metrics import METRICS_ALLOWED_IPS, render as render_metrics
 
 
 logger = logging.getLogger(__name__)
 
 
-def table_user(request):
+def authenticated(view):
     '''
-    To Fetch, Parse and Store user table data
+    Views reading or queueing work for the system user of the request answer 403 to anonymous requests
     '''
-    graph = require_persistent_graph(request)
-    response_data = graph.fql(FacebookUser.fql_query('WHERE uid=me()'))
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated():
+            return HttpResponse("Forbidden", status=403, content_type='text/plain')
+        return view(request, *args, **kwargs)
+    return wrapper
+
+'''
+Table views don't download anything themselves, they queue a background job running the task of the same name
+in apps.fbschema.tasks and return right away
+'''
+
+def job_response(job, message):
+    '''
+    Returns the step message of a table view along with the status link of the queued job
+    '''
+    status_url = reverse('fbschema_job_status', args=[job.id])
+    return HttpResponse("<p>Download job #%d (%s) is %s, follow it at <a href='%s'>%s</a> and wait for it to be done before the next step.</p>%s" % \
+                        (job.id, job.task, job.status, status_url, status_url, message))
 
-    response_data_dict = response_data[0]
-    data_dict = FacebookUser.prepare_dict(response_data_dict)
-    facebook_user = FacebookUser( user=request.user, **data_dict )
-    facebook_user.save()
-    return HttpResponse("<h2>Step 1. Successfully downloaded 'user' table. Now to download 'friend' table click here : <a href='%s'>/table/friend</a></h2> " % reverse('fbschema_table_friend'))
 
+@authenticated
+def job_status(request, job_id):
+    '''
+    Status of a queued download job as json
+    '''
+    job = get_object_or_404(SyncJob, id=job_id, user=request.user)
+    data = {
+        'id': job.id,
+        'task': job.task,
+        'status': job.status,
+        'created': job.created.isoformat(),
+        'started': job.started and job.started.isoformat(),
+        'finished': job.finished and job.finished.isoformat(),
+        'message': job.message,
+    }
+    #Friend batch tasks report how far they have walked through the friend list
+    checkpoint = SyncCheckpoint.objects.filter(user=request.user, table=job.task)
+    if checkpoint:
+        checkpoint = checkpoint[0]
+        data['progress'] = {
+            'done': checkpoint.done,
+            'total': checkpoint.total,
+            'fraction': checkpoint.progress(),
+            'completed': checkpoint.completed,
+            'skipped': list(SyncFailure.objects.filter(user=request.user, table=job.task).values_list('uid', flat=True)),
+        }
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+
+def fql_error(message, code, status=400):
+    '''
+    Error response shaped like facebook's, open_facebook raises the matching exception on the client side
+    '''
+    data = {'error': {'message': "(#%d) %s" % (code, message), 'type': 'OAuthException', 'code': code}}
+    return HttpResponse(json.dumps(data), status=status, content_type='application/json')
 
-def table_friend(request):
+
+@csrf_exempt
+def fql_endpoint(request):
     '''
-    To Fetch, Parse and Store user table data
+    Local counterpart of https://graph.facebook.com/fql, answers graph.fql and graph.batch_fql requests from the
+    local tables. The viewer is the owner of the access_token parameter, or the logged in user
+    '''
+    from django_facebook.utils import get_profile_model
+    q = request.REQUEST.get('q')
+    if not q:
+        return fql_error("A query is required", 601)
+
+    access_token = request.REQUEST.get('access_token')
+    if access_token:
+        profiles = get_profile_model().objects.filter(access_token=access_token).select_related('user')[:1]
+        if not profiles:
+            return fql_error("Invalid OAuth access token.", 190)
+        user, me = profiles[0].user, profiles[0].facebook_id
+    elif request.user.is_authenticated():
+        user, me = request.user, None
+    else:
+        return fql_error("An active access token must be used to query information about the current user.", 2500)
+
+    try:
+        body = stream_fql(q, user, me)
+    except FqlError, e:
+        return fql_error("Parser error: %s" % e, 601)
+    return StreamingHttpResponse(body, content_type='application/json')
+
+
+def aggregate_model(table, name, attribute):
+    try:
+        model = get_table_model(table)
+    except FqlError:
+        raise Http404
+    if name not in getattr(model, attribute, ()):
+        raise Http404
+    return model
+
+
+@authenticated
+def leaderboard(request, table, metric):
+    '''
+    Top tuples of the user on a leaderboard of apps.fbschema.aggregates as json, ?n= of them ( 10 by default, at most 100 )
     '''
-    graph = require_persistent_graph(request)
-    response_data = graph.fql(FacebookFriend.fql_query('WHERE uid1=me()'))
-    print("Hello")
+    model = aggregate_model(table, metric, 'ranked_by')
+    try:
+        n = min(int(request.GET.get('n', 10)), 100)
+    except ValueError:
+        n = 10
+    data = [{model.primary_identifier: getattr(data_tuple, model.primary_identifier), 'score': score}
+            for data_tuple, score in top(request.user, model, metric, n)]
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+@authenticated
+def counts(request, table, dimension):
+    '''
+    Tuples of the user per value of a column as json, users and albums by their facebook ids
+    '''
+    model = aggregate_model(table, dimension, 'counted_by')
+    data = group_counts(request.user, model, dimension)
+    field = model._meta.get_field(dimension)
+    if isinstance(field, ForeignKey) and field.rel.to in LOOKUP_FIELDS:
+        ids = dict(field.rel.to.objects.filter(id__in=[group for group in data if group is not None]).values_list('id', LOOKUP_FIELDS[field.rel.to]))
+        data = dict([(ids.get(group, group), count) for group, count in data.items()])
+    return HttpResponse(json.dumps(data), content_type='application/json')
 
-    for response_data_dict in response_data:
-        data_dict = FacebookFriend.prepare_dict(response_data_dict) 
-        facebook_friend = FacebookFriend( user=request.user, **data_dict )
-        facebook_friend.save()
 
-    return HttpResponse("<h2>Step 2. Successfully downloaded 'friend' table. Now we will download all friends' profiles and store them in facebook_user table. Importing all friends in a single request will throw facebookapi timeout error, hence we do 100 at a time. To start it click here : <a href='%s'>/table/user_friends_batch</a>. You can always look at your command terminal while django's testserver is printing mysterious things, it just feels good. " % reverse('fbschema_table_user_friends_batch'))
+@authenticated
+def search(request):
+    '''
+    Full text search of the user's tuples as json, ?q=terms&page=2&tables=stream,photo
+    '''
+    tables = [table for table in request.GET.get('tables', '').split(',') if table] or None
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        page = 1
+    results = search_tuples(request.user, request.GET.get('q', ''), tables, page, SEARCH_PAGE_SIZE)
+    data = {
+        'page': results.page,
+        'has_next': results.has_next,
+        'hits': [{'table': hit.table, 'key': hit.key, 'score': hit.score} for hit in results.hits],
+    }
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+def metrics(request):
+    '''
+    Sync metrics of all processes in the Prometheus text format, for staff and settings.FBSCHEMA_METRICS_ALLOWED_IPS
+    '''
+    if request.META.get('REMOTE_ADDR') not in METRICS_ALLOWED_IPS and not request.user.is_staff:
+        return HttpResponse("Forbidden", status=403, content_type='text/plain')
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4')
 
 
+@authenticated
+def table_user(request):
+    '''
+    To Fetch, Parse and Store user table data
+    '''
+    job = enqueue_job(request, 'table_user')
+    return job_response(job, "<h2>Step 1. Download of your 'user' table is queued. Once its job is done, to download 'friend' table click here : <a href='%s'>/table/friend</a></h2> " % reverse('fbschema_table_friend'))
+
 
-import pprint
-pp = pprint.PrettyPrinter(indent=4)
+@authenticated
+def table_friend(request):
+    '''
+    To Fetch, Parse and Store friend table data
+    '''
+    job = enqueue_job(request, 'table_friend')
+    return job_response(job, "<h2>Step 2. Download of your 'friend' table is queued. Once its job is done, we will download all friends' profiles and store them in facebook_user table. Importing all friends in a single request will throw facebookapi timeout error, hence we do 100 at a time. To start it click here : <a href='%s'>/table/user_friends_batch</a>. You can always look at your command terminal while django's testserver is printing mysterious things, it just feels good. " % reverse('fbschema_table_user_friends_batch'))
 
 
+@authenticated
 def table_user_friends_batch(request):
     '''
-    I am using batch queries, let us taste performance gain
-    '''
-    graph = require_persistent_graph(request)
-    query_dict = {}
-    for friend in FacebookFriend.objects.all()[:100]: 
-        # Conclusion 100 batched queries at a time are enough for a while
-        # My current problem is not to use broker, so deferring it. What I can do with data and for the problem is the question.
-        query_dict[friend.id] = FacebookUser.fql_query("WHERE uid=%d" % friend.uid2)
-   
-
-    response_dataset = graph.batch_fql(query_dict)
-    for response_data in response_dataset.values():
-        try:
-            response_data_dict = response_data[0]
-            data_dict = FacebookUser.prepare_dict(response_data_dict)
-            facebook_user = FacebookUser( user=request.user, **data_dict )
-            facebook_user.save()
-        except IndexError:
-            logger.info("A user query returned no information")
-    #pp.pprint(response_data)
-    return HttpResponse("<h2>Step 3. Congratulations! You have downloaded profiles of your first hundred friends. Don't believe me ? You can always look at these profiles using django's admin interface. Just don't forget to login into admin using different browser not messing up with this session. Now we will download 'like' table, click here : <a href='%s'>/table/table_like</a>." % reverse('fbschema_table_like'))
+    Profiles of friends, in batch queries
+    '''
+    job = enqueue_job(request, 'table_user_friends_batch')
+    return job_response(job, "<h2>Step 3. Download of the profiles of all your friends, 100 at a time, is queued. Once its job is done you can look at these profiles using django's admin interface. Just don't forget to login into admin using different browser not messing up with this session. Then we will download 'like' table, click here : <a href='%s'>/table/table_like</a>." % reverse('fbschema_table_like'))
 
 
+@authenticated
 def table_like(request):
     '''
     User Likes
     '''
-    graph = require_persistent_graph(request)
-    response_data = graph.fql(FacebookLike.fql_query('WHERE user_id=me()'))
+    job = enqueue_job(request, 'table_like')
+    return job_response(job, "<h2>Step 4. Download of your like table is queued. Facebook doesn't allow you to download your friends like information without their permission. Once its job is done we will start downloading 'album' table. First all your albums, click here to start with 'album' FQL table : <a href='%s'>/table/table_album</a>." % reverse('fbschema_table_album'))
 
-    for response_data_dict in response_data:
-        data_dict = FacebookLike.prepare_dict(response_data_dict, request) 
-        print data_dict
-        facebook_like = FacebookLike(**data_dict) 
-        facebook_like.save()
-    return HttpResponse("<h2>Step 4. We have downloaded your like table. Facebook doesn't allow you to download your friends like information without their permission. Now we will start downloading 'album' table. First all your albums, click here to start with 'album' FQL table : <a href='%s'>/table/table_album</a>." % reverse('fbschema_table_album'))
-    
 
+@authenticated
 def table_like_friends_batch(request):
     '''
     table_like => me and my friends => my friends in batch queries => table_like_friends_batch
     Warning: work under construction
     '''
-    # OpenFacebookException at /table/like_friends_batch
-    # The indexed user_id queried on must be the logged in user
-    # Note: that means we can fetch user_id[s?] if we have object_id, but we cannot fetch all object_ids for a give user_id [ makes sense ]
-
-    graph = require_persistent_graph(request)
-    query_dict = {}
-    for friend in FacebookFriend.objects.all()[:100]: 
-        query_dict[friend.id] = FacebookLike.fql_query("WHERE user_id=%d" % friend.uid2)
-   
-    response_dataset = graph.batch_fql(query_dict)
-    for response_data in response_dataset.values():
-        response_data_dict = response_data[0]
-        data_dict = FacebookLike.prepare_dict(response_data_dict, request)
-        facebook_like = FacebookLike(**data_dict) 
-        facebook_like.save()
-
-    return HttpResponse("Hello World")
+    job = enqueue_job(request, 'table_like_friends_batch')
+    return job_response(job, "Hello World")
 
 
+@authenticated
 def table_album(request):
     '''
     table album
     '''
-    context_model = FacebookAlbum
-    graph = require_persistent_graph(request)
-    response_data = graph.fql(context_model.fql_query_me())
-    context_model.save_update_delete(request, response_data)
-    return HttpResponse("<h2>Step 5. We have downloaded your album information. Now we do the same for your first hundred friends i.e. we are downloading album information of your first hundred friends ( Not all at once ). Click here to start with 'album' FQL table for your friends' albums : <a href='%s'>/table/table_album_friends_batch</a>." % reverse('fbschema_table_album_friends_batch'))
+    job = enqueue_job(request, 'table_album')
+    return job_response(job, "<h2>Step 5. Download of your album information is queued. Once its job is done we do the same for your friends i.e. we are downloading album information of all your friends, 100 friends at a time ( Not all at once ). Click here to start with 'album' FQL table for your friends' albums : <a href='%s'>/table/table_album_friends_batch</a>." % reverse('fbschema_table_album_friends_batch'))
 
 
+@authenticated
 def table_album_friends_batch(request):
     '''
     table album for friends
     '''
-    graph = require_persistent_graph(request)
-    query_dict = {}
-    for friend in FacebookFriend.objects.all()[:100]: # 100
-        query_dict[friend.id] = FacebookAlbum.fql_query("WHERE owner=%d" % friend.uid2)
-   
-    response_dataset = graph.batch_fql(query_dict)
-    for response_data in response_dataset.values():
-        for response_data_dict in response_data:
-            data_dict = FacebookAlbum.prepare_dict(response_data_dict, request)
-            facebook_album = FacebookAlbum(user=request.user, **data_dict) 
-            facebook_album.save()
-    return HttpResponse("<h2>Step 6. Cool! You now have all album information of some of your friends, checkout the django admin or mysql table. Now we will do the same thing with 'photo' table. To start with your own photos information, click here : <a href='%s'>/table/table_photo</a>." % reverse('fbschema_table_photo'))
+    job = enqueue_job(request, 'table_album_friends_batch')
+    return job_response(job, "<h2>Step 6. Download of the album information of your friends is queued, once its job is done checkout the django admin or mysql table. Then we will do the same thing with 'photo' table. To start with your own photos information, click here : <a href='%s'>/table/table_photo</a>." % reverse('fbschema_table_photo'))
 
 
+@authenticated
 def table_photo(request):
     '''
     table photo
     '''
-    # depends on Album  i.e. for a photo its parent album should exist
-    context_model = FacebookPhoto
-    graph = require_persistent_graph(request)
-    response_data = graph.fql(context_model.fql_query_me())
-    context_model.save_update_delete(request, response_data)
-
-    '''
-    graph = require_persistent_graph(request)
-    response_data = graph.fql(FacebookPhoto.fql_query('WHERE owner=me() limit 5000'))
-
-    for response_data_dict in response_data:
-        data_dict = FacebookPhoto.prepare_dict(response_data_dict, request) 
-        #print data_dict
-        facebook_photo = FacebookPhoto(user=request.user, **data_dict) 
-        facebook_photo.save()
-    '''
-    return HttpResponse("<h2>Step 7. Great, now you have all your facebook photos information. We do the same for your friends, and this time we process 2 friends at a time ( have a look in code ) as photo counts can be huge for each friend. Click here : <a href='%s'>/table/table_photo_friends_batch</a>." % reverse('fbschema_table_photo_friends_batch'))
-
+    job = enqueue_job(request, 'table_photo')
+    return job_response(job, "<h2>Step 7. Download of all your facebook photos information is queued. Once its job is done we do the same for your friends, and this time we process 2 friends at a time ( have a look in code ) as photo counts can be huge for each friend. Click here : <a href='%s'>/table/table_photo_friends_batch</a>." % reverse('fbschema_table_photo_friends_batch'))
 
 
+@authenticated
 def table_photo_friends_batch(request):
     '''
     table photo for friends
     '''
-    context_model = FacebookPhoto
-    
-    graph = require_persistent_graph(request)
-    query_dict = {}
-    for friend in FacebookFriend.objects.all()[2:4]: # 2
-        query_dict[friend.id] = context_model.fql_query_my_friends(friend.uid2)
-    
-    response_dataset = graph.batch_fql(query_dict)
-    for response_data in response_dataset.values():
-        if response_data:
-            context_model.save_update_delete(request, response_data)
-
-    return HttpResponse("<h2>Step 8. Now to download 'notification' table. Click here : <a href='%s'>/table/table_notification</a>." % reverse('fbschema_table_notification'))
+    job = enqueue_job(request, 'table_photo_friends_batch')
+    return job_response(job, "<h2>Step 8. Download of the photos information of your friends is queued. Once its job is done, to download 'notification' table. Click here : <a href='%s'>/table/table_notification</a>." % reverse('fbschema_table_notification'))
 
 
+@authenticated
 def table_notification(request):
     '''
     table notification
     '''
-    context_model = FacebookNotification
-    graph = require_persistent_graph(request)
-    response_data = graph.fql(context_model.fql_query_me())
-    context_model.save_update_delete(request, response_data, stream_nature=True)
-    return HttpResponse("<h2>Step 9. Facebook deletes all notifications older than 7 days, we have downloaded all available. But we can download all your shared links on facebook from 'link' FQL table ! Click here - : <a href='%s'>/table/table_link</a>." % reverse('fbschema_table_link'))
-    
+    job = enqueue_job(request, 'table_notification')
+    return job_response(job, "<h2>Step 9. Facebook deletes all notifications older than 7 days, download of all available ones is queued. Once its job is done we can download all your shared links on facebook from 'link' FQL table ! Click here - : <a href='%s'>/table/table_link</a>." % reverse('fbschema_table_link'))
 
 
+@authenticated
 def table_link(request):
     '''
     table link
@@ -208,46 +284,29 @@ def table_link(request):
     return HttpResponse("Hello World")
 
 
+@authenticated
 def table_link_friends_batch(request):
     '''
     table link for friends
     '''
-    context_model = FacebookLink
-    
-    graph = require_persistent_graph(request)
-    query_dict = {}
-    for friend in FacebookFriend.objects.all()[:3]: # 3
-        query_dict[friend.id] = context_model.fql_query_my_friends(friend.uid2)
-    
-    response_dataset = graph.batch_fql(query_dict)
-    for response_data in response_dataset.values():
-        if response_data:
-            context_model.save_update_delete(request, response_data)
-
-    return HttpResponse("<h2>Step 11. Finally in this alpha demo we download your stream posts from 'stream' FQL table. Click here - : <a href='%s'>/table/table_stream</a>." % reverse('fbschema_table_stream'))
-
+    job = enqueue_job(request, 'table_link_friends_batch')
+    return job_response(job, "<h2>Step 11. Download of the links shared by your friends is queued. Once its job is done, finally in this alpha demo we download your stream posts from 'stream' FQL table. Click here - : <a href='%s'>/table/table_stream</a>." % reverse('fbschema_table_stream'))
 
 
+@authenticated
 def table_stream(request):
     '''
     table stream
     '''
-    context_model = FacebookStream    
-    graph = require_persistent_graph(request)
-    response_data = graph.fql(context_model.fql_query_me())
-    context_model.save_update_delete(request, response_data, stream_nature=True)
-    return HttpResponse("<h2>Successfully done. Do checkout the project on github and help me to implement more fql tables and do more awesome things with locally hosted fql tables.")
+    job = enqueue_job(request, 'table_stream')
+    return job_response(job, "<h2>Download of your stream posts is queued, it is the last step. Do checkout the project on github and help me to implement more fql tables and do more awesome things with locally hosted fql tables.")
+
 
 ### Save update labs :
+@authenticated
 def table_link_save_update(request):
     '''
     table link : Save update
     '''
-    context_model = FacebookLink
-    graph = require_persistent_graph(request)
-    response_data = graph.fql(context_model.fql_query_me())
-    context_model.save_update_delete(request, response_data)
-
-    return HttpResponse("<h2>Step 10. Now to download all shared links by your friends (3 at a time)  ! Click here - : <a href='%s'>/table/table_link_friends_batch</a>." % reverse('fbschema_table_link_friends_batch'))
-
-
+    job = enqueue_job(request, 'table_link')
+    return job_response(job, "<h2>Step 10. Download of your shared links is queued. Once its job is done, to download all shared links by your friends (3 at a time)  ! Click here - : <a href='%s'>/table/table_link_friends_batch</a>." % reverse('fbschema_table_link_friends_batch'))
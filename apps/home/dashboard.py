@@ -0,0 +1,113 @@
+'''
+Data of the logged in dashboard. It is read from the viewer's own FacebookUser tuple ( and its shared profile ), never
+from facebook during the request, and cached per system user for settings.HOME_DASHBOARD_TTL seconds or until the
+user table of the viewer or a shared profile is written, in this process or in a worker running the refresh job, the
+generation numbers of apps.fbschema.fql_server ( kept in the database ) tell.
+
+When an entry is built from a tuple downloaded more than HOME_DASHBOARD_TTL seconds ago, or before the tuple exists,
+a table_user job is queued so a worker downloads it again ( see apps.fbschema.jobs ) and the stale data is served
+meanwhile. The ETag and Last-Modified of an entry let browsers revalidate the page with a 304.
+
+Usage -
+    entry = get_dashboard(request)
+    entry['data']['name'], entry['data']['profile_pic'], entry['etag'], entry['modified']
+'''
+import datetime
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils import timezone
+
+from apps.fbschema.fql_server import generations
+from apps.fbschema.jobs import enqueue_job
+from apps.fbschema.models import FacebookUser
+from apps.fbschema.sync_models import SyncJob
+
+logger = logging.getLogger(__name__)
+
+DASHBOARD_TTL = getattr(settings, 'HOME_DASHBOARD_TTL', 600)
+PICTURE_URL = 'https://graph.facebook.com/%s/picture?type=large'
+REFRESH_TASK = 'table_user'
+
+'''
+Columns of the shared profile shown in the header
+'''
+PROFILE_FIELDS = ('first_name', 'username', 'friend_count', 'likes_count', 'subscriber_count', 'wall_count')
+
+
+def dashboard_key(user_id):
+    return 'home:dashboard:%s' % user_id
+
+
+def dashboard_data(user, facebook_profile):
+    '''
+    Header and profile data of a system user from its stored tuples, and the time they were downloaded ( None when
+    the viewer's user tuple hasn't been downloaded yet )
+    '''
+    facebook_id = facebook_profile and facebook_profile.facebook_id
+    data = {'uid': facebook_id, 'name': facebook_profile and facebook_profile.facebook_name or user.username,
+            'profile_pic': facebook_id and PICTURE_URL % facebook_id or None}
+    if facebook_id:
+        for facebook_user in FacebookUser.objects.filter(user=user, uid=facebook_id).select_related('profile')[:1]:
+            profile = facebook_user.profile
+            data.update([(name, getattr(profile, name)) for name in PROFILE_FIELDS])
+            data['name'] = profile.first_name or data['name']
+            return data, profile.refreshed
+    return data, None
+
+
+def refresh_in_background(request):
+    '''
+    Queues a download of the viewer's user tuple, unless one is queued or running already
+    '''
+    queued = SyncJob.objects.filter(user=request.user, task=REFRESH_TASK, status__in=(SyncJob.PENDING, SyncJob.RUNNING))
+    if not queued.exists():
+        logger.info("Dashboard of %s is stale, queueing %s" % (request.user, REFRESH_TASK))
+        enqueue_job(request, REFRESH_TASK)
+
+
+def build_dashboard(request, generation):
+    try:
+        facebook_profile = request.user.get_profile()
+    except ObjectDoesNotExist:
+        # logged in without facebook, there is nothing to download
+        facebook_profile = None
+    data, refreshed = dashboard_data(request.user, facebook_profile)
+    now = timezone.now()
+    if facebook_profile and (refreshed is None or refreshed < now - datetime.timedelta(seconds=DASHBOARD_TTL)):
+        refresh_in_background(request)
+    text = json.dumps(data, sort_keys=True)
+    return {
+        'generation': generation,
+        'data': data,
+        'etag': hashlib.sha1(("%s|%s" % (request.user.id, text)).encode('utf-8')).hexdigest(),
+        'modified': refreshed or now,
+    }
+
+
+def get_dashboard(request):
+    '''
+    Dashboard entry of the user of the request, {data, etag, modified}. Memoized on the request, so the conditional
+    GET functions and the view share it
+    '''
+    entry = getattr(request, '_dashboard', None)
+    if entry is None:
+        generation = generations([FacebookUser], request.user.id)
+        entry = cache.get(dashboard_key(request.user.id))
+        if entry is None or entry['generation'] != generation:
+            entry = build_dashboard(request, generation)
+            cache.set(dashboard_key(request.user.id), entry, DASHBOARD_TTL)
+        request._dashboard = entry
+    return entry
+
+
+def dashboard_etag(request, *args, **kwargs):
+    return get_dashboard(request)['etag']
+
+
+def dashboard_last_modified(request, *args, **kwargs):
+    return get_dashboard(request)['modified']
@@ -5,7 +5,14 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+from django.contrib.auth.models import User
+from django.db.models import F
 from django.test import TestCase
+from django_facebook.models import FacebookProfile
+from apps.fbschema.jobs import JobRequest
+from apps.fbschema.models import FacebookUser, FacebookUserProfile
+from apps.fbschema.sync_models import SyncJob, TableGeneration
+from apps.fbschema.synthetic import SyntheticFacebook
 
 
 class SimpleTest(TestCase):
@@ -14,3 +21,48 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class DashboardTest(TestCase):
+    def test_conditional_get(self):
+        user = User.objects.create_user('viewer', password='secret')
+        # django_facebook may have created the profile already
+        FacebookProfile.objects.get_or_create(user=user)
+        FacebookProfile.objects.filter(user=user).update(facebook_id=100000000000001, facebook_name='Viewer')
+        self.client.login(username='viewer', password='secret')
+
+        response = self.client.get('/home')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['dashboard']['name'], 'Viewer')
+        self.assertTrue(response.has_header('Last-Modified'))
+        etag = response['ETag']
+        # nothing is downloaded in the request, a job refreshes the user tuple
+        self.assertEqual(SyncJob.objects.filter(user=user, task='table_user', status=SyncJob.PENDING).count(), 1)
+
+        self.assertEqual(self.client.get('/home', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(SyncJob.objects.filter(user=user).count(), 1)
+
+        facebook = SyntheticFacebook()
+        FacebookUser.save_profiles(JobRequest(user), facebook.rows('user', facebook.me))
+        response = self.client.get('/home', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.context['dashboard']['username'], FacebookUser.objects.get(user=user).profile.username)
+        self.assertEqual(SyncJob.objects.filter(user=user).count(), 1)
+
+    def test_worker_write(self):
+        user = User.objects.create_user('viewer', password='secret')
+        FacebookProfile.objects.get_or_create(user=user)
+        FacebookProfile.objects.filter(user=user).update(facebook_id=100000000000001, facebook_name='Viewer')
+        self.client.login(username='viewer', password='secret')
+        facebook = SyntheticFacebook()
+        FacebookUser.save_profiles(JobRequest(user), facebook.rows('user', facebook.me))
+        etag = self.client.get('/home')['ETag']
+
+        # a worker process stores a new profile, save_profiles bumps the generation in the database only
+        FacebookUserProfile.objects.filter(uid=facebook.me).update(first_name='Renamed')
+        self.assertEqual(self.client.get('/home', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        TableGeneration.objects.filter(table='user', viewer=0).update(value=F('value') + 1)
+        response = self.client.get('/home', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['dashboard']['name'], 'Renamed')
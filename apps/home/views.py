@@ -8,14 +8,19 @@ from django.template.context import RequestContext
 from django.utils.translation import ugettext as _
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 
 from django_facebook.api import get_persistent_graph, FacebookUserConverter, require_persistent_graph
 
+from apps.home.dashboard import dashboard_etag, dashboard_last_modified, get_dashboard
+
 logger = logging.getLogger(__name__)
 
 @login_required
+@cache_control(private=True, max_age=0)
+@condition(etag_func=dashboard_etag, last_modified_func=dashboard_last_modified)
 def logged_home(request):
-  graph = require_persistent_graph(request)
-  #print graph.fql("SELECT uid2 FROM friend WHERE uid1 IN ( SELECT uid FROM user WHERE uid=me() )");
-  return render_to_response('home/logged-home.html', {'graph': graph, 'profile_pic': graph.my_image_url}, context_instance = RequestContext(request) );  
-
+  # Served from the stored user tuple, see apps.home.dashboard. Repeat visits are answered with a 304
+  dashboard = get_dashboard(request)['data']
+  return render_to_response('home/logged-home.html', {'dashboard': dashboard, 'profile_pic': dashboard['profile_pic']}, context_instance = RequestContext(request) );
@@ -176,6 +176,17 @@ LOGGING = {
             'level': 'INFO',
             'propagate': True,
         },
+        'apps.fbschema.jobs': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': True,
+        },
+        # DEBUG logs the keys every sync chunk adds and updates, a lot for large syncs
+        'apps.fbschema.models': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': True,
+        },
         'django_facebook': {
             'handlers': ['console'],
             'level': 'DEBUG',
@@ -210,4 +221,88 @@ AUTHENTICATION_BACKENDS = (
 
 AUTH_PROFILE_MODULE = 'django_facebook.FacebookProfile'
 
+## DashFB Settings
+
+# Number of tuples written per statement/transaction by BaseFbModel.save_update_delete(bulk=True)
+FBSCHEMA_BULK_CHUNK_SIZE = 500
+# Compare responses with the stored tuples in SQL, through a temporary staging table and the native upsert of MySQL,
+# sqlite >= 3.24 or PostgreSQL >= 9.5, instead of loading the keys of the stored tuples into memory
+FBSCHEMA_STAGING_SYNC = False
+
+# Table downloads run as background jobs, `python manage.py fbschema_worker` starts this many worker processes
+FBSCHEMA_JOB_WORKERS = 2
+# Seconds an idle worker waits before looking for new jobs
+FBSCHEMA_JOB_POLL_INTERVAL = 2
+# Run jobs inline in the request instead, no worker needed ( development server )
+FBSCHEMA_JOBS_EAGER = False
+
+# Profiles of the user table are shared by all system users, a friend's profile downloaded by anyone less than this
+# many hours ago isn't downloaded again, only the columns depending on the viewer are
+FBSCHEMA_PROFILE_MAX_AGE_HOURS = 24
+
+# batch_fql requests kept in flight at once by friend batch tasks
+FBSCHEMA_FETCH_CONCURRENCY = 4
+# Seconds a batch_fql request may take before batches start to shrink
+FBSCHEMA_FETCH_TARGET_LATENCY = 10
+# Timeouts the query of a single friend may hit before friend batch tasks skip the friend
+FBSCHEMA_FETCH_RETRIES = 3
+
+# Album, photo, link and stream syncs only download tuples changed since the last sync, every this many days
+# an owner's tuples are downloaded and reconciled in full to catch deletions
+FBSCHEMA_FULL_SYNC_INTERVAL_DAYS = 7
+
+# Ceiling on the resident memory of a syncing process in MB, None for no ceiling. Responses are ingested in
+# chunks of FBSCHEMA_BULK_CHUNK_SIZE tuples which are halved while the ceiling is exceeded
+FBSCHEMA_INGEST_MEMORY_LIMIT = None
+
+# Log every added, updated and deleted tuple in a changelog so tables can be viewed as they were on some day
+FBSCHEMA_HISTORY = True
+# Changes logged for a table before a new full snapshot of it is taken, bounds the replay of "as of" reconstructions
+FBSCHEMA_HISTORY_SNAPSHOT_EVERY = 5000
+# Keep leaderboards ( top albums and photos by likes and comments ) and per owner / per type counts up to date as
+# syncs write, see apps.fbschema.aggregates
+FBSCHEMA_AGGREGATES = True
+# Full text index of the text columns kept up to date as syncs write, see apps.fbschema.search
+FBSCHEMA_SEARCH = True
+# 'fts5' ( sqlite ), 'mysql' ( FULLTEXT ) or 'postings' ( inverted index written in python ), None picks by database
+FBSCHEMA_SEARCH_BACKEND = None
+# Processes counting terms for apps.fbschema.corpus, None for one per cpu, 0 or 1 counts in the calling process
+FBSCHEMA_CORPUS_PROCESSES = None
+# Social graphs of system users kept in memory by each process, see apps.fbschema.social_graph
+FBSCHEMA_SOCIAL_GRAPH_CACHE_SIZE = 20
+# Admin change lists count tuples exactly up to this many, above it they use the estimate of the database, see
+# apps.fbschema.admin_utils
+FBSCHEMA_ADMIN_EXACT_COUNT_LIMIT = 10000
+# Seconds the admin remembers the key the next page of a change list starts at
+FBSCHEMA_ADMIN_KEYSET_TIMEOUT = 600
+
+# Seconds the dashboard of a user is cached, and after which its facebook data is downloaded again in the background,
+# see apps.home.dashboard
+HOME_DASHBOARD_TTL = 600
+
+# Compiled queries kept by the local fql engine
+FBSCHEMA_FQL_PLAN_CACHE_SIZE = 500
+# Seconds results of the local /fql endpoint stay cached, writes to a table invalidate them earlier
+FBSCHEMA_FQL_CACHE_TIMEOUT = 300
+# Results with more rows are streamed without being cached
+FBSCHEMA_FQL_CACHE_MAX_ROWS = 5000
+
+# Offline runs, jobs talk to a fake graph instead of facebook ( see apps.fbschema.fakegraph ). Either recorded
+# responses, {'fixtures': '/path/to/fixtures'}, or synthetic data, {'friends': 200, 'photos': 20, 'latency': 0.5, ...}
+FBSCHEMA_FAKE_GRAPH = None
+# Directory every fql response received from facebook is recorded into, for replaying with FBSCHEMA_FAKE_GRAPH
+FBSCHEMA_RECORD_FIXTURES = None
+# Graph api url jobs send requests to instead of https://graph.facebook.com/, for example http://127.0.0.1:8001/
+# to go through `python manage.py fbschema_fakegraph`
+FBSCHEMA_GRAPH_API_URL = None
+
+# Per phase timers, query and tuple counts of syncs and graph api latencies, served at /metrics
+FBSCHEMA_METRICS = True
+# Seconds a process keeps measurements before adding them to the totals in the database, jobs flush when done
+FBSCHEMA_METRICS_FLUSH_INTERVAL = 10
+# Addresses which may read the metrics without being staff, the Prometheus scraper
+FBSCHEMA_METRICS_ALLOWED_IPS = ('127.0.0.1',)
+# Dotted paths of callables connected to apps.fbschema.signals.metric_observed, e.g. forwarding to statsd
+FBSCHEMA_METRICS_HOOKS = ()
+
 from local_settings import *